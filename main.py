@@ -13,13 +13,19 @@ Re-written in Python, October 2025 by Louis De Neve
 import os
 from pathlib import Path
 import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import redirect_stderr, redirect_stdout
+from multiprocessing import Manager
 
-from processing.unzip_data import unzip_data
-from processing.calculate_trade_matrix import calculate_trade_matrix
+from processing.background_writer import BackgroundWriter
+from processing.convert_data import convert_data
+from processing.pipeline_context import PipelineContext
+from processing.mrio_cache import MrioCache
+from processing.calculate_trade_matrix import calculate_trade_matrix, calculate_trade_matrix_ensemble
 from processing.animal_products_to_feed import animal_products_to_feed
 from processing.calculate_area import calculate_area
 
-from provenance._consumption_provenance import main as consumption_provenance_main
+from provenance._consumption_provenance import consumption_provenance_all
 from provenance._get_impacts_bd import get_impacts as get_impacts_main
 from provenance._process_dat import main as process_dat_main
 # from provenance.global_commodity_impacts import main as global_commodity_impacts_main
@@ -41,12 +47,48 @@ PREFER_IMPORT = "import"
 # select working directory
 WORKING_DIR = '.'
 
-# 0 = all, 1 = unzip, 2 = trade matrix, 3 = animal products to feed, 4 = area calculation, 5 = country impacts
+# MRIO solver backend, see processing/mrio_solver.py
+# inputs: ("sparse", "scc", "dense")
+MRIO_SOLVER = "sparse"
+
+# number of worker processes solving the per-item MRIO models
+MRIO_WORKERS = os.cpu_count()
+
+# on-disk cache of the per-item MRIO solutions, reruns only solve items whose inputs changed (0 = no cache)
+MRIO_CACHE_SIZE_GB = 2
+
+# cached MRIO solutions not used for this many days are removed
+MRIO_CACHE_MAX_AGE_DAYS = 30
+
+# only solve the rows of the MRIO models that the provenance of COUNTRIES needs, instead of every
+# consumer country; the trade matrices then only hold the flows of COUNTRIES and their feed suppliers
+MRIO_CONSUMERS_ONLY = False
+
+# Monte-Carlo uncertainty of the MRIO step, written to TradeMatrixEnsemble_*.csv next to the trade matrix (n_draws 0 = off)
+# multiplicative errors with coefficients of variation z_cv (trade flows) and p_cv (production)
+# distribution inputs: ("lognormal", "normal"), memory_budget_gb limits the number of ensemble workers
+MRIO_ENSEMBLE = {"n_draws": 0, "z_cv": 0.1, "p_cv": 0.05, "distribution": "lognormal", "quantiles": (0.05, 0.5, 0.95), "memory_budget_gb": 4}
+
+# number of years processed at the same time in separate processes (1 = one year after another)
+YEAR_WORKERS = 1
+
+# memory (GB) the concurrently running years may use together, based on the estimates below
+YEAR_MEMORY_BUDGET_GB = 32
+
+# estimated peak memory (GB) of one year per pipeline component, the historic years use the smaller FBS tables
+YEAR_STAGE_MEMORY_GB = {
+    "Historic": {2: 6, 3: 5, 4: 3, 5: 4},
+    "": {2: 8, 3: 7, 4: 4, 5: 5}}
+
+# memory (GB) the shared data context may use to cache reference tables and yearly FAOSTAT slices
+MEMORY_BUDGET_GB = 8
+
+# 0 = all, 1 = convert data, 2 = trade matrix, 3 = animal products to feed, 4 = area calculation, 5 = country impacts
 PIPELINE_COMPONENTS:list = [0]
 # PIPELINE_COMPONENTS:list = [5]
 
-from pandas import read_excel, read_csv
-cdat = read_excel("input_data/nocsDataExport_20251021-164754.xlsx")
+from processing.excel_cache import read_excel_cached
+cdat = read_excel_cached("input_data/nocsDataExport_20251021-164754.xlsx")
 COUNTRIES = [_.upper() for _ in cdat["ISO3"].unique().tolist() if isinstance(_, str)]
 # COUNTRIES = ["USA", "IND", "BRA", "JPN", "UGA", "GBR"]
 
@@ -58,14 +100,23 @@ def main(years=list(range(1986, 2022)),
          pipeline_components=[0],
          working_dir=".",
          countries = ["GBR"],
-         results_dir="./results"):
+         results_dir="./results",
+         memory_budget_gb=8,
+         solver="sparse",
+         n_workers=1,
+         year_workers=1,
+         year_memory_budget_gb=32,
+         mrio_cache_size_gb=0,
+         mrio_cache_max_age_days=30,
+         consumers_only=False,
+         ensemble=None):
     
     os.system('cls' if os.name == 'nt' else 'clear')
     os.chdir(working_dir)
 
     component_dict = {
         0: "Full pipeline",
-        1: "Unzipping data",
+        1: "Converting data",
         2: "Trade matrix calculation",
         3: "Animal products to feed calculation",
         4: "Area calculation",
@@ -86,76 +137,170 @@ def main(years=list(range(1986, 2022)),
 
 
     if (0 in pipeline_components) or (1 in pipeline_components):
-        print("Unzipping data...")
+        # the zip archives are read directly, unzip_data() is only needed if the raw CSVs are wanted
+        print("Converting data to columnar store...")
         try:
-            unzip_data("./input_data") # Uncomment this line to enable unzipping
-            print("Data already unzipped or unzipping completed successfully.")
+            convert_data("./input_data")
+            print("Data already converted or conversion completed successfully.")
         except Exception as e:
-            print(f"Error during data unzipping: {e}")
-            # Continue anyway as data might already be unzipped
+            print(f"Error during data conversion: {e}")
+            # Continue anyway, stages fall back to streaming the CSVs out of the zip archives
 
     if pipeline_components == [1]:
         return
-    
+
+    year_options = dict(
+        conversion_option=conversion_option,
+        prefer_import=prefer_import,
+        pipeline_components=pipeline_components,
+        countries=countries,
+        solver=solver,
+        mrio_cache=None,
+        consumers_only=consumers_only,
+        ensemble=ensemble)
+
+    if mrio_cache_size_gb > 0:
+        year_options["mrio_cache"] = MrioCache(max_size_gb=mrio_cache_size_gb, max_age_days=mrio_cache_max_age_days)
+
+    if year_workers > 1 and len(years) > 1:
+        run_years_parallel(
+            years,
+            year_options,
+            year_workers=year_workers,
+            year_memory_budget_gb=year_memory_budget_gb,
+            memory_budget_gb=memory_budget_gb,
+            n_workers=max(1, n_workers // year_workers))
+        return
+
+    # shared by every stage and year of this run
+    context = PipelineContext("./input_data", memory_budget_gb=memory_budget_gb)
+
     for year in years:
+        process_year(year, context=context, n_workers=n_workers, **year_options)
 
-        year_dir = Path(f"./results/{year}")
-        year_dir.mkdir(exist_ok=True)
-        mrio_dir = Path(f"./results/{year}/.mrio")
-        mrio_dir.mkdir(exist_ok=True)
 
-        print(f"\nProcessing year: {year}")
-        
-        hist = "Historic" if year < 2010 else ""
+def process_year(year,
+                 conversion_option="dry_matter",
+                 prefer_import="import",
+                 pipeline_components=[0],
+                 countries=["GBR"],
+                 context=None,
+                 solver="sparse",
+                 n_workers=1,
+                 mrio_cache=None,
+                 consumers_only=False,
+                 ensemble=None,
+                 report_stage=None):
+    """Run the selected stages for one year, in order (2 -> 3 -> 5)"""
+
+    if context is None:
+        context = PipelineContext("./input_data")
+    if report_stage is None:
+        report_stage = lambda stage: None
+
+    year_dir = Path(f"./results/{year}")
+    year_dir.mkdir(exist_ok=True)
+    mrio_dir = Path(f"./results/{year}/.mrio")
+    mrio_dir.mkdir(exist_ok=True)
+
+    print(f"\nProcessing year: {year}")
+    
+    hist = "Historic" if year < 2010 else ""
+
+    # results are passed from stage to stage in memory and written in the background
+    with BackgroundWriter() as writer:
+        trade_matrix = trade_matrix_feed = None
 
         if (0 in pipeline_components) or (2 in pipeline_components):
-            calculate_trade_matrix(
+            report_stage("trade matrix")
+            consumers = None
+            if consumers_only:
+                area_codes = context.table("area_codes")
+                consumers = area_codes.loc[area_codes["ISO3"].isin(countries), "FAOSTAT"].dropna().astype(int).tolist()
+            trade_matrices = calculate_trade_matrix(
                 conversion_opt=conversion_option,
                 prefer_import=prefer_import,
                 year=year,
-                historic=hist)
-            
+                historic=hist,
+                context=context,
+                solver=solver,
+                n_workers=n_workers,
+                mrio_cache=mrio_cache,
+                consumers=consumers,
+                writer=writer)
+            trade_matrix = trade_matrices[(prefer_import, conversion_option)]
+
+            if ensemble and ensemble.get("n_draws", 0) > 0:
+                report_stage("trade matrix ensemble")
+                calculate_trade_matrix_ensemble(
+                    conversion_opt=conversion_option,
+                    prefer_import=prefer_import,
+                    year=year,
+                    historic=hist,
+                    context=context,
+                    n_workers=n_workers,
+                    **ensemble)
+        
         if (0 in pipeline_components) or (3 in pipeline_components):
-            animal_products_to_feed(
+            report_stage("animal feed")
+            # the partitions are only kept in memory for the provenance stage of this year,
+            # which always uses the import / dry matter trade matrices
+            trade_matrix_feed = animal_products_to_feed(
                 prefer_import=prefer_import,
                 conversion_opt=conversion_option,
                 year=year,
-                historic=hist)
-            
+                historic=hist,
+                context=context,
+                trade_matrix=trade_matrix,
+                writer=writer,
+                collect=((0 in pipeline_components) or (5 in pipeline_components))
+                    and (prefer_import, conversion_option) == ("import", "dry_matter"))
+        
         if (0 in pipeline_components) or (4 in pipeline_components):
             if 4 in pipeline_components:
                 print("    MRIO area calculation is deprecated")
             else:
                 print("   MRIO complete") 
-            
+        
             # calculate_area(
             #     prefer_import=PREFER_IMPORT,
             #     conversion_opt=CONVERSION_OPTION,
             #     year=year)
-            
+        
 
         if (0 in pipeline_components) or (5 in pipeline_components):
+            report_stage("provenance")
             print("    Processing country-level provenance and impacts...")
             missing_items = []
             if hist == "Historic":
-                sua = read_csv(f"./input_data/FoodBalanceSheetsHistoric_E_All_Data_(Normalized).csv", encoding="latin-1", low_memory=False)
+                sua = context.faostat("fbs_historic", years=[year])
             else:
-                sua = read_csv(f"./input_data/SUA_Crops_Livestock_E_All_Data_(Normalized).csv", encoding="latin-1", low_memory=False)
+                sua = context.faostat("sua", years=[year])
+
+            # the provenance stage always uses the import / dry matter trade matrices
+            if (prefer_import, conversion_option) != ("import", "dry_matter"):
+                trade_matrix = trade_matrix_feed = None
+
+            # provenance of all countries in one pass, impacts per country
+            t0 = time.perf_counter()
+            provenance = consumption_provenance_all(
+                year, countries, sua, hist, context=context, trade_matrix=trade_matrix, trade_matrix_feed=trade_matrix_feed)
+            print(f"    Provenance of {len(countries)} countries completed in {time.perf_counter() - t0:.2f} seconds")
 
             for country in countries:
                 print(f"    Processing country: {country}")
                 t0 = time.perf_counter()
-                cons, feed = consumption_provenance_main(year, country, sua, hist)
+                cons, feed = provenance[country]
                 if len(cons) == 0:
                     continue
-                bf = get_impacts_main(feed, year, country, "feed_impacts_wErr.csv")  
-                bh = get_impacts_main(cons, year, country, "human_consumed_impacts_wErr.csv") 
-                mi = process_dat_main(year, country, bh, bf)
+                bf = get_impacts_main(feed, year, country, "feed_impacts_wErr.csv", context=context)  
+                bh = get_impacts_main(cons, year, country, "human_consumed_impacts_wErr.csv", context=context) 
+                mi = process_dat_main(year, country, bh, bf, context=context)
                 missing_items.extend(mi)
                 t1 = time.perf_counter()
                 print(f"         Completed in {t1 - t0:.2f} seconds")
 
-            
+        
             # Save missing items to a file
             missing_items_file = Path(f"./results/{year}/missing_items.txt")
             with open(missing_items_file, "w") as f:
@@ -163,9 +308,102 @@ def main(years=list(range(1986, 2022)),
                 for item, code in set(missing_items):
                     f.write(f" - {item}: {code}\n")
 
+    print(f"Year {year} processing completed successfully\n")
+
+
+def estimate_year_memory_gb(year, pipeline_components):
+    """Rough peak memory of one year's stages, used to decide how many years can run at once"""
+    components = [2, 3, 4, 5] if 0 in pipeline_components else pipeline_components
+    per_stage = YEAR_STAGE_MEMORY_GB["Historic" if year < 2010 else ""]
+    return max([per_stage.get(c, 0) for c in components] + [1])
+
+
+def _process_year_worker(year, year_options, memory_budget_gb, n_workers, progress_queue):
+    # each year logs to its own file, the parent prints the consolidated progress
+    log_file = Path(f"./results/{year}/pipeline.log")
+    log_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(log_file, "w") as log, redirect_stdout(log), redirect_stderr(log):
+        try:
+            process_year(
+                year,
+                context=PipelineContext("./input_data", memory_budget_gb=memory_budget_gb),
+                n_workers=n_workers,
+                report_stage=lambda stage: progress_queue.put((year, stage)),
+                **year_options)
+        except SystemExit as e:
+            # missing inputs end the run with sys.exit(), only fail this year
+            print(e)
+            raise RuntimeError(str(e)) from None
+    return year
+
+
+def run_years_parallel(years, year_options, year_workers, year_memory_budget_gb, memory_budget_gb=8, n_workers=1):
+    """
+    Process several years at once in separate processes
+
+    A year is started only while the estimated peak memory of all running
+    years stays within year_memory_budget_gb (one year always runs). Stages
+    keep their order within each year; each year's output goes to
+    results/{year}/pipeline.log and a consolidated status line is printed
+    whenever a year changes stage.
+    """
+
+    pending = list(years)
+    status = {year: "queued" for year in years}
+    running = {}
+    failed = []
+
+    def print_status():
+        active = " | ".join(f"{y}: {status[y]}" for y in years if status[y] not in ("queued", "done", "failed"))
+        done = sum(s == "done" for s in status.values())
+        queued = sum(s == "queued" for s in status.values())
+        print(f"    [{time.strftime('%H:%M:%S')}] {active or '-'} || done {done}/{len(years)}, queued {queued}")
+
+    with Manager() as manager, ProcessPoolExecutor(max_workers=year_workers) as executor:
+        progress_queue = manager.Queue()
+
+        changed = True
+        while pending or running:
+            used_gb = sum(mem for _, mem in running.values())
+            while pending and len(running) < year_workers:
+                year = pending[0]
+                mem = estimate_year_memory_gb(year, year_options["pipeline_components"])
+                if running and used_gb + mem > year_memory_budget_gb:
+                    break
+                pending.pop(0)
+                future = executor.submit(
+                    _process_year_worker, year, year_options, memory_budget_gb / year_workers, n_workers, progress_queue)
+                running[future] = (year, mem)
+                status[year] = "starting"
+                used_gb += mem
+                changed = True
+
+            if changed:
+                print_status()
+                changed = False
+
+            finished, _ = wait(running, timeout=5, return_when=FIRST_COMPLETED)
+
+            while not progress_queue.empty():
+                year, stage = progress_queue.get()
+                if status[year] not in ("done", "failed"):
+                    status[year] = stage
+                    changed = True
 
+            for future in finished:
+                year, _ = running.pop(future)
+                try:
+                    future.result()
+                    status[year] = "done"
+                except Exception as e:
+                    status[year] = "failed"
+                    failed.append(year)
+                    print(f"    Year {year} failed: {e} (see results/{year}/pipeline.log)")
+                changed = True
 
-        print(f"Year {year} processing completed successfully\n")
+    print_status()
+    if failed:
+        print(f"Years that failed: {sorted(failed)}")
 
 
 if __name__ == "__main__":
@@ -175,5 +413,14 @@ if __name__ == "__main__":
         prefer_import=PREFER_IMPORT,
         pipeline_components=PIPELINE_COMPONENTS,
         working_dir=WORKING_DIR,
-        countries=COUNTRIES
+        countries=COUNTRIES,
+        memory_budget_gb=MEMORY_BUDGET_GB,
+        solver=MRIO_SOLVER,
+        n_workers=MRIO_WORKERS,
+        year_workers=YEAR_WORKERS,
+        year_memory_budget_gb=YEAR_MEMORY_BUDGET_GB,
+        mrio_cache_size_gb=MRIO_CACHE_SIZE_GB,
+        mrio_cache_max_age_days=MRIO_CACHE_MAX_AGE_DAYS,
+        consumers_only=MRIO_CONSUMERS_ONLY,
+        ensemble=MRIO_ENSEMBLE
     )
\ No newline at end of file
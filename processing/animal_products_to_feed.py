@@ -10,68 +10,258 @@ Re-written in Python, October 2025 by Louis De Neve
 
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
 from pathlib import Path
 
-def ml_animal_prod(year, country, production_animals,feed_data, weighing_factors,):
-    production_animal_data_1 = production_animals[
-        (production_animals["Area_Code"] == country) &
-        (production_animals["Year"] == year) &
-        (production_animals["Value"] > 0)]
-    data_feed = feed_data[
-        (feed_data["Area_Code"] == country) &
-        (feed_data["Year"] == year) &
-        (feed_data["Value"] > 0)]
-    # if len(production_animal_data_1) == 0 or len(data_feed) == 0:
-    #     return None
-    data_2 = weighing_factors.merge(production_animal_data_1, on="Item_Code", how="inner")
+from processing.background_writer import run_now
+from processing.partitioned_csv import PartitionedCsvWriter
+from processing.pipeline_context import PipelineContext
+
+def ml_animal_prod(countries, production_animals, feed_data, weighing_factors):
+    """
+    Feed use per unit of each animal product, for all (producer country, year) pairs at once
+
+    Within each country and year, the weighing factors of the animal products
+    are normalised to their mean and weighted by production, and the country's
+    feed use is distributed over the animal products in proportion. The outer
+    product of the per-product weights and the feed items is built for all
+    countries in one go, as flat arrays.
+
+    Args:
+        countries: DataFrame of the Producer_Country_Code, Year pairs to calculate
+        production_animals: animal production (Area_Code, Item_Code, Year, Value)
+        feed_data: feed use (Area_Code, Year, Primary_Item_Code, Value)
+        weighing_factors: Item_Code, Weighing_factors
+
+    Returns:
+        DataFrame of Producer_Country_Code, Year, Animal_Product_Code, Item_Code, Value,
+        ordered by Year, Producer_Country_Code, animal product and feed item
+    """
+
+    keys = ["Area_Code", "Year"]
+    countries = (countries
+        .rename(columns={"Producer_Country_Code": "Area_Code"})
+        .sort_values(by=["Year", "Area_Code"])
+        .assign(group=lambda x: np.arange(len(x))))
+
+    production = production_animals[production_animals["Value"] > 0][["Area_Code", "Year", "Item_Code", "Value"]]
+    data_2 = weighing_factors.merge(production, on="Item_Code", how="inner")
     data_2 = data_2[data_2["Weighing_factors"] > 0]
-    data_2["relative_weighing"] = data_2["Weighing_factors"] / data_2["Weighing_factors"].mean()
+    data_2 = data_2.merge(countries, on=keys, how="inner").sort_values(by="group", kind="stable")
+
+    by_country = data_2.groupby("group")
+    data_2["relative_weighing"] = data_2["Weighing_factors"] / by_country["Weighing_factors"].transform("mean")
     data_2["weighted_production"] = data_2["relative_weighing"] * data_2["Value"]
-    data_2["relative_production"] = data_2["weighted_production"] / data_2["weighted_production"].sum()
+    data_2["relative_production"] = data_2["weighted_production"] / data_2.groupby("group")["weighted_production"].transform("sum")
     data_2["rel_prod_weighted"] = data_2["relative_production"] / data_2["Value"]
-    
-    mpt = np.outer(data_2["rel_prod_weighted"], data_feed["Value"])
 
-    row_indices = data_2["Item_Code"].tolist()
-    col_indices = data_feed["Primary_Item_Code"].tolist()
-    
-    results = []
-    for j in range(mpt.shape[0]):
-        for k in range(mpt.shape[1]):
-            if (mpt[j, k] > 0) & (not np.isnan(row_indices[j])):
-                results.append({
-                    "Producer_Country_Code": country,
-                    "Year": year,
-                    "Animal_Product_Code": row_indices[j],
-                    "Item_Code": col_indices[k],
-                    "Value": mpt[j, k]
-                })
-    return results
-
-def animal_products_to_feed(prefer_import="import", conversion_opt="dry_matter", year=2013, historic="Historic"):
+    data_feed = feed_data[feed_data["Value"] > 0]
+    data_feed = data_feed.merge(countries, on=keys, how="inner").sort_values(by="group", kind="stable")
+
+    # grouped outer product: every animal product row is paired with the feed rows of its country and year
+    feed_groups = data_feed["group"].to_numpy()
+    feed_start = np.searchsorted(feed_groups, np.arange(len(countries)))
+    feed_count = np.searchsorted(feed_groups, np.arange(len(countries)), side="right") - feed_start
+
+    animal_groups = data_2["group"].to_numpy()
+    repeats = feed_count[animal_groups]
+    animal_idx = np.repeat(np.arange(len(data_2)), repeats)
+    offsets = np.arange(len(animal_idx)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    feed_idx = np.repeat(feed_start[animal_groups], repeats) + offsets
+
+    animal_codes = data_2["Item_Code"].to_numpy()[animal_idx]
+    values = data_2["rel_prod_weighted"].to_numpy()[animal_idx] * data_feed["Value"].to_numpy()[feed_idx]
+    keep = (values > 0) & ~pd.isna(animal_codes)
+
+    return pd.DataFrame({
+        "Producer_Country_Code": data_2["Area_Code"].to_numpy()[animal_idx][keep],
+        "Year": data_2["Year"].to_numpy()[animal_idx][keep],
+        "Animal_Product_Code": animal_codes[keep],
+        "Item_Code": data_feed["Primary_Item_Code"].to_numpy()[feed_idx][keep],
+        "Value": values[keep]})
+
+def _axis(*keys):
+    """
+    Integer codes of the rows of several key frames on one shared, sorted axis
+
+    Every frame has the same key columns (in the same order). Rows with a
+    missing key get code -1, as groupby() would drop them.
+
+    Returns:
+        list of code arrays, one per frame, and the frame of axis labels
+    """
+
+    columns = list(keys[0].columns)
+    combined = pd.concat([frame.set_axis(columns, axis=1) for frame in keys], ignore_index=True)
+    codes = combined.groupby(columns, sort=True, dropna=True).ngroup().to_numpy()
+    codes = np.where(np.isnan(codes), -1, codes).astype(np.int64)
+    labels = combined.dropna().drop_duplicates().sort_values(by=columns).reset_index(drop=True)
+    return np.split(codes, np.cumsum([len(frame) for frame in keys])[:-1]), labels
+
+
+def _sparse(row_codes, col_codes, values, shape):
+    # matrix of the values and of the pattern (number of contributing rows), duplicates summed
+    valid = (row_codes >= 0) & (col_codes >= 0)
+    coords = (row_codes[valid], col_codes[valid])
+    values = np.nan_to_num(np.asarray(values, dtype=float)[valid])
+    return (
+        sp.csr_matrix((values, coords), shape=shape),
+        sp.csr_matrix((np.ones(len(values)), coords), shape=shape))
+
+
+def _entries(values, pattern):
+    # every entry of the pattern, with its value (explicit zeros included, as in a groupby sum)
+    pattern = pattern.tocoo()
+    return pattern.row, pattern.col, np.asarray(values[pattern.row, pattern.col]).ravel()
+
+
+def embed_feed(animal_trade_data, feed_eq_data, crop_shares):
+    """
+    Feed embedded in the traded animal products, as a chain of sparse products
+
+    With u = (AP producer, animal product), w = (AP producer, feed item) and
+    v = (feed producer, crop item), all per year:
+
+        S[u, v] = sum_w  Feed_per_AP[u, w] * share[w, v]
+        F[(consumer, animal product), v] = sum_u  T[(consumer, animal product), u] * S[u, v]
+        O[AP producer, v] = sum_u  (sum_consumer T)[u] * S[u, v]
+
+    where T is the animal product trade. F is the feed in the animal products
+    each consumer imports, and O is the feed each AP producer uses for them.
+    Every combination that is linked by the factors is kept, even if its sum
+    is zero, as in a groupby.
+
+    Args:
+        animal_trade_data: trade matrix rows of animal products
+        feed_eq_data: AP_Producer_Country_Code, Year, Animal_Product_Code, Item_Code, Feed_per_AP
+        crop_shares: Feed_Producer_Country_Code, Consumer_Country_Code, Year, Feed_Item_Code, CB_Item_Code, share
+
+    Returns:
+        feed_use_origin_per_country (Year, Feed_Producer_Country_Code, Producer_Country_Code, Feed_Item_Code, tons_feed_use),
+        and a generator of (consumer, feed_in_animal_products of that consumer) in consumer order, with
+        feed_in_animal_products (Year, Producer_Country_Code, Consumer_Country_Code, Item_Code, Value, Animal_Product_Code)
+        computed one consumer at a time
+    """
+
+    (feed_w, share_w), w_axis = _axis(
+        feed_eq_data[["AP_Producer_Country_Code", "Item_Code", "Year"]],
+        crop_shares[["Consumer_Country_Code", "CB_Item_Code", "Year"]])
+    (feed_u, trade_u), u_axis = _axis(
+        feed_eq_data[["AP_Producer_Country_Code", "Animal_Product_Code", "Year"]],
+        animal_trade_data[["Producer_Country_Code", "Item_Code", "Year"]])
+    (share_v,), v_axis = _axis(crop_shares[["Feed_Producer_Country_Code", "Feed_Item_Code", "Year"]])
+    (trade_r,), r_axis = _axis(animal_trade_data[["Consumer_Country_Code", "Item_Code", "Year"]])
+    (u_origin,), origin_axis = _axis(u_axis[["AP_Producer_Country_Code", "Year"]])
+
+    feed_per_ap, feed_per_ap_pattern = _sparse(feed_u, feed_w, feed_eq_data["Feed_per_AP"], (len(u_axis), len(w_axis)))
+    shares, shares_pattern = _sparse(share_w, share_v, crop_shares["share"], (len(w_axis), len(v_axis)))
+    trade, trade_pattern = _sparse(trade_r, trade_u, animal_trade_data["Value"], (len(r_axis), len(u_axis)))
+    to_origin = sp.csr_matrix((np.ones(len(u_axis)), (u_origin, np.arange(len(u_axis)))), shape=(len(origin_axis), len(u_axis)))
+
+    feed_per_u = feed_per_ap @ shares
+    feed_per_u_pattern = feed_per_ap_pattern @ shares_pattern
+
+    traded = np.asarray(trade.sum(axis=0)).ravel()
+    traded_pattern = np.asarray(trade_pattern.sum(axis=0)).ravel()
+    rows, cols, values = _entries(
+        to_origin @ sp.diags(traded) @ feed_per_u,
+        to_origin @ sp.diags(traded_pattern) @ feed_per_u_pattern)
+    feed_use_origin_per_country = pd.DataFrame({
+        "Year": origin_axis["Year"].to_numpy()[rows],
+        "Feed_Producer_Country_Code": v_axis["Feed_Producer_Country_Code"].to_numpy(dtype=float)[cols],
+        "Producer_Country_Code": origin_axis["AP_Producer_Country_Code"].to_numpy()[rows],
+        "Feed_Item_Code": v_axis["Feed_Item_Code"].to_numpy(dtype=float)[cols],
+        "tons_feed_use": values})
+    feed_use_origin_per_country = feed_use_origin_per_country.sort_values(
+        by=["Year", "Feed_Producer_Country_Code", "Producer_Country_Code", "Feed_Item_Code"]).reset_index(drop=True)
+
+    def iter_feed_in_animal_products():
+        # the rows of r_axis are sorted by consumer, so each consumer is one block of rows of T
+        consumers = r_axis["Consumer_Country_Code"].to_numpy()
+        boundaries = np.flatnonzero(np.r_[True, consumers[1:] != consumers[:-1], True])
+        for start, stop in zip(boundaries[:-1], boundaries[1:]):
+            rows, cols, values = _entries(trade[start:stop] @ feed_per_u, trade_pattern[start:stop] @ feed_per_u_pattern)
+            rows += start
+            yield consumers[start], pd.DataFrame({
+                "Year": r_axis["Year"].to_numpy()[rows],
+                "Producer_Country_Code": v_axis["Feed_Producer_Country_Code"].to_numpy(dtype=float)[cols],
+                "Consumer_Country_Code": consumers[rows],
+                "Item_Code": v_axis["Feed_Item_Code"].to_numpy(dtype=float)[cols],
+                "Value": values,
+                "Animal_Product_Code": r_axis["Item_Code"].to_numpy()[rows]}).sort_values(
+                    by=["Year", "Producer_Country_Code", "Item_Code", "Animal_Product_Code"]).reset_index(drop=True)
+
+    return feed_use_origin_per_country, iter_feed_in_animal_products()
+
+
+def iter_feed_partitions(crop_trade_data, consumers, feed_in_animal_products, columns):
+    """
+    TradeMatrixFeed one consumer country at a time
+
+    Args:
+        crop_trade_data: crop rows of all consumers
+        consumers: consumer country codes of the animal product trade
+        feed_in_animal_products: generator of (consumer, feed rows) in consumer order, from embed_feed()
+
+    Yields:
+        (consumer, partition) in consumer order, for the consumers with any rows
+    """
+
+    crop_partitions = crop_trade_data.groupby("Consumer_Country_Code", sort=True).indices
+    feed_partition = next(feed_in_animal_products, None)
+    for consumer in sorted(set(crop_partitions) | set(consumers)):
+        frames = []
+        if consumer in crop_partitions:
+            frames.append(crop_trade_data.iloc[crop_partitions[consumer]])
+        if feed_partition is not None and feed_partition[0] == consumer:
+            frames.append(feed_partition[1])
+            feed_partition = next(feed_in_animal_products, None)
+        # animal product trade whose feed rows were dropped (e.g. a missing year) and no crop rows
+        if not frames:
+            continue
+        yield consumer, (pd.concat(frames) if len(frames) > 1 else frames[0])[columns]
+
+
+def animal_products_to_feed(prefer_import="import", conversion_opt="dry_matter", year=2013, historic="Historic", context=None,
+                            trade_matrix=None, writer=None, collect=False):
+    """
+    Break the TradeMatrix down for feed and write TradeMatrixFeed
+
+    trade_matrix optionally passes the TradeMatrix returned by calculate_trade_matrix()
+    instead of reading it from disk, and writer optionally writes the output in the
+    background, see processing/background_writer.py
+
+    The crop rows (crop trade plus the feed use of the animal product
+    producers) are built for all consumers at once, about the size of the
+    TradeMatrix. The feed embedded in the traded animal products, most of
+    TradeMatrixFeed, is computed and written one consumer at a time, so only
+    one consumer's share of it is held in memory unless collect is set, which
+    keeps all partitions for passing on to the provenance stage.
+
+    Returns:
+        dict of consumer country code -> partition of TradeMatrixFeed if collect, else None
+    """
     print("    Loading files for animal products to feed conversion...")
 
-    cb_map_filename = "input_data/CB_to_primary_items_map.csv"
-    cb_split_filename = "input_data/CB_items_split.csv" 
-    content_factors_filename = "input_data/content_factors_per_100g.xlsx"
-    cb_conversion_filename = "input_data/CB_code_FAO_code_for_conversion_factors.csv"
-    animals_filename = "input_data/Production_Crops_Livestock_E_All_Data_(Normalized).csv"
-    weighing_filename = "input_data/weighing_factors.csv"
+    if context is None:
+        context = PipelineContext()
 
     trade_matrix_filename = f"results/{year}/.mrio/TradeMatrix_{prefer_import}_{conversion_opt}.csv"
     output_filename = f"results/{year}/.mrio/TradeMatrixFeed_{prefer_import}_{conversion_opt}.csv"
 
-    if not Path(trade_matrix_filename).exists():
+    if trade_matrix is not None:
+        transformed_data = trade_matrix
+    elif not Path(trade_matrix_filename).exists():
         raise FileNotFoundError(f"Trade matrix file not found: {trade_matrix_filename}")
-    transformed_data = pd.read_csv(trade_matrix_filename, encoding="Latin-1")
-    cb_map = pd.read_csv(cb_map_filename, encoding="Latin-1")
-    cb_split = pd.read_csv(cb_split_filename, encoding="Latin-1")
-    content_factors = pd.read_excel(content_factors_filename, skiprows=1)
-    cb_conversion_map = pd.read_csv(cb_conversion_filename, encoding="Latin-1")
-    production_animals = pd.read_csv(animals_filename, encoding="Latin-1", low_memory=False)
-    weighing_factors = pd.read_csv(weighing_filename, encoding="Latin-1")
-    units = pd.read_excel(content_factors_filename, header=None, nrows=1)
-    units.columns = content_factors.columns
+    else:
+        transformed_data = pd.read_csv(trade_matrix_filename, encoding="Latin-1")
+    cb_map = context.table("cb_map")
+    cb_split = context.table("cb_split")
+    content_factors = context.table("content_factors")
+    cb_conversion_map = context.table("cb_conversion_map")
+    production_animals = context.faostat("production", years=[year], elements=[5510], columns=[
+        "Area Code", "Item Code", "Element Code", "Year", "Value"])
+    weighing_factors = context.table("weighing_factors")
 
 
     content_factors.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
@@ -79,9 +269,6 @@ def animal_products_to_feed(prefer_import="import", conversion_opt="dry_matter",
     weighing_factors.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
 
 
-    production_animals = production_animals[(production_animals["Year"] == year) &
-        (production_animals["Element_Code"] == 5510)]
-
     
     content_factors_cb = cb_conversion_map.merge(content_factors, 
         left_on="FAO_code",
@@ -113,27 +300,18 @@ def animal_products_to_feed(prefer_import="import", conversion_opt="dry_matter",
     ################################
     # NEW METHOD
     if historic == "Historic":
-        cb_crops_filename=f"input_data/FoodBalanceSheetsHistoric_E_All_Data_(Normalized).csv"
-        cb_crops_data = pd.read_csv(cb_crops_filename, encoding="Latin-1")
+        cb_crops_data = context.faostat("fbs_historic", years=[year], elements=[5521])
         cb_crops_data.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-        cb_crops_data = cb_crops_data[(cb_crops_data["Year"] == year) &
-            (cb_crops_data["Element_Code"] == 5521)]
         cb_crops_data["Value"] = cb_crops_data["Value"]*1000
         cb_crops_data["Unit"] = "t"
-        cb_crops_filename2=f"input_data/CommodityBalances_(non-food)_(-2013_old_methodology)_E_All_Data_(Normalized).csv"
-        cb_crops_data2 = pd.read_csv(cb_crops_filename2, encoding="Latin-1")
+        cb_crops_data2 = context.faostat("commodity_balances", years=[year], elements=[5520])
         cb_crops_data2.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-        cb_crops_data2 = cb_crops_data2[(cb_crops_data2["Year"] == year) &
-            (cb_crops_data2["Element_Code"] == 5520)]
         cb_crops_data = pd.concat([cb_crops_data, cb_crops_data2], ignore_index=True)
         del(cb_crops_data2)
 
     else:
-        cb_crops_filename=f"input_data/FoodBalanceSheets_E_All_Data_(Normalized).csv"
-        cb_crops_data = pd.read_csv(cb_crops_filename, encoding="Latin-1")
+        cb_crops_data = context.faostat("fbs", years=[year], elements=[5521])
         cb_crops_data.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-        cb_crops_data = cb_crops_data[(cb_crops_data["Year"] == year) &
-            (cb_crops_data["Element_Code"] == 5521)]
         cb_crops_data["Value"] = cb_crops_data["Value"]*1000  
 
         # remove extra data to just leave crops
@@ -146,11 +324,8 @@ def animal_products_to_feed(prefer_import="import", conversion_opt="dry_matter",
         cb_crops_data = cb_crops_data.drop(columns=["FAO_code", "CB_code", "Note"])
 
         # add missing data that is no longer reported as food
-        cb_crops_filename2=f"input_data/SUA_Crops_Livestock_E_All_Data_(Normalized).csv"
-        cb_crops_data2 = pd.read_csv(cb_crops_filename2, encoding="Latin-1", low_memory=False)
+        cb_crops_data2 = context.faostat("sua", years=[year], elements=[5520])
         cb_crops_data2.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-        cb_crops_data2 = cb_crops_data2[(cb_crops_data2["Year"] == year) &
-            (cb_crops_data2["Element_Code"] == 5520)]
         
         missing_item_codes = [17, 767, 329, 332, 780, 335, 291, 269, 826, 634, 253, 821, 256, 259, 272, 270, 836, 789, 771, 238, 782, 809]
         cb_crops_data2 = cb_crops_data2[cb_crops_data2["Item_Code"].isin(missing_item_codes)]
@@ -192,13 +367,8 @@ def animal_products_to_feed(prefer_import="import", conversion_opt="dry_matter",
         )
 
     unique_combinations = transformed_data[["Producer_Country_Code", "Year"]].drop_duplicates()
-    unique_combinations = unique_combinations.sort_values(by=["Year", "Producer_Country_Code"])
 
-    feed_eq_data = []
-    for country, yr in unique_combinations.itertuples(index=False):
-        feed_eq_data += ml_animal_prod(yr, country, production_animals, feed_data, weighing_factors)
-
-    feed_eq_data = pd.DataFrame(feed_eq_data, columns=["Producer_Country_Code", "Year", "Animal_Product_Code", "Item_Code", "Value"])
+    feed_eq_data = ml_animal_prod(unique_combinations, production_animals, feed_data, weighing_factors)
     feed_eq_data.rename(columns={"Producer_Country_Code": "AP_Producer_Country_Code", "Value": "Feed_per_AP"}, inplace=True)
 
 
@@ -215,66 +385,11 @@ def animal_products_to_feed(prefer_import="import", conversion_opt="dry_matter",
 
     crop_shares.loc[crop_shares["Value"]==0, "share"]=0
 
-    share_per_country = feed_eq_data.merge(crop_shares, left_on=["AP_Producer_Country_Code", "Year", "Item_Code"], right_on=["Consumer_Country_Code", "Year", "CB_Item_Code"], how="left")
-    share_per_country["feed_share"] = share_per_country["Feed_per_AP"] * share_per_country["share"]
-
-    share_per_country = share_per_country[["AP_Producer_Country_Code", "Year", "Animal_Product_Code", "Feed_Producer_Country_Code", "Feed_Item_Code", "feed_share"]]
-
     animal_trade_data = transformed_data[transformed_data["Item_Code"] > 850]
 
-
     print("    Computing animal feed...")
-    # Process merge in chunks by item
-    results = []    
-    for prod in animal_trade_data["Item_Code"].unique():
-        animal_chunk = animal_trade_data[animal_trade_data["Item_Code"] == prod]
-        share_chunk = share_per_country[share_per_country["Animal_Product_Code"] == prod]
-        
-        merged_chunk = animal_chunk.merge(
-            share_chunk,
-            left_on=["Year", "Item_Code", "Producer_Country_Code"],
-            right_on=["Year", "Animal_Product_Code", "AP_Producer_Country_Code"],
-            how="inner"
-        ).drop(columns=["AP_Producer_Country_Code", "Animal_Product_Code"])
-        
-        results.append(merged_chunk)
-        del(merged_chunk)
-
-    animal_product_data_full = pd.concat(results, ignore_index=True)
-    print("    Calculating feed use...")
-    animal_product_data_full["tons_feed_use"] = animal_product_data_full["feed_share"] * animal_product_data_full["Value"]
-    
-    agg = [] # chunk for memory efficiency
-    for cc in  animal_product_data_full["Consumer_Country_Code"].unique():
-        subset = animal_product_data_full[animal_product_data_full["Consumer_Country_Code"] == cc]
-        subset_feed = (subset
-        .groupby(["Year", "Feed_Producer_Country_Code", "Consumer_Country_Code", "Feed_Item_Code", "Item_Code"])
-        .agg({"tons_feed_use": "sum"})
-        .reset_index()
-        .rename(columns={
-            "Feed_Producer_Country_Code": "Producer_Country_Code",
-            "tons_feed_use": "Value",
-            "Item_Code": "Animal_Product_Code",
-            "Feed_Item_Code": "Item_Code",
-        })
-        .reindex(columns=["Year", "Producer_Country_Code", "Consumer_Country_Code", "Item_Code", "Value", "Animal_Product_Code"]))
-        agg.append(subset_feed)
-    
-    feed_in_animal_products = pd.concat(agg, ignore_index=True)
-
-
-    agg = [] # chunk for memory efficiency
-    for cc in  animal_product_data_full["Feed_Producer_Country_Code"].unique():
-        subset = animal_product_data_full[animal_product_data_full["Feed_Producer_Country_Code"] == cc]
-        subset_feed = (subset
-            .groupby(["Year", "Feed_Producer_Country_Code", "Producer_Country_Code", "Feed_Item_Code", "Item_Code"])
-            .agg({"tons_feed_use": "sum"})
-            .reset_index())
-        agg.append(subset_feed)
-    feed_use_origin_per_country = pd.concat(agg, ignore_index=True)
+    feed_use_origin_per_country, feed_in_animal_products = embed_feed(animal_trade_data, feed_eq_data, crop_shares)
 
-
-    feed_use_origin_per_country.drop(columns=["Item_Code"], inplace=True)
     feed_use_origin_per_country["tons_feed_use"] = feed_use_origin_per_country["tons_feed_use"] * -1
 
     feed_use_origin_per_country.rename(columns={
@@ -289,12 +404,24 @@ def animal_products_to_feed(prefer_import="import", conversion_opt="dry_matter",
     crop_trade_data = crop_trade_data.groupby(["Year", "Producer_Country_Code", "Consumer_Country_Code", "Item_Code"], as_index=False)["Value"].sum()
     crop_trade_data["Animal_Product_Code"] = np.nan
 
-    output_data = pd.concat([crop_trade_data, feed_in_animal_products])
+    # one partition per consumer country, written as soon as its feed rows are computed
     print("    Saving feed results...")
-    if __name__ == "__main__":
-        output_data.to_csv(f"{output_filename[:-4]}_temp.csv", index=False)
-
-    output_data.to_csv(output_filename, index=False)
+    columns = ["Year", "Producer_Country_Code", "Consumer_Country_Code", "Item_Code", "Value", "Animal_Product_Code"]
+    submit = writer.submit if writer is not None else run_now
+    partitions = {} if collect else None
+    partitioned_writer = PartitionedCsvWriter(output_filename, "Consumer_Country_Code", columns)
+    try:
+        for consumer, partition in iter_feed_partitions(
+                crop_trade_data, animal_trade_data["Consumer_Country_Code"].dropna(), feed_in_animal_products, columns):
+            submit(partitioned_writer.write, int(consumer), partition)
+            if collect:
+                partitions[int(consumer)] = partition
+    except BaseException:
+        submit(partitioned_writer.abort)
+        raise
+    submit(partitioned_writer.close)
+
+    return partitions
 
 if __name__ == "__main__":
     import os
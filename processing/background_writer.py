@@ -0,0 +1,69 @@
+"""
+Asynchronous writes of the pipeline's intermediate results.
+
+The stages of one year hand their results to the next stage in memory;
+writing them to results/{year}/.mrio is only needed for later runs and for
+inspection. BackgroundWriter runs these writes on a single background thread,
+in the order they were submitted, so the next stage starts while the previous
+one's output is still being written. Every file is written under a temporary
+name and renamed when complete, so a reader never sees a partial file.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+def write_csv(data, filename, **kwargs):
+    """Write data to filename via a temporary file, replacing filename once complete"""
+    filename = Path(filename)
+    tmp_file = filename.with_name(f"{filename.name}.{os.getpid()}.tmp")
+    try:
+        data.to_csv(tmp_file, **kwargs)
+        os.replace(tmp_file, filename)
+    except BaseException:
+        tmp_file.unlink(missing_ok=True)
+        raise
+
+
+class BackgroundWriter:
+    """
+    Run write jobs on a background thread, in submission order
+
+    Errors of a job are raised by the next wait() or close().
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="writer")
+        self._pending = []
+
+    def submit(self, function, *args, **kwargs):
+        """Queue function(*args, **kwargs); the arguments must not be modified afterwards"""
+        self._pending.append(self._executor.submit(function, *args, **kwargs))
+
+    def to_csv(self, data, filename, **kwargs):
+        """Queue writing a DataFrame to filename"""
+        self.submit(write_csv, data, filename, **kwargs)
+
+    def wait(self):
+        """Block until every queued job has finished"""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def run_now(function, *args, **kwargs):
+    """Synchronous stand-in for BackgroundWriter.submit()"""
+    function(*args, **kwargs)
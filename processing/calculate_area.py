@@ -10,22 +10,25 @@ Re-written in Python, October 2025 by Louis De Neve
 
 import pandas as pd
 import numpy as np
-from pathlib import Path
 
-def calculate_area(prefer_import="import", conversion_opt="dry_matter", year=2013):
+from processing.partitioned_csv import iter_partitions, table_exists
+from processing.pipeline_context import PipelineContext
+
+def calculate_area(prefer_import="import", conversion_opt="dry_matter", year=2013, context=None):
     
     print("    Loading area data...")
+    if context is None:
+        context = PipelineContext()
         # File paths
-    yield_data_file = "input_data/Production_Crops_Livestock_E_All_Data_(Normalized).csv"
     trade_matrix_file = f"results/{year}/.mrio/TradeMatrixFeed_{prefer_import}_{conversion_opt}.csv"
     
     # Check if trade matrix file exists
-    if not Path(trade_matrix_file).exists():
+    if not table_exists(trade_matrix_file):
         raise FileNotFoundError(f"Trade matrix file not found: {trade_matrix_file}")
     
     # Load data
-    trade_data = pd.read_csv(trade_matrix_file, encoding="Latin-1")
-    yield_data = pd.read_csv(yield_data_file, encoding="Latin-1", low_memory=False)
+    yield_data = context.faostat("production", years=[year], columns=[
+        "Area Code", "Item Code", "Element", "Year", "Unit", "Value"])
     
     # Clean column names
     yield_data.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
@@ -40,30 +43,31 @@ def calculate_area(prefer_import="import", conversion_opt="dry_matter", year=201
         "Value": "Yield"})
     
     print("    Calculating areas...")
-    
-    # Merge trade data with yield data
-    area_data = trade_data.merge(
-        yield_data[["Producer_Country_Code", "Year", "Item_Code", "Yield"]], 
-        on=["Producer_Country_Code", "Year", "Item_Code"], 
-        how="left")
-    
-
-    # Calculate area (Value * 10000 / Yield)
-    # Value is in tonnes so Value *1,000 gives kg then dividing by Yield (kg/ha) gives area in ha
-    area_data["Area"] = (area_data["Value"].astype(float) * 1000) / area_data["Yield"]
-    
-    # Select output columns
-    output_data = area_data[[
-        "Consumer_Country_Code", 
-        "Producer_Country_Code", 
-        "Item_Code", 
-        "Animal_Product_Code", 
-        "Year", 
-        "Value", 
-        "Area"]]
-    
-    
-    print("    Saving final results...")
     output_filename = f"results/{year}/.mrio/TradeMatrixFeed_{prefer_import}_{conversion_opt}_{year}_Area.csv"
-    output_data.to_csv(output_filename, index=False)
 
+    # one consumer partition of the trade matrix at a time, appended to the output
+    for n, (_, trade_data) in enumerate(iter_partitions(trade_matrix_file, encoding="Latin-1")):
+        # Merge trade data with yield data
+        area_data = trade_data.merge(
+            yield_data[["Producer_Country_Code", "Year", "Item_Code", "Yield"]], 
+            on=["Producer_Country_Code", "Year", "Item_Code"], 
+            how="left")
+        
+
+        # Calculate area (Value * 10000 / Yield)
+        # Value is in tonnes so Value *1,000 gives kg then dividing by Yield (kg/ha) gives area in ha
+        area_data["Area"] = (area_data["Value"].astype(float) * 1000) / area_data["Yield"]
+        
+        # Select output columns
+        output_data = area_data[[
+            "Consumer_Country_Code", 
+            "Producer_Country_Code", 
+            "Item_Code", 
+            "Animal_Product_Code", 
+            "Year", 
+            "Value", 
+            "Area"]]
+        
+        output_data.to_csv(output_filename, index=False, mode="w" if n == 0 else "a", header=n == 0)
+
+    print("    Saved final results.")
@@ -11,102 +11,334 @@ Re-written in Python, October 2025 by Louis De Neve
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
-from numba import jit
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
+from pathlib import Path
+
+from processing.mrio_cache import system_key
+from processing.mrio_solver import dense_r_bar_batch, ensemble_memory, ensemble_r_bar, solve_mrio
+from processing.pipeline_context import PipelineContext
 warnings.filterwarnings("ignore", category=FutureWarning)
 np.seterr(divide="ignore")
 
-def eliminate_dates(reporting_dates:pd.DataFrame, function_dataframe:pd.DataFrame) -> pd.DataFrame:
+def reporting_windows(reporting_dates:pd.DataFrame) -> pd.DataFrame:
+    """
+    Per-country window [Start_Year, End_Year] of correctly reported trade data
+    Countries listed more than once keep the narrowest window; NaN means unbounded
+    """
+
+    reporting_dates = reporting_dates.rename(columns=lambda x: x.replace(" ", "_"))
+    return reporting_dates.groupby("Country_Code").agg(
+        Start_Year=("Start_Year", "max"),
+        End_Year=("End_Year", "min"))
+
+def eliminate_dates(reporting_windows:pd.DataFrame, function_dataframe:pd.DataFrame) -> pd.DataFrame:
     # removes countries that were not correctly reported
-    
-    reporting_dates_start = reporting_dates[["Country_Code", "Start_Year"]].dropna()
-    reporting_dates_end = reporting_dates[["Country_Code", "End_Year"]].dropna()
 
-    for country, year in reporting_dates_start.values:
-        function_dataframe.loc[(function_dataframe["Reporter_Country_Code"] == country) & (function_dataframe["Year"] < year), "Value"] = 0
-    for country, year in reporting_dates_end.values:
-        function_dataframe.loc[(function_dataframe["Reporter_Country_Code"] == country) & (function_dataframe["Year"] > year), "Value"] = 0
+    start_year = function_dataframe["Reporter_Country_Code"].map(reporting_windows["Start_Year"])
+    end_year = function_dataframe["Reporter_Country_Code"].map(reporting_windows["End_Year"])
+    outside = (function_dataframe["Year"] < start_year) | (function_dataframe["Year"] > end_year)
+    function_dataframe.loc[outside.to_numpy(), "Value"] = 0
 
     return function_dataframe
 
-@jit(nopython=True)
-def calculate_mrio_matrices(Z, p):
-    """JIT-compiled version of matrix calculations"""
-    summation_vector = np.ones(len(p))
-    x = p + Z @ summation_vector
-    
-    one_over_x = np.where(x != 0, 1.0/x, 0.0)
-    A = Z @ np.diag(one_over_x)
-    
-    I = np.eye(len(p))
-    R = np.linalg.pinv(I - A) @ np.diag(p) # note pseudo-inverse rather than inverse (inverse creates some extra)
-    
-    ac = x - Z.sum(axis=0)
-    c = ac * one_over_x
-    R_bar = np.diag(c) @ R
-    
-    return R_bar
+def build_item_systems(primary_data, production_all):
+    """
+    Split trade and production into one compact MRIO system per (Year, primary_item)
+
+    Both tables are grouped once and the country codes are factorized once for
+    all items, so assembling an item's system only touches that item's rows.
+
+    Args:
+        primary_data: DataFrame with trade data in primary equivalents
+        production_all: DataFrame with production data, or a dict of value column
+            of primary_data -> production data to build the systems of several
+            conversion options on the same countries and sparse structure
 
+    Returns:
+        list of (year, item_code, countries, rows, cols, values, p) where countries
+        are the sorted country codes of the item, rows/cols/values the coordinates
+        (consumer, producer) and values of the nonzero entries of Z and p the
+        production vector. With a dict of production data, values and p have one
+        column per entry of the dict.
+    """
+
+    if isinstance(production_all, dict):
+        value_columns = list(production_all)
+        productions = list(production_all.values())
+    else:
+        value_columns = "Value_Sum"
+        productions = [production_all]
+
+    n_trade = len(primary_data)
+    all_codes = np.concatenate([
+        primary_data["Consumer_Country_Code"].to_numpy(),
+        primary_data["Producer_Country_Code"].to_numpy()] + [
+        production["Area_Code"].to_numpy() for production in productions])
+    country_codes, country_ids = np.unique(all_codes, return_inverse=True)
+    consumer_ids = country_ids[:n_trade]
+    producer_ids = country_ids[n_trade:2 * n_trade]
+    area_ids = np.split(country_ids[2 * n_trade:], np.cumsum([len(production) for production in productions])[:-1])
+
+    trade_values = np.nan_to_num(primary_data[value_columns].to_numpy(dtype=float)) # denoted Z in Kastner 2011
+    production_values = [np.nan_to_num(production["Value"].to_numpy(dtype=float)) for production in productions] # denoted p in Kastner 2011
+
+    trade_groups = primary_data.groupby(["Year", "primary_item"], sort=True).indices
+    production_groups = [production.groupby(["Year", "Item_Code"]).indices for production in productions]
+    no_production = np.array([], dtype=int)
+
+    systems = []
+    for (year, item_code), trade_idx in trade_groups.items():
+        production_idx = [groups.get((year, item_code), no_production) for groups in production_groups]
 
-def mrio_model(item_code, year, p_data, prod_data):
+        local_ids = np.unique(np.concatenate([
+            consumer_ids[trade_idx], producer_ids[trade_idx]] + [
+            ids[idx] for ids, idx in zip(area_ids, production_idx)]))
+        rows = np.searchsorted(local_ids, consumer_ids[trade_idx])
+        cols = np.searchsorted(local_ids, producer_ids[trade_idx])
+
+        p = np.zeros((len(local_ids), len(productions)))
+        for k, (ids, idx) in enumerate(zip(area_ids, production_idx)):
+            p[np.searchsorted(local_ids, ids[idx]), k] = production_values[k][idx]
+        if not isinstance(production_all, dict):
+            p = p[:, 0]
+
+        systems.append((year, item_code, country_codes[local_ids], rows, cols, trade_values[trade_idx], p))
+
+    return systems
+
+
+def mrio_model(countries, rows, cols, values, p, solver="sparse", consumers=None, producers=None):
     """
     Perform matrix operations for MRIO calculation
     Equivalent to matrix.operation function in R
     
     Args:
-        item_code: Primary item code to process
-        year: Year to process
-        primary_data: DataFrame with trade data in primary equivalents
-        production_all: DataFrame with production data
+        countries: country codes indexing Z and p
+        rows: consumer index of each nonzero entry of Z
+        cols: producer index of each nonzero entry of Z
+        values: value of each nonzero entry of Z
+        p: production per country
+        solver: solver backend, see mrio_solver.SOLVERS
+        consumers, producers: optional indices of the only rows and columns of R_bar to solve for
     
     Returns:
-        DataFrame with Consumer_Country_Code, Producer_Country_Code, Value, Item_Code, Year
+        (Consumer_Country_Code, Producer_Country_Code, Value) arrays of the nonzero entries of R_bar,
+        and the solver path that produced them
+    """
+
+    R_bar, path = solve_mrio(rows, cols, values, p, solver=solver, consumers=consumers, producers=producers)
+
+    R_bar = np.round(R_bar, 2)
+    i_indices, j_indices = np.nonzero(R_bar)
+
+    return countries[i_indices], countries[j_indices], R_bar[i_indices, j_indices], path
+
+
+def _solve_item_system(task):
+    countries, rows, cols, values, p, solver, consumers, producers = task
+    return mrio_model(countries, rows, cols, values, p, solver=solver, consumers=consumers, producers=producers)
+
+
+def _solve_dense_batch(tasks, n_workers):
+    # full dense solves of many items in one compiled kernel, one item per thread
+    solutions = dense_r_bar_batch([(rows, cols, values, p) for _, rows, cols, values, p, *_ in tasks], n_threads=n_workers)
+    for (countries, *_), (i_indices, j_indices, values) in zip(tasks, solutions):
+        yield countries[i_indices], countries[j_indices], values, "pinv"
+
+
+def _with_cached_solutions(tasks, keys, cached, solved, mrio_cache):
+    # merge cached solutions and newly solved ones back into the order of tasks
+    for task, key, result in zip(tasks, keys, cached):
+        if result is None:
+            result = next(solved)
+            if mrio_cache is not None:
+                mrio_cache.put(key, result)
+        yield result
+
+
+def iter_item_solutions(item_systems, solver="sparse", n_workers=1, mrio_cache=None, consumer_rows=None, producer_cols=None):
     """
+    Solve the MRIO system of every item, optionally in a pool of worker processes
+
+    Only the compact (countries, rows, cols, values, p) arrays are sent to the
+    workers and only the nonzero R_bar entries come back. Results are yielded
+    in the order of item_systems, so the output does not depend on n_workers.
+    With an MrioCache, systems that were solved before are read from disk and
+    only the others are solved. consumer_rows and producer_cols optionally
+    give, per system, the indices of the only rows and columns of R_bar to
+    solve for (all if both are None). Full solves with the dense solver run
+    in one batched kernel in n_workers threads instead of worker processes.
+    """
+
+    if consumer_rows is None:
+        consumer_rows = [None] * len(item_systems)
+    if producer_cols is None:
+        producer_cols = [None] * len(item_systems)
+    tasks = [
+        (countries, rows, cols, values, p, solver, consumers, producers)
+        for (_, _, countries, rows, cols, values, p), consumers, producers in zip(item_systems, consumer_rows, producer_cols)]
+    progress = {"total": len(tasks), "desc": "    Processing MRIO models", "leave": True, "position": 0}
+
+    if mrio_cache is not None:
+        keys = [system_key(*task) for task in tasks]
+        cached = [mrio_cache.get(key) for key in keys]
+    else:
+        keys = cached = [None] * len(tasks)
+    misses = [task for task, result in zip(tasks, cached) if result is None]
+
+    if solver == "dense" and all(task[6] is None and task[7] is None for task in misses):
+        solved = _solve_dense_batch(misses, n_workers)
+        yield from tqdm(_with_cached_solutions(tasks, keys, cached, solved, mrio_cache), **progress)
+    elif n_workers <= 1 or not misses:
+        solved = map(_solve_item_system, misses)
+        yield from tqdm(_with_cached_solutions(tasks, keys, cached, solved, mrio_cache), **progress)
+    else:
+        chunksize = max(1, len(misses) // (4 * n_workers))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            solved = executor.map(_solve_item_system, misses, chunksize=chunksize)
+            yield from tqdm(_with_cached_solutions(tasks, keys, cached, solved, mrio_cache), **progress)
 
-    data_subset = p_data[(p_data["Year"] == year) & (p_data["primary_item"] == item_code)]
-    production_data_subset = prod_data[(prod_data["Year"] == year) & (prod_data["Item_Code"] == item_code)]
+    if mrio_cache is not None:
+        mrio_cache.evict()
+        print(f"    MRIO cache: {mrio_cache.summary()}")
 
-    production_data_subset.loc[production_data_subset["Value"].isna(), "Value"] = 0
 
-    producers = production_data_subset["Area_Code"].unique()
-    importers = data_subset["Consumer_Country_Code"].unique()
-    exporters = data_subset["Producer_Country_Code"].unique()
+def solve_item_systems(item_systems, solver="sparse", n_workers=1, mrio_cache=None, consumer_rows=None, producer_cols=None):
+    """List of the solutions of iter_item_solutions()"""
+    return list(iter_item_solutions(
+        item_systems, solver=solver, n_workers=n_workers, mrio_cache=mrio_cache,
+        consumer_rows=consumer_rows, producer_cols=producer_cols))
 
-    traders = np.union1d(importers, exporters)
-    countries = np.union1d(producers, traders)
 
-    country_dict = {code: idx for idx, code in enumerate(countries)}
+def solve_consumer_rows(item_systems, consumers, solver="sparse", n_workers=1, mrio_cache=None):
+    """
+    Solve only the R_bar rows that the provenance of the given consumer countries needs
+
+    Every item is solved for the rows of the consumers, by transposed solves.
+    The feed provenance of the consumers follows their animal product imports
+    back to the countries of origin and from there to the feed those countries
+    import, so animal products are also solved for the rows of the countries of
+    origin, and crops for the rows of the countries these import animal products
+    from. The feed conversion subtracts the feed a country uses for its animal
+    product exports, so animal products are also solved for the consumers'
+    columns. The sugar aggregate (2545) is solved in full, as its split into
+    sugar crops uses every consumer's total.
 
-    Z = np.zeros((len(countries), len(countries)))
+    Args:
+        item_systems: systems from build_item_systems()
+        consumers: FAOSTAT codes of the consumer countries
 
-    for _, row in data_subset.iterrows():
-        i = country_dict[row["Consumer_Country_Code"]]
-        j = country_dict[row["Producer_Country_Code"]]
-        Z[i, j] = row["Value_Sum"] # denoted Z in Kastner 2011
+    Returns:
+        list of solutions in the order of item_systems, as from solve_item_systems()
+    """
 
-    Z[np.isnan(Z)] = 0
+    def rows_of(countries, codes):
+        return np.flatnonzero(np.isin(countries, codes))
+
+    def is_animal(item_code):
+        return item_code > 850 and item_code != 2545
+
+    def origins_of(solved, codes):
+        # per year, the countries the given consumers import animal products from
+        origins = {}
+        for (year, *_), (consumer_codes, producer_codes, _, _) in solved:
+            origins.setdefault(year, set()).update(producer_codes[np.isin(consumer_codes, codes)].tolist())
+        return origins
+
+    def solve(indices, consumer_rows, producer_cols):
+        # skip the systems with no rows or columns left to solve for
+        needed = [
+            (i, rows, cols) for i, rows, cols in zip(indices, consumer_rows, producer_cols)
+            if rows is None or len(rows) > 0 or cols is not None]
+        if not needed:
+            return
+        indices, consumer_rows, producer_cols = map(list, zip(*needed))
+        systems = [item_systems[i] for i in indices]
+        for i, cols, result in zip(indices, producer_cols, solve_item_systems(
+                systems, solver, n_workers, mrio_cache, consumer_rows, producer_cols)):
+            if results[i] is None:
+                results[i] = result
+            else:
+                # the rows of a later pass are disjoint from the earlier rows, but
+                # not from the earlier columns, whose entries are already known
+                new = ~np.isin(result[1], solved_columns.get(i, []))
+                results[i] = tuple(
+                    np.concatenate([a, b[new]]) for a, b in zip(results[i][:3], result[:3])) + (results[i][3],)
+            if cols is not None:
+                solved_columns[i] = item_systems[i][2][cols]
+
+    results = [None] * len(item_systems)
+    solved_columns = {}
+    animals = [i for i, (_, item_code, *_) in enumerate(item_systems) if is_animal(item_code)]
+    others = [i for i, (_, item_code, *_) in enumerate(item_systems) if not is_animal(item_code)]
+
+    consumer_rows = {i: rows_of(item_systems[i][2], consumers) for i in animals}
+    solve(animals, [consumer_rows[i] for i in animals], [consumer_rows[i] for i in animals])
+
+    origins = origins_of([(item_systems[i], results[i]) for i in animals], consumers)
+    origin_rows = {
+        i: np.setdiff1d(rows_of(item_systems[i][2], list(origins.get(item_systems[i][0], ()))), consumer_rows[i])
+        for i in animals}
+    solve(animals, [origin_rows[i] for i in animals], [None] * len(animals))
+
+    # crop shares are needed for the origins of the animal products of the consumers and their countries of origin
+    feed_origins = origins_of(
+        [(item_systems[i], results[i]) for i in animals],
+        list(consumers) + [code for codes in origins.values() for code in codes])
+    solve(others, [
+        None if item_systems[i][1] == 2545 else
+        rows_of(item_systems[i][2], list(consumers) + list(feed_origins.get(item_systems[i][0], ())))
+        for i in others], [None] * len(others))
+    return results
+
+
+def _ensemble_item_system(task):
+    year, item_code, countries, rows, cols, values, p, options = task
+    options = dict(options)
+    # seeded per item, so the draws do not depend on the number of workers
+    rng = np.random.default_rng([options.pop("seed"), int(year), int(item_code)])
+    producers, mean, quantile_values = ensemble_r_bar(rows, cols, values, p, rng=rng, **options)
+
+    mean = np.round(mean, 2)
+    quantile_values = np.round(quantile_values, 2)
+    i_indices, j_indices = np.nonzero((mean != 0) | (quantile_values != 0).any(axis=0))
+
+    return (countries[i_indices], countries[producers[j_indices]],
+            mean[i_indices, j_indices], quantile_values[:, i_indices, j_indices])
+
+
+def iter_item_ensembles(item_systems, n_workers=1, memory_budget_gb=None, **options):
+    """
+    Monte-Carlo ensemble of the MRIO system of every item, see mrio_solver.ensemble_r_bar()
 
-    p = np.zeros((len(countries),)) 
-    for _, row in production_data_subset.iterrows():
-        i = country_dict[row["Area_Code"]]
-        p[i] = row["Value"] # denoted p in Kastner 2011
+    With memory_budget_gb, only as many workers run as the largest item's
+    ensemble (see mrio_solver.ensemble_memory()) fits into the budget, and
+    at least one.
 
-    R_bar = calculate_mrio_matrices(Z, p)
+    Yields:
+        (consumers, producers, mean, quantile values) of the nonzero entries, in the order of item_systems
+    """
 
-    R_bar = np.round(R_bar, 2)
-    nonzero_mask = R_bar != 0
-    i_indices, j_indices = np.where(nonzero_mask)
+    tasks = [system + (options,) for system in item_systems]
+    progress = {"total": len(tasks), "desc": "    Processing MRIO ensembles", "leave": True, "position": 0}
 
-    if len(i_indices) == 0:
-        return []
-    
-    return [{
-        "Consumer_Country_Code": countries[i],
-        "Producer_Country_Code": countries[j], 
-        "Value_Sum": R_bar[i, j],
-        "primary_item": item_code,
-        "Year": year
-    } for i, j in zip(i_indices, j_indices)]
+    if memory_budget_gb is not None and n_workers > 1 and tasks:
+        item_memory = max(
+            ensemble_memory(len(p), np.count_nonzero(p), options.get("n_draws", 1000))
+            for *_, p in item_systems)
+        max_workers = max(1, int(memory_budget_gb * 1024**3 // item_memory))
+        if max_workers < n_workers:
+            print(f"    {max_workers} ensemble workers fit into {memory_budget_gb} GB ({item_memory / 1024**3:.2f} GB per item)")
+            n_workers = max_workers
+
+    if n_workers <= 1:
+        yield from (_ensemble_item_system(task) for task in tqdm(tasks, **progress))
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        yield from tqdm(executor.map(_ensemble_item_system, tasks), **progress)
 
 
 def calculate_conversion_factors(conversion_opt, content_factors, item_map):
@@ -137,75 +369,61 @@ def calculate_conversion_factors(conversion_opt, content_factors, item_map):
         return conversion_factors
 
 
-def calculate_trade_matrix(
-        conversion_opt="dry_matter",
-        prefer_import="import",
-        year=2013,
-        historic="Historic"):
-    """Calculate Trade Matrix module for MRIO pipeline"""
-
-    output_filename = f"results/{year}/.mrio/TradeMatrix_{prefer_import}_{conversion_opt}.csv"
-
-    print("    Loading trade data...")
-
-    # File paths
-    item_map_filename = "input_data/primary_item_map_feed.csv" 
-    trade_filename = "input_data/Trade_DetailedTradeMatrix_E_All_Data_(Normalized).csv" # FAOSTAT import
-    reporting_filename = "input_data/Reporting_Dates.xls"
-    content_filename = "input_data/content_factors_per_100g.xlsx"
-    production_filename = "input_data/Production_Crops_Livestock_E_All_Data_(Normalized).csv"
-    sugar_processing_filename = f"input_data/FoodBalanceSheets{historic}_E_All_Data_(Normalized).csv"
+def load_trade_inputs(years, historic_years, context):
+    """
+    Load the FAOSTAT and reference data needed for the trade matrices of several years
 
+    Args:
+        years: years to load
+        historic_years: years whose sugar processing comes from the historic food balance sheets
+        context: PipelineContext serving the data
 
-    # Load Files
-    item_map = pd.read_csv(item_map_filename, encoding="Latin-1")
-    raw_trade_data = pd.read_csv(trade_filename, encoding="Latin-1")
-    reporting_date = pd.read_excel(reporting_filename)
-    content_factors = pd.read_excel(content_filename, skiprows=1)
-    sugar_processing = pd.read_csv(sugar_processing_filename, encoding="Latin-1")                                
-    production = pd.read_csv(production_filename, low_memory=False)
+    Returns:
+        dict of DataFrames with the column names' spaces replaced by underscores
+    """
 
+    sugar_processing = []
+    for year in years:
+        sugar_processing_dataset = "fbs_historic" if year in historic_years else "fbs"
+        sugar_processing.append(context.faostat(sugar_processing_dataset, years=[year], elements=[5131], columns=[
+            "Area Code", "Item Code", "Element Code", "Year", "Value"]))
+
+    inputs = {
+        "item_map": context.table("item_map"),
+        "raw_trade_data": context.faostat("trade", years=years, elements=[5610, 5910], columns=[
+            "Reporter Country Code", "Partner Country Code", "Item Code", "Element Code", "Year", "Value"]),
+        "content_factors": context.table("content_factors"),
+        "sugar_processing": pd.concat(sugar_processing, ignore_index=True),
+        "production": context.faostat("production", years=years, elements=[5510], columns=[
+            "Area Code", "Area", "Item Code", "Item", "Element Code", "Element", "Year Code", "Year", "Unit", "Value"])}
 
     # Rename columns
-    item_map.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-    raw_trade_data.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-    reporting_date.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-    content_factors.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-    sugar_processing.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-    production.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
+    for data in inputs.values():
+        data.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
 
+    inputs["reporting_window"] = context.get("reporting_windows", lambda: reporting_windows(context.table("reporting_dates")))
 
-    # Select year
-    raw_trade_data = raw_trade_data[raw_trade_data["Year"] == year]
-    sugar_processing = sugar_processing[sugar_processing["Year"] == year]
-    production = production[production["Year"] == year]
-
-
-    # Tweaks for slightly different files
-    production_all = production[["Area_Code", "Area", "Item_Code", "Item", "Element_Code", "Element", "Year_Code", "Year", "Unit", "Value"]]
-
+    item_map = inputs["item_map"]
     item_map[item_map["FAO_code"]==156] = [156, "Sugar cane", 2545, "Sugar agregate"]
     item_map[item_map["FAO_code"]==157] = [157, "Sugar beet", 2545, "Sugar agregate"]
-    # production_crops.drop(columns=["Note"], inplace=True)
-    # production_offals = sugar_processing[(sugar_processing["Element_Code"] == 5511) & (sugar_processing["Item_Code"] == 2736)]
-    # production_offals['Element_Code'] = 5510
-    # production_offals['Value'] = production_offals['Value']*1000
-    
-    print("    Preprocessing trade data...")
 
-    # Combine and filter
-    # production_all = pd.concat([production_all, production_offals], ignore_index=True)
-    production_all = production_all[(production_all["Area_Code"]<300) & (production_all["Element_Code"]==5510)]
+    return inputs
 
 
+def reported_trade_data(raw_trade_data, reporting_window):
+    """
+    Split the raw trade data into reported imports and exports, as consumer/producer tables,
+    without badly reported years and trade of a country with itself
+    """
+
     # harmonise import and export data
 
     data_import = raw_trade_data[raw_trade_data["Element_Code"] == 5610][["Reporter_Country_Code", "Partner_Country_Code", "Element_Code", "Item_Code", "Year", "Value"]]
     data_export = raw_trade_data[raw_trade_data["Element_Code"] == 5910][["Partner_Country_Code", "Reporter_Country_Code", "Element_Code", "Item_Code", "Year", "Value"]]
 
 
-    data_import = eliminate_dates(reporting_date, data_import)
-    data_export = eliminate_dates(reporting_date, data_export)
+    data_import = eliminate_dates(reporting_window, data_import)
+    data_export = eliminate_dates(reporting_window, data_export)
 
     data_import.loc[data_import["Reporter_Country_Code"] == data_import["Partner_Country_Code"], "Value"] = 0
     data_export.loc[data_export["Reporter_Country_Code"] == data_export["Partner_Country_Code"], "Value"] = 0
@@ -215,6 +433,12 @@ def calculate_trade_matrix(
     data_import.rename(columns={"Reporter_Country_Code": "Consumer_Country_Code", "Partner_Country_Code": "Producer_Country_Code"}, inplace=True)
     data_export.rename(columns={"Reporter_Country_Code": "Producer_Country_Code", "Partner_Country_Code": "Consumer_Country_Code"}, inplace=True)
 
+    return data_import, data_export
+
+
+def reconcile_trade_data(data_import, data_export, prefer_import="import"):
+    """Combine reported imports and exports, keeping the preferred side where both report a flow"""
+
     if prefer_import == "import":
         trade_data = pd.concat([data_import, data_export], ignore_index=True)
         trade_data = trade_data.drop_duplicates(subset=["Consumer_Country_Code", "Producer_Country_Code", "Year", "Item_Code"],
@@ -226,30 +450,66 @@ def calculate_trade_matrix(
     else:
         raise ValueError("prefer_import must be either 'import' or 'export'")
 
-    trade_data = trade_data.sort_values(["Consumer_Country_Code", "Producer_Country_Code"])
+    return trade_data.sort_values(["Consumer_Country_Code", "Producer_Country_Code"])
+
+
+def harmonise_trade_data(raw_trade_data, reporting_window, prefer_import="import"):
+    """Combine reported imports and exports into one consumer/producer trade table"""
+
+    data_import, data_export = reported_trade_data(raw_trade_data, reporting_window)
+    return reconcile_trade_data(data_import, data_export, prefer_import)
 
-    conversion_factors = calculate_conversion_factors(conversion_opt, content_factors, item_map)
 
+def primary_trade_data(trade_data, conversion_factors):
+    """
+    Convert trade into primary equivalents, summed per (consumer, producer, year, primary item)
+
+    Args:
+        trade_data: harmonised trade data
+        conversion_factors: factors of one conversion option from calculate_conversion_factors(),
+            or a dict of conversion option -> factors to convert all options in one batch
+
+    Returns:
+        DataFrame with the primary values in Value_Sum, or with a dict of
+        conversion factors in one column per conversion option
+    """
+
+    if isinstance(conversion_factors, dict):
+        value_columns = list(conversion_factors)
+    else:
+        value_columns = ["Value_Sum"]
+        conversion_factors = {"Value_Sum": conversion_factors}
+
+    # every option maps the same items onto the same primary items, only the factor differs
+    factors = next(iter(conversion_factors.values()))[["FAO_code", "primary_item"]].copy()
+    for column, option_factors in conversion_factors.items():
+        factors[column] = option_factors["Conversion_factor"].to_numpy()
 
     trade_data = trade_data.merge(
-        conversion_factors,
+        factors,
         left_on="Item_Code",
         right_on="FAO_code",
         how="left")
     trade_data.drop(columns=["FAO_code"], inplace=True)
 
-    trade_data["primary_Value"] = trade_data["Value"] * trade_data["Conversion_factor"]
+    trade_data[value_columns] = trade_data[value_columns].mul(trade_data["Value"], axis=0)
 
-    primary_data = trade_data.groupby(["Consumer_Country_Code", "Producer_Country_Code", "Year", "primary_item"])["primary_Value"].sum().reset_index()
-    primary_data.columns = ["Consumer_Country_Code", "Producer_Country_Code", "Year", "primary_item", "Value_Sum"]
+    primary_data = trade_data.groupby(["Consumer_Country_Code", "Producer_Country_Code", "Year", "primary_item"])[value_columns].sum().reset_index()
             
-    primary_data = primary_data[
+    return primary_data[
         (primary_data["primary_item"] != 0) & 
         (primary_data["primary_item"].notna()) &
-        (primary_data["Value_Sum"].notna())]
+        (primary_data[value_columns].notna().all(axis=1))]
 
 
-    # Calculate sugar production and sugar production shares
+def add_sugar_production(production_all, conversion_factors):
+    """
+    Add the sugar aggregate (2545) to the production data
+
+    Returns:
+        (production_all with the sugar aggregate, production shares of the sugar crops per country and year)
+    """
+
     sugar_crop_codes = [156, 157]
 
     # Filter production data for sugar crops and merge with conversion factors
@@ -263,11 +523,11 @@ def calculate_trade_matrix(
 
     # Calculate shares for later use
     sugar_shares = (sugar_production
-        .groupby(["Area_Code", "Year"],)
-        .apply(lambda x: x.assign(share=x["Value"] / x["Value"].sum()))
-        .reset_index(drop=True)
+        .assign(share=sugar_production["Value"] / sugar_production.groupby(["Area_Code", "Year"])["Value"].transform("sum"))
+        .sort_values(["Area_Code", "Year"], kind="stable")
         [["Area_Code", "Year", "Item_Code", "share"]]
-        .query("share > 0"))
+        .query("share > 0")
+        .reset_index(drop=True))
 
     # Add production data - group by key columns and aggregate
     sugar_production = (sugar_production
@@ -282,39 +542,11 @@ def calculate_trade_matrix(
         .assign(Flag=" "))
 
     # Add sugar production to main production data
-    production_all = pd.concat([production_all, sugar_production], ignore_index=True)
-
-    unique_combinations = primary_data[["Year", "primary_item"]].drop_duplicates()
-
-    
-
-
-    mrio_output = []
-    for index, (yr, ic) in enumerate(tqdm(unique_combinations.values, desc="    Processing MRIO models", leave=True, position=0)):
-        m = mrio_model(ic, yr, primary_data, production_all)
-        mrio_output += m
-        
-
-    transformed_data = pd.DataFrame(mrio_output, columns=primary_data.columns)
-
-    missing_data = production_all[
-        (production_all["Element_Code"] == 5510) &
-        (production_all["Year"] == year) &
-        (production_all["Item_Code"].notna()) &
-        (production_all["Value"].notna()) &
-        (production_all["Item_Code"].isin(item_map["primary_item"])) &
-        (~production_all["Item_Code"].isin(primary_data["primary_item"]))]
+    return pd.concat([production_all, sugar_production], ignore_index=True), sugar_shares
 
-    add_data = missing_data[["Area_Code", "Value", "Item_Code", "Year"]].copy()
-    add_data = add_data.rename(columns={"Area_Code": "Producer_Country_Code"})
-    add_data["Consumer_Country_Code"] = add_data["Producer_Country_Code"]
-
-    transformed_data = transformed_data.rename(columns={"primary_item": "Item_Code", "Value_Sum": "Value"})
-    transformed_data = pd.concat([transformed_data, add_data], ignore_index=True)
 
-    ###################################
-
-    sugar_trade_data = transformed_data[transformed_data["Item_Code"] == 2545]
+def sugar_processing_shares(sugar_processing, conversion_factors):
+    """Share of sugar cane and sugar beet in each country's sugar processing, per year"""
 
     sugar_processing = sugar_processing[
         (sugar_processing["Item_Code"].isin([2536, 2537]))&
@@ -335,21 +567,69 @@ def calculate_trade_matrix(
     sugar_processing["Value_new"] = sugar_processing["Value"] * sugar_processing["Conversion_factor"]
 
 
-    sugar_processing = (sugar_processing
-        .groupby(["Area_Code", "Year"])
-        .apply(lambda x: x.assign(processing_share=x["Value_new"] / x["Value_new"].sum()))
+    sugar_processing["processing_share"] = (
+        sugar_processing["Value_new"] / sugar_processing.groupby(["Area_Code", "Year"])["Value_new"].transform("sum"))
+
+    return (sugar_processing
+        .sort_values(["Area_Code", "Year"], kind="stable")
         .reset_index(drop=True)[["Area_Code", "Year", "Item_Code", "processing_share"]])
 
+
+def mrio_results_frame(item_systems, item_results, primary_data, solver="sparse"):
+    """Collect the solved item systems into one Consumer/Producer/Year/primary_item/Value_Sum frame"""
+
+    mrio_output = {column: [] for column in primary_data.columns}
+    solver_paths = {}
+    for (yr, ic, *_), (consumers, producers, r_bar, path) in zip(item_systems, item_results):
+        solver_paths.setdefault(path, []).append(ic)
+        mrio_output["Consumer_Country_Code"].append(consumers)
+        mrio_output["Producer_Country_Code"].append(producers)
+        mrio_output["Year"].append(np.full(len(r_bar), yr, dtype=primary_data["Year"].dtype))
+        mrio_output["primary_item"].append(np.full(len(r_bar), ic, dtype=primary_data["primary_item"].dtype))
+        mrio_output["Value_Sum"].append(r_bar)
+
+    transformed_data = pd.DataFrame({
+        column: np.concatenate(arrays) if arrays else []
+        for column, arrays in mrio_output.items()})
+
+    print("    Solver paths: " + ", ".join(f"{path}: {len(items)}" for path, items in solver_paths.items()))
+    if solver != "dense" and "pinv" in solver_paths:
+        print(f"    Singular systems solved with the pseudo-inverse: items {[int(ic) for ic in solver_paths['pinv']]}")
+
+    return transformed_data
+
+
+def split_sugar_aggregate(sugar_trade_data, sugar_shares, sugar_processing, production_all, conversion_factors):
+    """
+    Split the MRIO results of the sugar aggregate (2545) back into sugar cane and sugar beet
+
+    Each producer's sugar is allocated to the crops by their share in its sugar
+    processing, or by their production shares where there is no processing
+    data, and converted back to crop quantities. On the diagonal, the domestic
+    use is corrected so that each producer's crop totals match its production.
+    All steps are grouped array operations, so any number of years can be
+    split at once.
+
+    Args:
+        sugar_trade_data: MRIO results (Consumer/Producer_Country_Code, Value, Item_Code, Year) of item 2545
+        sugar_shares: production shares of the sugar crops from add_sugar_production()
+        sugar_processing: processing shares of the sugar crops from sugar_processing_shares()
+        production_all: production data including the sugar crops
+        conversion_factors: factors of the conversion option from calculate_conversion_factors()
+
+    Returns:
+        DataFrame with Consumer_Country_Code, Producer_Country_Code, Value, Item_Code and Year of the sugar crops
+    """
+
+    sugar_crop_codes = [156, 157]
+
     # Join sugar shares with processing data
     sugar_crop_share = sugar_shares.merge(sugar_processing, 
         on=["Area_Code", "Year", "Item_Code"], 
         how="left")
 
     # Check if a crop does not appear in processing data but does in production
-    sugar_crop_share = (sugar_crop_share
-        .groupby(["Area_Code", "Year"])
-        .apply(lambda x: x.assign(control=x["processing_share"].sum(skipna=True)))
-        .reset_index(drop=True))
+    sugar_crop_share["control"] = sugar_crop_share.groupby(["Area_Code", "Year"])["processing_share"].transform("sum")
 
     # If that is the case, set the contribution to processing to zero
     mask1 = (sugar_crop_share["processing_share"].isna() & 
@@ -384,9 +664,12 @@ def calculate_trade_matrix(
         production_all["Item_Code"].isin(sugar_crop_codes)
         ].rename(columns={"Value": "national_production"})
 
+    # trade without a crop share cannot be allocated
+    group_keys = ["Producer_Country_Code", "Year", "Item_Code"]
+    sugar_data = sugar_data.dropna(subset=group_keys)
     sugar_data = (sugar_data
-        .groupby(["Producer_Country_Code", "Year", "Item_Code"])
-        .apply(lambda x: x.assign(sugar_crop_total=x["Value"].sum(skipna=True)))
+        .assign(sugar_crop_total=sugar_data.groupby(group_keys)["Value"].transform("sum"))
+        .sort_values(group_keys, kind="stable")
         .reset_index(drop=True))
 
     sugar_data = sugar_data.merge(
@@ -400,13 +683,319 @@ def calculate_trade_matrix(
     mask_diagonal = (sugar_data["Producer_Country_Code"] == sugar_data["Consumer_Country_Code"])
     sugar_data.loc[mask_diagonal, "Value"] = sugar_data.loc[mask_diagonal, "Value_new"]
 
-    sugar_data = sugar_data[["Consumer_Country_Code", "Producer_Country_Code", "Value", "Item_Code", "Year"]]
-    print(sugar_data)
+    return sugar_data[["Consumer_Country_Code", "Producer_Country_Code", "Value", "Item_Code", "Year"]]
+
+
+def finalise_trade_matrix(year, transformed_data, primary_data, production_all, item_map, sugar_shares, sugar_processing, conversion_factors):
+    """
+    Add unmatched domestic production and split the sugar aggregate back into
+    sugar cane and sugar beet for one year's MRIO results
+    """
+
+    missing_data = production_all[
+        (production_all["Element_Code"] == 5510) &
+        (production_all["Year"] == year) &
+        (production_all["Item_Code"].notna()) &
+        (production_all["Value"].notna()) &
+        (production_all["Item_Code"].isin(item_map["primary_item"])) &
+        (~production_all["Item_Code"].isin(primary_data["primary_item"]))]
+
+    add_data = missing_data[["Area_Code", "Value", "Item_Code", "Year"]].copy()
+    add_data = add_data.rename(columns={"Area_Code": "Producer_Country_Code"})
+    add_data["Consumer_Country_Code"] = add_data["Producer_Country_Code"]
+
+    transformed_data = transformed_data.rename(columns={"primary_item": "Item_Code", "Value_Sum": "Value"})
+    transformed_data = pd.concat([transformed_data, add_data], ignore_index=True)
+
+    ###################################
+
+    sugar_trade_data = transformed_data[transformed_data["Item_Code"] == 2545]
+
+    sugar_data = split_sugar_aggregate(sugar_trade_data, sugar_shares, sugar_processing, production_all, conversion_factors)
+
     output_data = pd.concat([transformed_data[transformed_data["Item_Code"] != 2545], sugar_data], ignore_index=True)
 
-    print("    Saving MRIO results...")
+    return output_data[["Consumer_Country_Code", "Producer_Country_Code", "Value", "Item_Code", "Year"]]
+
+
+def iter_trade_matrices(
+        conversion_opts=["dry_matter"],
+        prefer_imports=["import"],
+        years=[2013],
+        historic_years=[],
+        context=None,
+        solver="sparse",
+        n_workers=1,
+        mrio_cache=None,
+        consumers=None):
+    """
+    Calculate the trade matrices of several years, conversion options and
+    import/export preferences from one load of the input data
+
+    The inputs of all years are loaded together and imports and exports are
+    cleaned once; each preference only reconciles them differently. Every
+    conversion option is applied to the reconciled trade in one batch, the
+    MRIO systems of every (Year, primary_item) are built once per preference,
+    with one column of values per option, and all of them are solved in one
+    pass in year order. Production and sugar shares are shared by all.
+    With consumers (FAOSTAT codes), only the rows the provenance of these
+    countries needs are solved, see solve_consumer_rows().
+
+    Yields:
+        (year, prefer_import, conversion option, trade matrix) as soon as all items of that year have been solved
+    """
+
+    if context is None:
+        context = PipelineContext()
+
+    print("    Loading trade data...")
+    inputs = load_trade_inputs(years, historic_years, context)
+    item_map = inputs["item_map"]
+
+    # Tweaks for slightly different files
+    production_all = inputs["production"][["Area_Code", "Area", "Item_Code", "Item", "Element_Code", "Element", "Year_Code", "Year", "Unit", "Value"]]
+    # production_crops.drop(columns=["Note"], inplace=True)
+    # production_offals = sugar_processing[(sugar_processing["Element_Code"] == 5511) & (sugar_processing["Item_Code"] == 2736)]
+    # production_offals['Element_Code'] = 5510
+    # production_offals['Value'] = production_offals['Value']*1000
+    
+    print("    Preprocessing trade data...")
+
+    # Combine and filter
+    # production_all = pd.concat([production_all, production_offals], ignore_index=True)
+    production_all = production_all[(production_all["Area_Code"]<300) & (production_all["Element_Code"]==5510)]
+
+    data_import, data_export = reported_trade_data(inputs["raw_trade_data"], inputs["reporting_window"])
+
+    conversion_factors = {
+        conversion_opt: calculate_conversion_factors(conversion_opt, inputs["content_factors"], item_map)
+        for conversion_opt in conversion_opts}
+
+    # Calculate sugar production and sugar production shares (these depend on the conversion option)
+    production, sugar_shares, sugar_processing = {}, {}, {}
+    for conversion_opt, factors in conversion_factors.items():
+        production[conversion_opt], sugar_shares[conversion_opt] = add_sugar_production(production_all, factors)
+        sugar_processing[conversion_opt] = sugar_processing_shares(inputs["sugar_processing"], factors)
+
+    # one task per (preference, system, option), all options of a system share its countries and sparse structure
+    primary_data = {}
+    tasks = []
+    for prefer_import in prefer_imports:
+        trade_data = reconcile_trade_data(data_import, data_export, prefer_import)
+        primary_data[prefer_import] = primary_trade_data(trade_data, conversion_factors)
+
+        for year, item_code, countries, rows, cols, values, p in build_item_systems(primary_data[prefer_import], production):
+            for k, conversion_opt in enumerate(conversion_opts):
+                tasks.append(((prefer_import, conversion_opt), (year, item_code, countries, rows, cols, values[:, k], p[:, k])))
+
+    # stable sort, so within a year the preference, item and option order is kept
+    tasks.sort(key=lambda task: task[1][0])
+    if consumers is None:
+        item_results = iter_item_solutions([system for _, system in tasks], solver=solver, n_workers=n_workers, mrio_cache=mrio_cache)
+    else:
+        item_results = solve_consumer_rows([system for _, system in tasks], consumers, solver, n_workers, mrio_cache)
+
+    # each year is complete once the next one starts
+    solved_years = groupby(zip(tasks, item_results, strict=True), key=lambda solution: solution[0][1][0])
+    next_year, next_solutions = next(solved_years, (None, ()))
+
+    for year in sorted(years):
+        year_solutions = []
+        if next_year == year:
+            year_solutions = list(next_solutions)
+            next_year, next_solutions = next(solved_years, (None, ()))
+
+        for prefer_import in prefer_imports:
+            for conversion_opt in conversion_opts:
+                variant_solutions = [
+                    (system, result) for (variant, system), result in year_solutions
+                    if variant == (prefer_import, conversion_opt)]
+                year_systems = [system for system, _ in variant_solutions]
+                year_results = [result for _, result in variant_solutions]
+                year_primary_data = (primary_data[prefer_import][primary_data[prefer_import]["Year"] == year]
+                    [["Consumer_Country_Code", "Producer_Country_Code", "Year", "primary_item", conversion_opt]]
+                    .rename(columns={conversion_opt: "Value_Sum"}))
+
+                transformed_data = mrio_results_frame(year_systems, year_results, year_primary_data, solver=solver)
+
+                option_shares = sugar_shares[conversion_opt]
+                option_processing = sugar_processing[conversion_opt]
+                yield year, prefer_import, conversion_opt, finalise_trade_matrix(
+                    year,
+                    transformed_data,
+                    year_primary_data,
+                    production[conversion_opt],
+                    item_map,
+                    option_shares[option_shares["Year"] == year],
+                    option_processing[option_processing["Year"] == year],
+                    conversion_factors[conversion_opt])
+
+
+def save_trade_matrix(output_data, year, prefer_import, conversion_opt, writer=None):
+    """Write one TradeMatrix, in the background if a BackgroundWriter is given"""
+    filename = f"results/{year}/.mrio/TradeMatrix_{prefer_import}_{conversion_opt}.csv"
+    if writer is None:
+        output_data.to_csv(filename, index=False)
+    else:
+        writer.to_csv(output_data, filename, index=False)
+
+
+def calculate_trade_matrix_years(
+        conversion_opt="dry_matter",
+        prefer_import="import",
+        years=[2013],
+        context=None,
+        solver="sparse",
+        n_workers=1,
+        mrio_cache=None,
+        consumers=None,
+        writer=None):
+    """
+    Calculate Trade Matrix module for several years, and optionally several
+    conversion options, in a single pass
+    Years before 2010 use the historic food balance sheets, as in main.py,
+    and each year's TradeMatrix is written as soon as it is complete
+
+    Args:
+        conversion_opt: conversion option, or a list of conversion options
+        prefer_import: "import" or "export", or ["import", "export"] for both;
+            every combination gets its own TradeMatrix_{prefer_import}_{option}.csv
+        mrio_cache: optional MrioCache, see processing/mrio_cache.py
+        consumers: optional FAOSTAT codes of the only consumer countries to solve for
+        writer: optional BackgroundWriter to write the TradeMatrix files with
+    """
+
+    conversion_opts = [conversion_opt] if isinstance(conversion_opt, str) else list(conversion_opt)
+    prefer_imports = [prefer_import] if isinstance(prefer_import, str) else list(prefer_import)
+    historic_years = [year for year in years if year < 2010]
+
+    for year, prefer, option, output_data in iter_trade_matrices(
+            conversion_opts, prefer_imports, years, historic_years, context, solver, n_workers, mrio_cache, consumers):
+        print(f"    Saving MRIO results for {year} ({prefer}, {option})...")
+        Path(f"results/{year}/.mrio").mkdir(parents=True, exist_ok=True)
+        save_trade_matrix(output_data, year, prefer, option, writer)
+
+
+def calculate_trade_matrix(
+        conversion_opt="dry_matter",
+        prefer_import="import",
+        year=2013,
+        historic="Historic",
+        context=None,
+        solver="sparse",
+        n_workers=1,
+        mrio_cache=None,
+        consumers=None,
+        writer=None):
+    """
+    Calculate Trade Matrix module for MRIO pipeline
+    conversion_opt and prefer_import may be lists (e.g. ["import", "export"]),
+    all combinations share one load and harmonisation
+    consumers optionally restricts the solves to the rows of these FAOSTAT country codes
+    writer optionally writes the TradeMatrix files in the background, see processing/background_writer.py
+
+    Returns:
+        dict of (prefer_import, conversion_opt) -> TradeMatrix, for passing on to animal_products_to_feed()
+    """
+
+    conversion_opts = [conversion_opt] if isinstance(conversion_opt, str) else list(conversion_opt)
+    prefer_imports = [prefer_import] if isinstance(prefer_import, str) else list(prefer_import)
+    historic_years = [year] if historic == "Historic" else []
+
+    trade_matrices = {}
+    for _, prefer, option, output_data in iter_trade_matrices(
+            conversion_opts, prefer_imports, [year], historic_years, context, solver, n_workers, mrio_cache, consumers):
+        print("    Saving MRIO results...")
+
+        # transformed_data["Value"] = transformed_data["Value"].round(2)
+        save_trade_matrix(output_data, year, prefer, option, writer)
+        trade_matrices[(prefer, option)] = output_data
+    return trade_matrices
+
+
+def year_item_systems(conversion_opt="dry_matter", prefer_import="import", year=2013, historic="Historic", context=None):
+    """
+    MRIO systems of every item of one year, as from build_item_systems(), and
+    the primary-equivalent trade data they were built from
+    """
+
+    if context is None:
+        context = PipelineContext()
+
+    historic_years = [year] if historic == "Historic" else []
 
-    # transformed_data["Value"] = transformed_data["Value"].round(2)
-    output_data = output_data[["Consumer_Country_Code", "Producer_Country_Code", "Value", "Item_Code", "Year"]]
-    output_data.to_csv(output_filename, index=False)
+    print("    Loading trade data...")
+    inputs = load_trade_inputs([year], historic_years, context)
+
+    production_all = inputs["production"][["Area_Code", "Area", "Item_Code", "Item", "Element_Code", "Element", "Year_Code", "Year", "Unit", "Value"]]
+    production_all = production_all[(production_all["Area_Code"]<300) & (production_all["Element_Code"]==5510)]
+
+    trade_data = harmonise_trade_data(inputs["raw_trade_data"], inputs["reporting_window"], prefer_import)
+    conversion_factors = calculate_conversion_factors(conversion_opt, inputs["content_factors"], inputs["item_map"])
+    primary_data = primary_trade_data(trade_data, conversion_factors)
+    production_all, _ = add_sugar_production(production_all, conversion_factors)
+
+    return build_item_systems(primary_data, production_all), primary_data
+
+
+def calculate_trade_matrix_ensemble(
+        conversion_opt="dry_matter",
+        prefer_import="import",
+        year=2013,
+        historic="Historic",
+        n_draws=1000,
+        z_cv=0.1,
+        p_cv=0.05,
+        distribution="lognormal",
+        quantiles=(0.05, 0.5, 0.95),
+        seed=0,
+        memory_budget_gb=4,
+        context=None,
+        n_workers=1):
+    """
+    Monte-Carlo uncertainty of the MRIO step
+
+    Perturbs the primary-equivalent trade flows (Z) and production (p) of every
+    item n_draws times with the given error model and writes the mean and
+    quantiles of R_bar to TradeMatrixEnsemble_{prefer_import}_{conversion_opt}.csv.
+    The sugar aggregate (2545) is reported as the aggregate, without the
+    split into sugar cane and sugar beet.
+
+    Args:
+        n_draws: number of draws per item
+        z_cv, p_cv: coefficient of variation of the trade flows and of production
+        distribution: error model, see mrio_solver.ERROR_MODELS
+        quantiles: quantiles of R_bar to write, as Value_q{quantile} columns
+        seed: seed of the draws, combined with the year and item
+        memory_budget_gb: memory the ensemble workers may use together, see iter_item_ensembles()
+    """
 
+    output_filename = f"results/{year}/.mrio/TradeMatrixEnsemble_{prefer_import}_{conversion_opt}.csv"
+
+    item_systems, primary_data = year_item_systems(conversion_opt, prefer_import, year, historic, context)
+    item_results = iter_item_ensembles(
+        item_systems,
+        n_workers=n_workers,
+        memory_budget_gb=memory_budget_gb,
+        n_draws=n_draws,
+        z_cv=z_cv,
+        p_cv=p_cv,
+        distribution=distribution,
+        quantiles=tuple(quantiles),
+        seed=seed)
+
+    quantile_columns = [f"Value_q{q:g}" for q in quantiles]
+    ensemble_output = {column: [] for column in ["Consumer_Country_Code", "Producer_Country_Code", "Item_Code", "Year", "Value"] + quantile_columns}
+    for (yr, ic, *_), (consumers, producers, mean, quantile_values) in zip(item_systems, item_results, strict=True):
+        ensemble_output["Consumer_Country_Code"].append(consumers)
+        ensemble_output["Producer_Country_Code"].append(producers)
+        ensemble_output["Item_Code"].append(np.full(len(mean), ic, dtype=primary_data["primary_item"].dtype))
+        ensemble_output["Year"].append(np.full(len(mean), yr, dtype=primary_data["Year"].dtype))
+        ensemble_output["Value"].append(mean)
+        for column, values in zip(quantile_columns, quantile_values):
+            ensemble_output[column].append(values)
+
+    print("    Saving MRIO ensemble results...")
+    pd.DataFrame({
+        column: np.concatenate(arrays) if arrays else []
+        for column, arrays in ensemble_output.items()}).to_csv(output_filename, index=False)
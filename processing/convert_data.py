@@ -0,0 +1,185 @@
+"""
+Columnar, year-partitioned store of the FAOSTAT bulk data.
+
+The normalised FAOSTAT CSVs are several GB each and every pipeline stage only
+ever needs a single year (or a handful of years) out of them. convert_data()
+parses each CSV once and writes it to parquet files partitioned by Year;
+load_faostat() then reads only the requested years and columns, falling back
+to streaming the CSV when no store has been built yet.
+
+The CSVs do not need to be extracted: when only the downloaded zip archive is
+present, the CSV member is streamed straight out of the archive.
+"""
+
+import shutil
+import zipfile
+from contextlib import contextmanager
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+FAOSTAT_DATASETS = {
+    "production": "Production_Crops_Livestock_E_All_Data_(Normalized)",
+    "trade": "Trade_DetailedTradeMatrix_E_All_Data_(Normalized)",
+    "fbs": "FoodBalanceSheets_E_All_Data_(Normalized)",
+    "fbs_historic": "FoodBalanceSheetsHistoric_E_All_Data_(Normalized)",
+    "sua": "SUA_Crops_Livestock_E_All_Data_(Normalized)",
+    "commodity_balances": "CommodityBalances_(non-food)_(-2013_old_methodology)_E_All_Data_(Normalized)",
+}
+
+STORE_DIR = ".store"
+COMPLETE_MARKER = "_SUCCESS"
+
+
+def _arrow_schema(columns):
+    # codes and years are integers, Value is a float and everything else
+    # (names, units, flags, M49/CPC codes with leading quotes) is kept as text
+    fields = []
+    for col in columns:
+        if col == "Value":
+            fields.append(pa.field(col, pa.float64()))
+        elif col == "Year" or col.endswith("Code"):
+            fields.append(pa.field(col, pa.int64()))
+        else:
+            fields.append(pa.field(col, pa.string()))
+    return pa.schema(fields)
+
+
+def _to_arrow(chunk, schema):
+    for field in schema:
+        col = field.name
+        if pa.types.is_string(field.type):
+            chunk[col] = chunk[col].astype("string")
+        elif pa.types.is_integer(field.type):
+            chunk[col] = pd.to_numeric(chunk[col], errors="coerce").astype("Int64")
+        else:
+            chunk[col] = pd.to_numeric(chunk[col], errors="coerce").astype("float64")
+    return pa.Table.from_pandas(chunk, schema=schema, preserve_index=False).replace_schema_metadata(None)
+
+
+def store_path(dataset, path="./input_data"):
+    return Path(path) / STORE_DIR / FAOSTAT_DATASETS[dataset]
+
+
+def source_path(dataset, path="./input_data"):
+    """Extracted CSV if there is one, otherwise the downloaded zip archive"""
+    stem = FAOSTAT_DATASETS[dataset]
+    csv_file = Path(path) / f"{stem}.csv"
+    return csv_file if csv_file.exists() else Path(path) / f"{stem}.zip"
+
+
+@contextmanager
+def _open_source(dataset, path):
+    source = source_path(dataset, path)
+    if source.suffix == ".csv":
+        with open(source, "rb") as f:
+            yield f
+        return
+
+    with zipfile.ZipFile(source) as zip_ref:
+        # skip the Flags/AreaCodes/Elements/ItemCodes members shipped alongside the data
+        member = f"{FAOSTAT_DATASETS[dataset]}.csv"
+        if member not in zip_ref.namelist():
+            member = next(n for n in zip_ref.namelist() if n.endswith("All_Data_(Normalized).csv"))
+        with zip_ref.open(member) as f:
+            yield f
+
+
+def iter_faostat_chunks(dataset, years=None, columns=None, elements=None, path="./input_data", chunksize=1_000_000):
+    """
+    Stream a FAOSTAT dataset from its CSV, or straight out of its zip archive,
+    yielding chunks filtered to the requested years and element codes
+    """
+
+    usecols = None
+    if columns is not None:
+        usecols = list(columns)
+        if years is not None:
+            usecols.append("Year")
+        if elements is not None:
+            usecols.append("Element Code")
+        usecols = list(dict.fromkeys(usecols))
+
+    with _open_source(dataset, path) as f:
+        for chunk in pd.read_csv(f, encoding="latin-1", usecols=usecols, chunksize=chunksize, low_memory=False):
+            if years is not None:
+                chunk = chunk[chunk["Year"].isin(years)]
+            if elements is not None:
+                chunk = chunk[chunk["Element Code"].isin(elements)]
+            yield chunk if columns is None else chunk[columns]
+
+
+def convert_data(path="./input_data", chunksize=1_000_000, overwrite=False):
+    """
+    Convert the FAOSTAT CSVs (extracted or still zipped) into the year-partitioned parquet store
+    This only needs to run once; datasets whose store is newer than the source are skipped
+    """
+
+    for dataset, stem in FAOSTAT_DATASETS.items():
+        source = source_path(dataset, path)
+        store = store_path(dataset, path)
+        marker = store / COMPLETE_MARKER
+
+        if not source.exists():
+            continue
+        if marker.exists() and not overwrite and marker.stat().st_mtime >= source.stat().st_mtime:
+            continue
+
+        print(f"Converting {source.name}...")
+        tmp_store = store.with_name(f"{stem}.tmp")
+        if tmp_store.exists():
+            shutil.rmtree(tmp_store)
+        tmp_store.mkdir(parents=True)
+
+        schema = None
+        for n, chunk in enumerate(iter_faostat_chunks(dataset, path=path, chunksize=chunksize)):
+            if schema is None:
+                schema = _arrow_schema(chunk.columns)
+            table = _to_arrow(chunk, schema)
+            years = table.column("Year").to_numpy()
+            for year in pd.unique(years):
+                year_dir = tmp_store / str(int(year))
+                year_dir.mkdir(exist_ok=True)
+                pq.write_table(table.filter(pa.array(years == year)), year_dir / f"part-{n:04d}.parquet")
+
+        (tmp_store / COMPLETE_MARKER).touch()
+        if store.exists():
+            shutil.rmtree(store)
+        tmp_store.rename(store)
+
+
+def load_faostat(dataset, years=None, columns=None, elements=None, path="./input_data"):
+    """
+    Load a FAOSTAT dataset restricted to the requested years, columns and elements
+
+    Args:
+        dataset: key of FAOSTAT_DATASETS, e.g. "production" or "fbs_historic"
+        years: iterable of years to load, None for all years
+        columns: list of columns (original FAOSTAT names) to load, None for all
+        elements: iterable of Element Codes to keep, None for all elements
+
+    Returns:
+        DataFrame with the original FAOSTAT column names
+    """
+
+    store = store_path(dataset, path)
+    if years is not None:
+        years = [int(y) for y in years]
+    if elements is not None:
+        elements = [int(e) for e in elements]
+
+    if not (store / COMPLETE_MARKER).exists():
+        chunks = iter_faostat_chunks(dataset, years=years, columns=columns, elements=elements, path=path)
+        return pd.concat(chunks, ignore_index=True)
+
+    year_dirs = sorted(store.glob("[0-9]*")) if years is None else [store / str(y) for y in years]
+    files = [f for year_dir in year_dirs for f in sorted(year_dir.glob("*.parquet"))]
+
+    if not files:
+        schema = pq.read_schema(next(store.glob("*/*.parquet")))
+        return schema.empty_table().select(columns or schema.names).to_pandas()
+
+    filters = None if elements is None else [("Element Code", "in", elements)]
+    return pa.concat_tables([pq.read_table(f, columns=columns, filters=filters) for f in files]).to_pandas()
@@ -0,0 +1,78 @@
+"""
+Binary cache for the Excel reference workbooks.
+
+Parsing .xlsx/.xls files through openpyxl/xlrd is slow, and the same workbooks
+are read for every year and country. read_excel_cached() is a drop-in for
+pd.read_excel() that converts each (workbook, sheet, read options) once to a
+pickle next to the workbook and serves later reads from it. Cache entries record
+the workbook's mtime, size and SHA-256 so they are rebuilt automatically when
+the workbook changes.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+
+CACHE_DIR = ".cache"
+
+
+def _file_hash(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _cache_key(file_path, kwargs):
+    options = json.dumps(kwargs, sort_keys=True, default=str)
+    return hashlib.sha1(f"{file_path.resolve()}|{options}".encode()).hexdigest()
+
+
+def read_excel_cached(file_path, cache_dir=None, **kwargs):
+    """
+    pd.read_excel() with a binary cache keyed on the workbook's mtime and hash
+
+    Args:
+        file_path: path of the workbook
+        cache_dir: directory for the cache files, defaults to .cache next to the workbook
+        **kwargs: passed on to pd.read_excel(), and part of the cache key
+    """
+
+    file_path = Path(file_path)
+    cache_dir = Path(cache_dir) if cache_dir is not None else file_path.parent / CACHE_DIR
+    key = _cache_key(file_path, kwargs)
+    data_file = cache_dir / f"{key}.pkl"
+    meta_file = cache_dir / f"{key}.json"
+
+    stat = file_path.stat()
+    if data_file.exists() and meta_file.exists():
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta["mtime"] == stat.st_mtime and meta["size"] == stat.st_size:
+            return pd.read_pickle(data_file)
+
+        # touched but not changed (e.g. a fresh checkout): keep the entry, refresh the mtime
+        if meta["size"] == stat.st_size and meta["sha256"] == _file_hash(file_path):
+            meta["mtime"] = stat.st_mtime
+            with open(meta_file, "w") as f:
+                json.dump(meta, f)
+            return pd.read_pickle(data_file)
+
+    data = pd.read_excel(file_path, **kwargs)
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_file = data_file.with_suffix(".tmp")
+    data.to_pickle(tmp_file)
+    os.replace(tmp_file, data_file)
+    with open(meta_file, "w") as f:
+        json.dump({
+            "source": str(file_path),
+            "options": json.dumps(kwargs, sort_keys=True, default=str),
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "sha256": _file_hash(file_path)}, f)
+    return data
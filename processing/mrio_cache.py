@@ -0,0 +1,111 @@
+"""
+On-disk cache of the per-item MRIO solutions.
+
+Every (Year, primary_item, conversion option, import/export preference) system
+is fully described by its country codes, the coordinates and values of Z, the
+production vector p and the solver. MrioCache keys each solution on a hash of
+exactly these arrays, so after a small upstream change (e.g. one row of
+primary_item_map_feed.csv) a rerun only solves the items whose inputs changed
+and serves all others from disk. Entries are evicted once they are older than
+max_age_days or, least recently used first, once the cache exceeds
+max_size_gb.
+"""
+
+import hashlib
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+CACHE_DIR = "./input_data/.cache/mrio"
+
+# bump when the solvers change in a way that changes their results
+CACHE_VERSION = 1
+
+
+def system_key(countries, rows, cols, values, p, solver, consumers=None, producers=None):
+    """Content hash of one item's MRIO system, and of the rows and columns solved for if not all"""
+    sha = hashlib.sha1(f"v{CACHE_VERSION}|{solver}|{consumers is None}|{producers is None}".encode())
+    arrays = [countries, rows, cols, values, p] + [subset for subset in (consumers, producers) if subset is not None]
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        sha.update(f"|{array.dtype.str}{array.shape}|".encode())
+        sha.update(array.tobytes())
+    return sha.hexdigest()
+
+
+class MrioCache:
+    """
+    Persistent cache of mrio_model() results keyed by system_key()
+
+    Args:
+        cache_dir: directory holding one .npz file per solved system
+        max_size_gb: combined size above which the least recently used entries are evicted
+        max_age_days: entries not used for longer than this are evicted
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_size_gb=2.0, max_age_days=30):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = int(max_size_gb * 1024**3)
+        self.max_age = max_age_days * 24 * 3600
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def _file(self, key):
+        return self.cache_dir / key[:2] / f"{key}.npz"
+
+    def get(self, key):
+        """Cached (consumers, producers, values, path) for key, or None"""
+        cache_file = self._file(key)
+        try:
+            with np.load(cache_file) as data:
+                result = (data["consumers"], data["producers"], data["values"], str(data["path"]))
+        except (OSError, KeyError, ValueError):
+            self.misses += 1
+            return None
+
+        # the modification time records the last use, for the LRU eviction
+        os.utime(cache_file)
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        consumers, producers, values, path = result
+        cache_file = self._file(key)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_name(f"{key}.{os.getpid()}.tmp.npz")
+        np.savez(tmp_file, consumers=consumers, producers=producers, values=values, path=np.array(path))
+        os.replace(tmp_file, cache_file)
+
+    def evict(self):
+        """Remove entries older than max_age_days, then the least recently used ones above max_size_gb"""
+        if not self.cache_dir.exists():
+            return
+
+        now = time.time()
+        entries = []
+        for cache_file in self.cache_dir.glob("*/*.npz"):
+            try:
+                stat = cache_file.stat()
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.max_age:
+                cache_file.unlink(missing_ok=True)
+                self.evicted += 1
+            else:
+                entries.append((stat.st_mtime, stat.st_size, cache_file))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, cache_file in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            cache_file.unlink(missing_ok=True)
+            total_size -= size
+            self.evicted += 1
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        hit_rate = 100 * self.hits / lookups if lookups else 0
+        return f"{self.hits} hits, {self.misses} misses ({hit_rate:.0f}% hit rate), {self.evicted} evicted"
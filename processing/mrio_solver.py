@@ -0,0 +1,437 @@
+"""
+Solver backends for the per-item MRIO systems (Kastner et al. 2011).
+
+For an item with bilateral trade Z (consumer x producer) and production p:
+
+    x     = p + Z 1
+    A     = Z diag(1/x)
+    R     = (I - A)^-1 diag(p)
+    R_bar = diag(c) R,   c = (x - 1'Z) / x
+
+"dense" is the original JIT-compiled pseudo-inverse of the dense I - A;
+dense_r_bar_batch() runs it for many items at once in parallel threads.
+"sparse" factorizes I - A as a sparse matrix and solves only for the columns
+of diag(p) that are nonzero, falling back to the pseudo-inverse when the
+matrix is singular. "scc" splits the item's trade graph into its strongly
+connected components and solves them one block at a time in topological
+order, so the cost scales with the size of the components rather than with
+the number of countries. Every solve reports the path it took.
+
+leontief_inverse() gives the dense (I - A)^-1 that the trade scenarios update.
+
+ensemble_r_bar() propagates uncertainty in Z and p through the same model by
+solving batches of perturbed draws and returning quantiles of R_bar;
+ensemble_memory() estimates its peak memory per item.
+"""
+
+import math
+from graphlib import TopologicalSorter
+
+import numpy as np
+import scipy.sparse as sp
+from numba import config, jit, prange, set_num_threads
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import splu
+
+SOLVERS = ("sparse", "scc", "dense")
+
+# multiplicative error models of the Monte-Carlo ensemble
+ERROR_MODELS = ("lognormal", "normal")
+
+# relative residual above which a sparse LU solution is treated as singular
+RESIDUAL_TOLERANCE = 1e-8
+
+
+@jit(nopython=True, cache=True)
+def calculate_mrio_matrices(Z, p):
+    """JIT-compiled version of matrix calculations"""
+    summation_vector = np.ones(len(p))
+    x = p + Z @ summation_vector
+
+    one_over_x = np.where(x != 0, 1.0/x, 0.0)
+    A = Z * one_over_x.reshape(1, -1) # Z diag(1/x), by broadcasting
+
+    I = np.eye(len(p))
+    R = np.linalg.pinv(I - A) * p.reshape(1, -1) # note pseudo-inverse rather than inverse (inverse creates some extra)
+
+    ac = x - Z.sum(axis=0)
+    c = ac * one_over_x
+    R_bar = c.reshape(-1, 1) * R
+
+    return R_bar
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _dense_r_bar_batch(p_offsets, p, z_offsets, rows, cols, values, out_offsets, out_rows, out_cols, out_values, counts):
+    # one item per prange iteration: item k owns p[p_offsets[k]:p_offsets[k+1]], the nonzeros of Z in
+    # z_offsets[k]:z_offsets[k+1] and the output slots out_offsets[k]:out_offsets[k+1] (n^2 of them)
+    for k in prange(len(p_offsets) - 1):
+        n = p_offsets[k + 1] - p_offsets[k]
+        Z = np.zeros((n, n))
+        for e in range(z_offsets[k], z_offsets[k + 1]):
+            Z[rows[e], cols[e]] = values[e]
+
+        R_bar = calculate_mrio_matrices(Z, p[p_offsets[k]:p_offsets[k + 1]].copy())
+        rounded = np.empty_like(R_bar)
+        np.round(R_bar, 2, rounded)
+
+        slot = out_offsets[k]
+        for i in range(n):
+            for j in range(n):
+                if rounded[i, j] != 0:
+                    out_rows[slot] = i
+                    out_cols[slot] = j
+                    out_values[slot] = rounded[i, j]
+                    slot += 1
+        counts[k] = slot - out_offsets[k]
+
+
+def dense_r_bar_batch(systems, max_entries=2**24, n_threads=None):
+    """
+    Dense solver of many items at once, in parallel threads
+
+    The ragged systems are concatenated into flat arrays and solved by one
+    compiled kernel, with one item per parallel iteration. Items are batched
+    so that the preallocated output buffers (n^2 entries per item) hold at
+    most max_entries entries.
+
+    Args:
+        systems: list of (rows, cols, values, p) as passed to solve_mrio()
+        n_threads: number of threads, defaults to numba's default (all cores)
+
+    Returns:
+        list of (i_indices, j_indices, values) of the nonzero entries of R_bar
+        rounded to two decimals, in the order of systems
+    """
+
+    if n_threads is not None:
+        set_num_threads(max(1, min(n_threads, config.NUMBA_NUM_THREADS)))
+
+    results = []
+    start = 0
+    while start < len(systems):
+        stop, entries = start, 0
+        while stop < len(systems) and (stop == start or entries + len(systems[stop][3])**2 <= max_entries):
+            entries += len(systems[stop][3])**2
+            stop += 1
+        batch = systems[start:stop]
+
+        sizes = np.array([len(p) for *_, p in batch], dtype=np.int64)
+        p_offsets = np.concatenate([[0], np.cumsum(sizes)])
+        z_offsets = np.concatenate([[0], np.cumsum([len(values) for _, _, values, _ in batch])]).astype(np.int64)
+        out_offsets = np.concatenate([[0], np.cumsum(sizes**2)])
+        out_rows = np.empty(out_offsets[-1], dtype=np.int64)
+        out_cols = np.empty(out_offsets[-1], dtype=np.int64)
+        out_values = np.empty(out_offsets[-1])
+        counts = np.zeros(len(batch), dtype=np.int64)
+
+        def flat(k, dtype):
+            return np.concatenate([np.asarray(system[k], dtype=dtype) for system in batch])
+
+        _dense_r_bar_batch(
+            p_offsets, flat(3, np.float64), z_offsets, flat(0, np.int64), flat(1, np.int64), flat(2, np.float64),
+            out_offsets, out_rows, out_cols, out_values, counts)
+
+        for offset, count in zip(out_offsets[:-1], counts):
+            results.append((
+                out_rows[offset:offset + count],
+                out_cols[offset:offset + count],
+                out_values[offset:offset + count]))
+        start = stop
+
+    return results
+
+
+def dense_z(rows, cols, values, n):
+    Z = np.zeros((n, n))
+    Z[rows, cols] = values
+    return Z
+
+
+def _solved(M, X, rhs):
+    # a factorization of a (near) singular matrix gives non-finite or inaccurate solutions
+    if not np.all(np.isfinite(X)):
+        return False
+    return np.linalg.norm(M @ X - rhs) / np.linalg.norm(rhs) <= RESIDUAL_TOLERANCE
+
+
+def _block_solve(M, rhs):
+    """
+    Solve M X = rhs block by block along the strongly connected components of
+    the off-diagonal pattern of M, or return None if a block is singular
+
+    Permuted to the components, M is block triangular: rows of a component
+    only depend on the solutions of the components it has edges to. These are
+    solved first, so each component only needs a solve of its own diagonal
+    block. Components that become ready together are handled in one batch, and
+    the single-country ones (most of them) by a division.
+    """
+
+    M = sp.csr_matrix(M)
+    n = M.shape[0]
+    n_blocks, labels = connected_components(M, directed=True, connection="strong")
+
+    coo = M.tocoo()
+    between = labels[coo.row] != labels[coo.col]
+    dependencies = {block: set() for block in range(n_blocks)}
+    for block, dependency in set(zip(labels[coo.row[between]].tolist(), labels[coo.col[between]].tolist())):
+        dependencies[block].add(dependency)
+
+    members = np.split(np.argsort(labels, kind="stable"), np.cumsum(np.bincount(labels, minlength=n_blocks))[:-1])
+    diagonal = M.diagonal()
+    off_diagonal = (M - sp.diags(diagonal)).tocsr()
+
+    X = np.zeros((n, rhs.shape[1]))
+    order = TopologicalSorter(dependencies)
+    order.prepare()
+    while order.is_active():
+        ready = order.get_ready()
+        batch = np.concatenate([members[block] for block in ready])
+        # off-diagonal entries of a ready component only point to solved components
+        batch_rhs = rhs[batch] - off_diagonal[batch] @ X
+
+        single = np.array([len(members[block]) == 1 for block in ready])
+        if single.all():
+            if np.any(diagonal[batch] == 0):
+                return None
+            X[batch] = batch_rhs / diagonal[batch, None]
+        else:
+            offset = 0
+            for block in ready:
+                idx = members[block]
+                block_rhs = batch_rhs[offset:offset + len(idx)]
+                offset += len(idx)
+                try:
+                    X[idx] = np.linalg.solve(M[idx][:, idx].toarray(), block_rhs)
+                except np.linalg.LinAlgError:
+                    return None
+        order.done(*ready)
+
+    return X
+
+
+def _sparse_r_bar(rows, cols, values, p, consumers=None, producers=None, blocks=False):
+    n = len(p)
+    Z = sp.csc_matrix((values, (rows, cols)), shape=(n, n))
+
+    x = p + np.asarray(Z.sum(axis=1)).ravel()
+    with np.errstate(divide="ignore"):
+        one_over_x = np.where(x != 0, 1.0 / x, 0.0)
+    c = (x - np.asarray(Z.sum(axis=0)).ravel()) * one_over_x
+
+    M = (sp.identity(n, format="csc") - Z @ sp.diags(one_over_x)).tocsc()
+
+    # R = M^-1 diag(p): only the columns of producing countries are nonzero
+    if consumers is None and producers is None:
+        producers = np.flatnonzero(p)
+    elif producers is None:
+        producers = np.array([], dtype=int)
+    else:
+        producers = np.intersect1d(producers, np.flatnonzero(p))
+    if consumers is None:
+        consumers = np.array([], dtype=int)
+
+    R_bar = np.zeros((n, n))
+    if len(producers) == 0 and len(consumers) == 0:
+        return R_bar
+
+    if blocks:
+        solve = lambda rhs, trans="N": _block_solve(M.T if trans == "T" else M, rhs)
+    else:
+        try:
+            solve = splu(M).solve
+        except RuntimeError:
+            return None
+
+    if len(producers) > 0:
+        rhs = np.zeros((n, len(producers)))
+        rhs[producers, np.arange(len(producers))] = p[producers]
+        R = solve(rhs)
+        if R is None or not _solved(M, R, rhs):
+            return None
+        R_bar[:, producers] = c[:, None] * R
+
+    if len(consumers) > 0:
+        # row s of M^-1 solves M' y = e_s, so each requested consumer costs one transposed solve
+        rhs = np.zeros((n, len(consumers)))
+        rhs[consumers, np.arange(len(consumers))] = 1
+        Y = solve(rhs, trans="T")
+        if Y is None or not _solved(M.T, Y, rhs):
+            return None
+        R_bar[consumers, :] = c[consumers, None] * Y.T * p[None, :]
+
+    return R_bar
+
+
+def solve_mrio(rows, cols, values, p, solver="sparse", consumers=None, producers=None):
+    """
+    Solve one item's MRIO system
+
+    Args:
+        rows, cols, values: coordinates (consumer, producer) and values of the nonzero entries of Z
+        p: production per country
+        solver: "sparse", "scc" or "dense"
+        consumers, producers: optional indices of the consumer countries (rows)
+            and producer countries (columns) of R_bar that are needed. With the
+            sparse solver, rows cost one transposed solve per consumer and
+            columns one solve per producer, instead of solving for every producer
+
+    Returns:
+        (R_bar, path) where path is the method that produced R_bar:
+        "sparse_lu", "scc_blocks", or "pinv" for the dense solver and singular fallbacks.
+        If consumers or producers are given, all other entries of R_bar are zero.
+    """
+
+    if solver not in SOLVERS:
+        raise ValueError(f"solver must be one of {SOLVERS}")
+
+    if solver in ("sparse", "scc"):
+        R_bar = _sparse_r_bar(rows, cols, values, p, consumers, producers, blocks=solver == "scc")
+        if R_bar is not None:
+            return R_bar, "scc_blocks" if solver == "scc" else "sparse_lu"
+
+    R_bar = calculate_mrio_matrices(dense_z(rows, cols, values, len(p)), p)
+    if consumers is not None or producers is not None:
+        needed = np.zeros(R_bar.shape, dtype=bool)
+        if consumers is not None:
+            needed[consumers, :] = True
+        if producers is not None:
+            needed[:, producers] = True
+        R_bar[~needed] = 0
+    return R_bar, "pinv"
+
+
+def leontief_inverse(rows, cols, values, p):
+    """
+    Dense (I - A)^-1 of one item's MRIO system, from its sparse LU factorization
+    or the pseudo-inverse if I - A is singular
+
+    Returns:
+        ((I - A)^-1, path) with path "sparse_lu" or "pinv", as for solve_mrio()
+    """
+
+    n = len(p)
+    Z = sp.csc_matrix((values, (rows, cols)), shape=(n, n))
+    x = p + np.asarray(Z.sum(axis=1)).ravel()
+    with np.errstate(divide="ignore"):
+        one_over_x = np.where(x != 0, 1.0 / x, 0.0)
+    M = (sp.identity(n, format="csc") - Z @ sp.diags(one_over_x)).tocsc()
+
+    identity = np.eye(n)
+    try:
+        M_inverse = splu(M).solve(identity)
+        if _solved(M, M_inverse, identity):
+            return M_inverse, "sparse_lu"
+    except RuntimeError:
+        pass
+    return np.linalg.pinv(M.toarray()), "pinv"
+
+
+def _perturbed(values, cv, distribution, rng, n_draws):
+    # multiplicative, mean-preserving noise with coefficient of variation (about) cv
+    if cv == 0:
+        return np.broadcast_to(values, (n_draws, len(values)))
+    if distribution == "lognormal":
+        sigma = np.sqrt(np.log1p(cv**2))
+        return values * rng.lognormal(-sigma**2 / 2, sigma, (n_draws, len(values)))
+
+    # normal noise truncated at zero (negative draws are redrawn) and divided by its truncated mean
+    noise = rng.normal(1.0, cv, (n_draws, len(values)))
+    negative = noise < 0
+    while negative.any():
+        noise[negative] = rng.normal(1.0, cv, negative.sum())
+        negative = noise < 0
+    a = 1 / cv
+    truncated_mean = 1 + cv * math.exp(-a**2 / 2) / math.sqrt(2 * math.pi) / (0.5 * (1 + math.erf(a / math.sqrt(2))))
+    return values * noise / truncated_mean
+
+
+def _batch_r_bar(Z, p, producers):
+    # R_bar of a stack of systems, restricted to the producer columns
+    n = p.shape[1]
+    x = p + Z.sum(axis=2)
+    with np.errstate(divide="ignore"):
+        one_over_x = np.where(x != 0, 1.0 / x, 0.0)
+    c = (x - Z.sum(axis=1)) * one_over_x
+
+    M = np.eye(n) - Z * one_over_x[:, None, :]
+    rhs = np.zeros((len(p), n, len(producers)))
+    rhs[:, producers, np.arange(len(producers))] = p[:, producers]
+
+    try:
+        R = np.linalg.solve(M, rhs)
+    except np.linalg.LinAlgError:
+        R = None
+    if R is None or not np.all(np.isfinite(R)):
+        R = np.linalg.pinv(M) @ rhs
+
+    return c[:, :, None] * R
+
+
+def ensemble_memory(n, n_producers, n_draws=1000, batch_size=100):
+    """Estimated peak memory (bytes) of ensemble_r_bar() for an item with n countries"""
+    batch_size = min(batch_size, n_draws)
+    # the kept draws, plus one batch of perturbed systems, right-hand sides and solutions
+    return 8 * (n_draws * n * n_producers + batch_size * (3 * n * n + 4 * n * n_producers))
+
+
+def ensemble_r_bar(rows, cols, values, p, n_draws=1000, z_cv=0.1, p_cv=0.05, distribution="lognormal",
+                   quantiles=(0.05, 0.5, 0.95), rng=None, batch_size=100):
+    """
+    Monte-Carlo ensemble of one item's MRIO system
+
+    The nonzero entries of Z and the production p are perturbed independently
+    with multiplicative noise and every draw is solved; draws are stacked into
+    batches of batch_size and solved together with one batched LAPACK call,
+    falling back to the pseudo-inverse for batches with singular systems.
+    Perturbing Z or p changes A = Z diag(1/x), so every draw needs its own
+    factorization and the cost grows linearly with n_draws. The mean is summed
+    up batch by batch; the quantiles need every draw of the producer columns,
+    so these are kept (n_draws x n x len(producers) values, see
+    ensemble_memory()) and reduced a block of columns at a time.
+
+    Args:
+        rows, cols, values: coordinates (consumer, producer) and values of the nonzero entries of Z
+        p: production per country
+        n_draws: number of draws, at least 1
+        z_cv, p_cv: coefficient of variation of the trade flows and of production
+        distribution: error model, one of ERROR_MODELS
+        quantiles: quantiles of R_bar to return
+        rng: numpy Generator
+
+    Returns:
+        (producers, mean, quantile values) where producers are the indices of
+        the producing countries, mean is the (n x len(producers)) mean of R_bar
+        over those columns and quantile values is (len(quantiles) x n x len(producers));
+        all other columns of R_bar are zero
+    """
+
+    if distribution not in ERROR_MODELS:
+        raise ValueError(f"distribution must be one of {ERROR_MODELS}")
+    if n_draws < 1:
+        raise ValueError("n_draws must be at least 1")
+    if rng is None:
+        rng = np.random.default_rng()
+
+    n = len(p)
+    producers = np.flatnonzero(p)
+    k = len(producers)
+    if k == 0:
+        return producers, np.zeros((n, 0)), np.zeros((len(quantiles), n, 0))
+
+    draws = np.empty((n_draws, n, k))
+    total = np.zeros((n, k))
+    for start in range(0, n_draws, batch_size):
+        size = min(batch_size, n_draws - start)
+        Z = np.zeros((size, n, n))
+        Z[:, rows, cols] = _perturbed(values, z_cv, distribution, rng, size)
+        draws[start:start + size] = _batch_r_bar(Z, _perturbed(p, p_cv, distribution, rng, size), producers)
+        total += draws[start:start + size].sum(axis=0)
+
+    # np.quantile copies its input, so one block of columns at a time, about the size of a batch
+    quantile_values = np.empty((len(quantiles), n, k))
+    block = max(1, batch_size * k // n_draws)
+    for j in range(0, k, block):
+        quantile_values[:, :, j:j + block] = np.quantile(draws[:, :, j:j + block], quantiles, axis=0)
+
+    return producers, total / n_draws, quantile_values
@@ -0,0 +1,140 @@
+"""
+Partitioned CSV output for the large per-year result tables.
+
+TradeMatrixFeed_{prefer_import}_{conversion_opt}.csv is the largest artifact
+of the pipeline. Instead of one file built in memory and written at the end,
+it is written as one CSV per partition (consumer country) into a directory
+named after the file, as each partition is produced. A manifest.json, written
+last, lists the partitions, so readers only ever see complete outputs and can
+load just the partitions they need.
+
+read_partitioned_csv() takes the original file name and also reads outputs
+written as a single CSV by earlier versions.
+"""
+
+import json
+import os
+import shutil
+from pathlib import Path
+
+import pandas as pd
+
+MANIFEST = "manifest.json"
+
+
+def partition_dir(filename):
+    """Directory holding the partitions of filename (the file name without .csv)"""
+    filename = Path(filename)
+    return filename.with_name(filename.stem)
+
+
+class PartitionedCsvWriter:
+    """
+    Write a table partition by partition
+
+    Partitions are written into a temporary directory that replaces the
+    previous output when the writer is closed, together with the manifest.
+
+    Args:
+        filename: name of the table, e.g. results/2013/.mrio/TradeMatrixFeed_import_dry_matter.csv
+        partition_column: column the table is partitioned by
+        columns: columns of every partition, in order
+    """
+
+    def __init__(self, filename, partition_column, columns):
+        self.directory = partition_dir(filename)
+        self.tmp_directory = self.directory.with_name(f"{self.directory.name}.{os.getpid()}.tmp")
+        self.partition_column = partition_column
+        self.columns = list(columns)
+        self.partitions = []
+
+        if self.tmp_directory.exists():
+            shutil.rmtree(self.tmp_directory)
+        self.tmp_directory.mkdir(parents=True)
+
+    def write(self, key, frame):
+        """Write the rows of one partition"""
+        file_name = f"part-{key}.csv"
+        frame[self.columns].to_csv(self.tmp_directory / file_name, index=False)
+        self.partitions.append({"key": key, "file": file_name, "rows": len(frame)})
+
+    def close(self):
+        with open(self.tmp_directory / MANIFEST, "w") as f:
+            json.dump({
+                "partition_column": self.partition_column,
+                "columns": self.columns,
+                "partitions": self.partitions}, f, indent=1)
+
+        if self.directory.exists():
+            shutil.rmtree(self.directory)
+        self.tmp_directory.rename(self.directory)
+
+    def abort(self):
+        """Discard the partitions written so far, keeping the previous output"""
+        shutil.rmtree(self.tmp_directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def read_manifest(filename):
+    """Manifest of a partitioned table, or None if it was written as a single CSV"""
+    manifest_file = partition_dir(filename) / MANIFEST
+    if not manifest_file.exists():
+        return None
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def iter_partitions(filename, partitions=None, partition_column="Consumer_Country_Code", **kwargs):
+    """
+    Yield (key, frame) for the partitions of a table, all of them or those in partitions
+
+    kwargs are passed to pd.read_csv(). A table written as a single CSV is
+    yielded as one partition with key None, filtered on partition_column.
+    """
+
+    manifest = read_manifest(filename)
+    if manifest is None:
+        if not Path(filename).exists():
+            raise FileNotFoundError(f"Partitioned table not found: {filename}")
+        data = pd.read_csv(filename, **kwargs)
+        if partitions is not None:
+            data = data[data[partition_column].isin(partitions)]
+        yield None, data
+        return
+
+    wanted = None if partitions is None else set(partitions)
+    directory = partition_dir(filename)
+    for partition in manifest["partitions"]:
+        if wanted is None or partition["key"] in wanted:
+            yield partition["key"], pd.read_csv(directory / partition["file"], **kwargs)
+
+
+def read_partitioned_csv(filename, partitions=None, partition_column="Consumer_Country_Code", **kwargs):
+    """
+    Read a table written by PartitionedCsvWriter, or a single CSV
+
+    Args:
+        filename: name of the table as passed to the writer
+        partitions: optional partition keys (e.g. consumer country codes) to read, all if None
+        partition_column: column to filter a single CSV on
+        **kwargs: passed to pd.read_csv()
+    """
+
+    frames = [frame for _, frame in iter_partitions(filename, partitions, partition_column, **kwargs)]
+    if not frames:
+        manifest = read_manifest(filename)
+        return pd.DataFrame(columns=manifest["columns"])
+    return pd.concat(frames, ignore_index=True)
+
+
+def table_exists(filename):
+    """Whether a table exists, partitioned or as a single CSV"""
+    return read_manifest(filename) is not None or Path(filename).exists()
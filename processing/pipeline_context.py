@@ -0,0 +1,133 @@
+"""
+Shared in-memory data for one pipeline run.
+
+Every stage used to reload the reference tables and the FAOSTAT data it needs,
+for every year and (in the provenance stage) for every country. A single
+PipelineContext is built in main.main() and passed to every stage; it loads
+each table and per-year FAOSTAT slice lazily the first time it is requested
+and serves copies of it afterwards. Cached entries are evicted, least recently
+used first, once their combined size exceeds the memory budget.
+"""
+
+import warnings
+from collections import OrderedDict
+from pathlib import Path
+
+import pandas as pd
+
+from processing.convert_data import load_faostat
+from processing.excel_cache import read_excel_cached
+
+REFERENCE_TABLES = {
+    "item_map": ("primary_item_map_feed.csv", {"encoding": "latin-1"}),
+    "content_factors": ("content_factors_per_100g.xlsx", {"skiprows": 1}),
+    "reporting_dates": ("Reporting_Dates.xls", {}),
+    "area_codes": ("nocsDataExport_20251021-164754.xlsx", {}),
+    "weighing_factors": ("weighing_factors.csv", {"encoding": "latin-1"}),
+    "cb_map": ("CB_to_primary_items_map.csv", {"encoding": "latin-1"}),
+    "cb_split": ("CB_items_split.csv", {"encoding": "latin-1"}),
+    "cb_conversion_map": ("CB_code_FAO_code_for_conversion_factors.csv", {"encoding": "latin-1"}),
+    "item_codes": ("SUA_Crops_Livestock_E_ItemCodes.csv", {"encoding": "latin-1"}),
+    "crop_db": ("crop_db.csv", {}),
+    "schwarzmueller_wwf": ("schwarzmueller_wwf.csv", {"index_col": 0}),
+    "pasture_factors": ("tb_pasture_factors_2.csv", {"index_col": 0}),
+    "opp_cost": ("country_opp_cost_v6.csv", {"index_col": 0}),
+    "composition_old_vs_new": ("composition_old_vs_new.csv", {}),
+}
+
+
+def _frame_size(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum())
+    return 0
+
+
+class PipelineContext:
+    """
+    Lazily loaded, memoised reference tables and FAOSTAT slices for one pipeline run
+
+    Args:
+        input_dir: directory holding the input data
+        memory_budget_gb: combined size of cached entries above which the least
+            recently used entries are evicted
+    """
+
+    def __init__(self, input_dir="./input_data", memory_budget_gb=8.0):
+        self.input_dir = input_dir
+        self.memory_budget = int(memory_budget_gb * 1024**3)
+        self._cache = OrderedDict()
+        self._sizes = {}
+        self.cached_bytes = 0
+
+    def get(self, key, loader):
+        """Return the cached value for key, calling loader() to create it on a miss"""
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        value = loader()
+        size = _frame_size(value)
+        if size > self.memory_budget:
+            return value
+
+        while self._cache and self.cached_bytes + size > self.memory_budget:
+            self._evict()
+        self._cache[key] = value
+        self._sizes[key] = size
+        self.cached_bytes += size
+        return value
+
+    def _evict(self):
+        key, _ = self._cache.popitem(last=False)
+        self.cached_bytes -= self._sizes.pop(key)
+
+    def clear(self):
+        self._cache.clear()
+        self._sizes.clear()
+        self.cached_bytes = 0
+
+    def _read_table(self, name):
+        filename, kwargs = REFERENCE_TABLES[name]
+        file_path = Path(self.input_dir) / filename
+        if file_path.suffix in (".xls", ".xlsx"):
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                return read_excel_cached(file_path, **kwargs)
+        return pd.read_csv(file_path, **kwargs)
+
+    def table(self, name):
+        """Copy of one of the REFERENCE_TABLES"""
+        return self.get(("table", name), lambda: self._read_table(name)).copy()
+
+    def faostat(self, dataset, years, columns=None, elements=None):
+        """
+        Copy of a FAOSTAT dataset restricted to years, columns and elements
+        Slices are cached per year, so multi-year requests reuse single years;
+        the years not cached yet are loaded in one pass over the dataset
+        """
+        columns = None if columns is None else tuple(columns)
+        elements = None if elements is None else tuple(int(e) for e in elements)
+        years = [int(year) for year in years]
+        keys = {year: ("faostat", dataset, year, columns, elements) for year in years}
+
+        # take the cached years first, caching the loaded ones may evict them
+        slices = {year: self._cache[keys[year]] for year in dict.fromkeys(years) if keys[year] in self._cache}
+        for year in slices:
+            self._cache.move_to_end(keys[year])
+
+        missing = [year for year in dict.fromkeys(years) if year not in slices]
+        if missing:
+            # the Year column is needed to split the slices, even if not requested
+            load_columns = None if columns is None else list(dict.fromkeys(columns + ("Year",)))
+            data = load_faostat(dataset, years=missing, columns=load_columns, elements=elements, path=self.input_dir)
+            year_rows = data.groupby("Year").indices
+            for year in missing:
+                part = data.iloc[year_rows.get(year, [])].reset_index(drop=True)
+                part = part if columns is None or "Year" in columns else part.drop(columns=["Year"])
+                slices[year] = self.get(keys[year], lambda part=part: part)
+
+        frames = [slices[year] for year in years]
+
+        if len(frames) > 1:
+            return pd.concat(frames, ignore_index=True)
+        return frames[0].copy()
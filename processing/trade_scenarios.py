@@ -0,0 +1,197 @@
+"""
+What-if trade scenarios on the per-item MRIO systems.
+
+A scenario is a sparse set of edits to one item's bilateral trade Z and
+production p, e.g. "exporter X halts wheat exports" or "the flow from Y to W
+doubles". Rerunning the trade matrix calculation for every scenario repeats
+the whole solve; instead, ScenarioBaseline keeps (I - A)^-1 of the baseline
+system and applies each scenario as a low-rank update (Sherman-Morrison-
+Woodbury).
+
+Editing Z[i, j] changes column j of A = Z diag(1/x) and, through x_i, all of
+column i; editing p_i changes column i as well. With C the k changed columns,
+
+    (I - A')   = (I - A) + U E_C'           U = -(A' - A)[:, C]
+    (I - A')^-1 = (I - A)^-1 - W S^-1 (I - A)^-1[C, :]
+                  W = (I - A)^-1 U,   S = I_k + (I - A)^-1[C, :] U
+
+so a scenario costs O(n^2 k) instead of a new factorization. Scenarios whose
+update is (near) singular, and all scenarios of a baseline whose I - A is
+singular (solved with the pseudo-inverse), are solved directly.
+"""
+
+import numpy as np
+import pandas as pd
+
+from processing.calculate_trade_matrix import year_item_systems
+from processing.mrio_solver import dense_z, leontief_inverse, solve_mrio
+
+# condition number of S, relative to the identity it updates, above which a
+# scenario is solved directly instead
+CONDITION_LIMIT = 1e12
+
+
+def _one_over(x):
+    with np.errstate(divide="ignore"):
+        return np.where(x != 0, 1.0 / x, 0.0)
+
+
+class ScenarioBaseline:
+    """
+    Baseline MRIO system of one (Year, primary_item) and its (I - A)^-1
+
+    Args:
+        year, item_code, countries, rows, cols, values, p: one system from build_item_systems()
+    """
+
+    def __init__(self, year, item_code, countries, rows, cols, values, p):
+        self.year = year
+        self.item_code = item_code
+        self.countries = countries
+        self.index = {code: i for i, code in enumerate(countries.tolist())}
+
+        self.Z = dense_z(rows, cols, values, len(p))
+        self.p = np.asarray(p, dtype=float)
+        self.x = self.p + self.Z.sum(axis=1)
+        self.one_over_x = _one_over(self.x)
+        self.A = self.Z * self.one_over_x[None, :]
+
+        self.M_inverse, self.path = leontief_inverse(rows, cols, values, self.p)
+        self.r_bar = self._r_bar(self.M_inverse, self.Z, self.p, self.x, self.one_over_x)
+
+    @staticmethod
+    def _r_bar(M_inverse, Z, p, x, one_over_x):
+        c = (x - Z.sum(axis=0)) * one_over_x
+        return c[:, None] * M_inverse * p[None, :]
+
+    def _country(self, code):
+        try:
+            return self.index[code]
+        except KeyError:
+            raise ValueError(f"country {code} is not part of the system of item {self.item_code} in {self.year}") from None
+
+    def flow_edits(self, consumer=None, producer=None, factor=0.0):
+        """
+        Z edits scaling the baseline flows from producer to consumer by factor,
+        e.g. flow_edits(producer=X) halts all exports of X and
+        flow_edits(consumer=Y, producer=W, factor=2) doubles one flow
+
+        Returns:
+            dict of (consumer code, producer code) -> new value
+        """
+
+        mask = self.Z != 0
+        if consumer is not None:
+            mask[np.arange(len(self.p)) != self._country(consumer), :] = False
+        if producer is not None:
+            mask[:, np.arange(len(self.p)) != self._country(producer)] = False
+        rows, cols = np.nonzero(mask)
+        return {
+            (self.countries[i], self.countries[j]): self.Z[i, j] * factor
+            for i, j in zip(rows, cols)}
+
+    def edited(self, z_edits=None, p_edits=None):
+        """Z and p of the baseline with the edits applied"""
+        Z = self.Z.copy()
+        p = self.p.copy()
+        for (consumer, producer), value in (z_edits or {}).items():
+            Z[self._country(consumer), self._country(producer)] = value
+        for country, value in (p_edits or {}).items():
+            p[self._country(country)] = value
+        return Z, p
+
+    def apply(self, z_edits=None, p_edits=None):
+        """
+        R_bar of one scenario by a rank-k update of the baseline
+
+        Args:
+            z_edits: dict of (consumer code, producer code) -> new value of Z
+            p_edits: dict of country code -> new production
+
+        Returns:
+            (R_bar, R_bar - baseline R_bar) as dense (n x n) arrays indexed like countries
+        """
+
+        Z, p = self.edited(z_edits, p_edits)
+        x = p + Z.sum(axis=1)
+        one_over_x = _one_over(x)
+
+        changed = np.flatnonzero((Z != self.Z).any(axis=0) | (one_over_x != self.one_over_x))
+        if len(changed) == 0:
+            R_bar = self._r_bar(self.M_inverse, Z, p, x, one_over_x)
+            return R_bar, R_bar - self.r_bar
+
+        # the update identity only holds for a true inverse, not for the
+        # pseudo-inverse of a singular baseline
+        if self.path == "pinv":
+            R_bar = self._solve(Z, p)
+            return R_bar, R_bar - self.r_bar
+
+        U = self.A[:, changed] - Z[:, changed] * one_over_x[None, changed]
+        W = self.M_inverse @ U
+        M_inverse_rows = self.M_inverse[changed, :]
+        S = np.eye(len(changed)) + M_inverse_rows @ U
+
+        # the plain condition number of a 1 x 1 S is always 1, so compare its
+        # smallest singular value with the scale of I as well
+        singular_values = np.linalg.svd(S, compute_uv=False)
+        if singular_values[-1] * CONDITION_LIMIT < max(singular_values[0], 1.0):
+            R_bar = self._solve(Z, p)
+        else:
+            M_inverse = self.M_inverse - W @ np.linalg.solve(S, M_inverse_rows)
+            R_bar = self._r_bar(M_inverse, Z, p, x, one_over_x)
+        return R_bar, R_bar - self.r_bar
+
+    @staticmethod
+    def _solve(Z, p):
+        # direct solve of an edited system
+        rows, cols = np.nonzero(Z)
+        R_bar, _ = solve_mrio(rows, cols, Z[rows, cols], p)
+        return R_bar
+
+    def frame(self, R_bar, min_value=0.0):
+        """Long table of the entries of R_bar whose magnitude exceeds min_value"""
+        i_indices, j_indices = np.nonzero(np.abs(R_bar) > min_value)
+        return pd.DataFrame({
+            "Consumer_Country_Code": self.countries[i_indices],
+            "Producer_Country_Code": self.countries[j_indices],
+            "Item_Code": self.item_code,
+            "Year": self.year,
+            "Value": R_bar[i_indices, j_indices]})
+
+
+def scenario_baselines(
+        item_codes=None,
+        conversion_opt="dry_matter",
+        prefer_import="import",
+        year=2013,
+        historic="Historic",
+        context=None):
+    """
+    ScenarioBaseline of every item of one year, or of item_codes only
+
+    Returns:
+        dict of item code -> ScenarioBaseline
+    """
+
+    item_systems, _ = year_item_systems(conversion_opt, prefer_import, year, historic, context)
+    return {
+        item_code: ScenarioBaseline(year, item_code, *system)
+        for year, item_code, *system in item_systems
+        if item_codes is None or item_code in item_codes}
+
+
+def run_scenarios(baseline, scenarios):
+    """
+    Apply many scenarios to one baseline
+
+    Args:
+        baseline: ScenarioBaseline
+        scenarios: iterable of dicts with optional "Z" and "p" edits, as for ScenarioBaseline.apply()
+
+    Yields:
+        (R_bar, R_bar - baseline R_bar) per scenario
+    """
+
+    for scenario in scenarios:
+        yield baseline.apply(scenario.get("Z"), scenario.get("p"))
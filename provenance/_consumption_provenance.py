@@ -8,6 +8,9 @@ import pandas as pd
 import numpy as np
 import os
 import time
+
+from processing.partitioned_csv import read_partitioned_csv
+from processing.pipeline_context import PipelineContext
     
 
 
@@ -59,66 +62,33 @@ def calculate_conversion_factors(conversion_opt, content_factors, item_map_for_c
         return conversion_factors
 
 
-def main(year, country_of_interest, sua, historic=""):
-
-    
-    datPath = "./input_data"
-    trade_feed = f"./results/{year}/.mrio/TradeMatrixFeed_import_dry_matter.csv"
-    trade_nofeed = f"./results/{year}/.mrio/TradeMatrix_import_dry_matter.csv"
-
-    item_codes = pd.read_csv(f"{datPath}/SUA_Crops_Livestock_E_ItemCodes.csv", encoding = "latin-1", low_memory=False)
-
-    import warnings
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        area_codes = pd.read_excel(f"{datPath}/nocsDataExport_20251021-164754.xlsx", engine="openpyxl")  
-        factors = pd.read_excel(f"{datPath}/content_factors_per_100g.xlsx", skiprows=1, engine="openpyxl")
-
-    item_map = pd.read_csv(f"{datPath}/primary_item_map_feed.csv", encoding = "latin-1")
-    weighing_factors = pd.read_csv(f"{datPath}/weighing_factors.csv", encoding = "latin-1")
-    prov_mat_no_feed = pd.read_csv(trade_nofeed)
-    prov_mat_feed = pd.read_csv(trade_feed)
-
-    coi_code = area_codes[area_codes["ISO3"] == country_of_interest]["FAOSTAT"].values[0]
-
-    item_codes.columns = [_.strip() for _ in item_codes.columns]
-    add_palestine = pd.DataFrame({"ISO3":["PSE"], "FAOSTAT":[299]})
-    area_codes = pd.concat([area_codes, add_palestine], ignore_index=True)
-    ic = item_codes.rename(columns={"CPC Code":"Item Code (CPC)", "Item Code":"FAO_code", "Item":"item_name"})
-    ic["Item Code (CPC)"] = ic["Item Code (CPC)"].astype("string")
+def food_supply(sua, coi_codes, year, historic, ic, context):
+    """Food supply quantities (tonnes) of the countries with FAOSTAT codes coi_codes, keyed by Area Code"""
 
+    sua = sua[(sua["Area Code"].isin(coi_codes))&(sua.Year == year)]
 
-    sua = sua[(sua["Area Code"]==coi_code)&(sua.Year == year)]
-    
     if historic == "":
-        sugar_cane = sua[(sua["Item Code"]==156)]
-        sugar_beet = sua[(sua["Item Code"]==157)]
-        palm_oil = sua[(sua["Item Code"]==257)]
-        for sugar in [sugar_cane, sugar_beet, palm_oil]:
-            sugar_p = sugar[sugar["Element"]=="Production"].Value.sum()
-            sugar_i = sugar[sugar["Element"]=="Import quantity"].Value.sum()
-            sugar_e = sugar[sugar["Element"]=="Export quantity"].Value.sum()
-            sugar_l = sugar[sugar["Element"]=="Loss"].Value.sum()
-            sugar_val = np.max([sugar_p + sugar_i - sugar_e - sugar_l, 0])
-            new_entry = sugar.iloc[0].copy()
-            new_entry['Element Code'] = 5141
-            new_entry['Element'] = "Food supply quantity (tonnes)"
-            new_entry['Value'] = sugar_val
-            sua = pd.concat([sua, new_entry.to_frame().T], ignore_index=True)
-        # print(sua[sua["Item Code"].isin([156,157])])
+        # sugar crops and palm oil get a food supply entry from their balance
+        sugar = sua[sua["Item Code"].isin([156, 157, 257])]
+        sugar_keys = [sugar["Area Code"], sugar["Item Code"]]
+        sign = sugar["Element"].map({"Production": 1, "Import quantity": 1, "Export quantity": -1, "Loss": -1})
+        sugar_val = (sugar["Value"].astype(float) * sign).groupby(sugar_keys).sum().clip(lower=0)
+        new_entries = sugar.groupby(sugar_keys).head(1).copy()
+        new_entries['Element Code'] = 5141
+        new_entries['Element'] = "Food supply quantity (tonnes)"
+        new_entries['Value'] = sugar_val.reindex(pd.MultiIndex.from_frame(new_entries[["Area Code", "Item Code"]])).values
+        sua = pd.concat([sua, new_entries], ignore_index=True)
+
         fs = sua[sua["Element Code"]==5141].copy()
-        t0 = time.perf_counter()
         fs["Item Code (CPC)"] = fs["Item Code (CPC)"].astype("string")
-        t1 = time.perf_counter()
-        # print(f"         Converted Item Code to string in {t1 - t0:.2f} seconds")
         fs = fs.merge(ic, on="Item Code (CPC)", how="left") 
         fs = fs.drop(columns=["Note"])
 
     else:
-        population = sua[(sua["Element Code"]==511)].Value.values[0]
+        population = sua[(sua["Element Code"]==511)].groupby("Area Code").Value.first()
         fs = sua[sua["Element Code"]==645].copy()
-        fs["Value"] = fs["Value"] * population  # convert kg/capita/yr to tonnes by multiplying by population
-        cb_conversion_map = pd.read_csv("./input_data/CB_code_FAO_code_for_conversion_factors.csv", encoding="Latin-1")
+        fs["Value"] = fs["Value"] * fs["Area Code"].map(population)  # convert kg/capita/yr to tonnes by multiplying by population
+        cb_conversion_map = context.table("cb_conversion_map")
         fs = fs.merge(
             cb_conversion_map[["FAO_code", "CB_code"]],
             left_on="Item Code",
@@ -128,97 +98,129 @@ def main(year, country_of_interest, sua, historic=""):
         fs.drop(columns=["CB_code"], inplace=True)
         fs = fs.merge(ic[["FAO_code", "item_name"]], on="FAO_code", how="left")
 
-    if len(fs) == 0:
-        print(f"         No food supply data for ({area_codes[area_codes["ISO3"] == country_of_interest]["LIST NAME"].values[0]}) in  {year}")
-        return pd.DataFrame(), pd.DataFrame()
+    return fs
 
 
-    country_savefile_path = f"./results/{year}/{country_of_interest}"
-    if not os.path.isdir(country_savefile_path):
-        os.makedirs(country_savefile_path)   
+def feed_partitions(trade_feed, trade_matrix_feed, consumers):
+    """
+    Rows of TradeMatrixFeed of the consumer countries consumers, from the partitions
+    passed on in memory (dict of consumer code -> frame) or read from trade_feed
+    """
+    if trade_matrix_feed is None:
+        feed = read_partitioned_csv(trade_feed, partitions=consumers)
+    else:
+        frames = [trade_matrix_feed[consumer] for consumer in consumers if consumer in trade_matrix_feed]
+        if frames:
+            feed = pd.concat(frames, ignore_index=True)
+        else:
+            feed = pd.DataFrame(columns=["Year", "Producer_Country_Code", "Consumer_Country_Code", "Item_Code", "Value", "Animal_Product_Code"])
+    # no partitions leave untyped (object) columns, which do not merge with numeric keys
+    return feed.astype(float) if len(feed) == 0 else feed
 
 
+def consumption_provenance_all(year, countries, sua, historic="", context=None, trade_matrix=None, trade_matrix_feed=None):
+    """
+    Provenance of the human consumed and feed items of every country in countries
 
-    
+    Every input is loaded once and all countries are computed together, grouped
+    by consumer country. Each country's results are written to
+    results/{year}/{country}/human_consumed.csv and feed.csv.
+    Only the partitions of TradeMatrixFeed that are needed are read, from
+    trade_matrix_feed if passed on in memory by animal_products_to_feed(collect=True).
 
-    # ERROR CALCULATION - commented out for now
-    # fs = fs[(fs.Year <= year+2) & (fs.Year >= year-2)]
-    # fserr = fserr[(fserr.Year <= year+2) & (fserr.Year >= year-2)]
+    Returns:
+        dict of ISO3 -> (cons_prov, feed_prov), two empty frames for countries without food supply data
+    """
+
+    datPath = "./input_data"
+    if context is None:
+        context = PipelineContext(datPath)
+    trade_feed = f"./results/{year}/.mrio/TradeMatrixFeed_import_dry_matter.csv"
+    trade_nofeed = f"./results/{year}/.mrio/TradeMatrix_import_dry_matter.csv"
 
-    # means = fs.groupby(["Item", "Item Code"]).Value.mean().reset_index()
-    # errs = fs.groupby(["Item", "Item Code"]).Value.sem().reset_index() # no groupings so this is just zero
+    item_codes = context.table("item_codes")
+    area_codes = context.table("area_codes")
+    factors = context.table("content_factors")
+    item_map = context.table("item_map")
+    weighing_factors = context.table("weighing_factors")
+    # the trade matrices of the earlier stages, when passed on in memory
+    prov_mat_no_feed = pd.read_csv(trade_nofeed) if trade_matrix is None else trade_matrix
 
-    # for item in means.Item:
-    #     fs.loc[fs.Item == item, "Value"] = means[means.Item==item].Value.values[0]
-    #     fserr.loc[fserr.Item == item, "Value"] = errs[errs.Item==item].Value.values[0]
+    coi_codes = {country: area_codes[area_codes["ISO3"] == country]["FAOSTAT"].values[0] for country in countries}
 
-    
+    item_codes.columns = [_.strip() for _ in item_codes.columns]
+    add_palestine = pd.DataFrame({"ISO3":["PSE"], "FAOSTAT":[299]})
+    area_codes = pd.concat([area_codes, add_palestine], ignore_index=True)
+    ic = item_codes.rename(columns={"CPC Code":"Item Code (CPC)", "Item Code":"FAO_code", "Item":"item_name"})
+    ic["Item Code (CPC)"] = ic["Item Code (CPC)"].astype("string")
 
-    
+    fs = food_supply(sua, list(coi_codes.values()), year, historic, ic, context)
+    fs = fs.rename(columns={"Area Code": "Consumer_Country_Code"})
 
+    supplied = set(fs["Consumer_Country_Code"])
+    for country, coi_code in coi_codes.items():
+        if coi_code not in supplied:
+            name = area_codes.loc[area_codes.ISO3 == country, "LIST NAME"].values[0]
+            print(f'         No food supply data for ({name}) in  {year}')
+    codes = [coi_code for coi_code in coi_codes.values() if coi_code in supplied]
 
     fserr = fs.copy()
 
-    imports_feed = prov_mat_feed[prov_mat_feed.Consumer_Country_Code == coi_code]
+    imports_feed = feed_partitions(trade_feed, trade_matrix_feed, codes)
     imports_feed = add_cols(imports_feed, area_codes=area_codes, item_codes=item_codes)
     imports_feed = imports_feed[~imports_feed.Item.isna()]   
-    imports_feed_crops = imports_feed[(imports_feed.Animal_Product.isna()) & (imports_feed.Value >= 0)]
-    imports_feed_crops.loc[:, 'Animal_Product'] = ""
-
-    imports_no_feed = prov_mat_no_feed[prov_mat_no_feed.Consumer_Country_Code == coi_code]
+    imports_feed_crops = imports_feed[(imports_feed.Animal_Product.isna()) & (imports_feed.Value >= 0)].copy()
+    imports_feed_crops['Animal_Product'] = ""
+
+    # animal products imported by a country that it also has feed provenance for
+    fed_products = (imports_feed[["Consumer_Country_Code", "Animal_Product_Code"]]
+        .dropna()
+        .drop_duplicates()
+        .astype({"Animal_Product_Code": int})
+        .rename(columns={"Animal_Product_Code": "Item_Code"}))
+    imports_no_feed = prov_mat_no_feed[prov_mat_no_feed.Consumer_Country_Code.isin(codes)]
     imports_no_feed = add_cols(imports_no_feed, area_codes=area_codes, item_codes=item_codes)
     imports_no_feed = imports_no_feed[~imports_no_feed.Item.isna()]
-    imports_no_feed = imports_no_feed[imports_no_feed.Item_Code.isin(imports_feed.Animal_Product_Code.unique())]
-    imports_no_feed.loc[:, 'Animal_Product'] = "Primary"
+    imports_no_feed = imports_no_feed.merge(fed_products, on=["Consumer_Country_Code", "Item_Code"])
+    imports_no_feed['Animal_Product'] = "Primary"
 
-    imports_total = pd.concat([imports_feed_crops, imports_no_feed])
+    imports_total = pd.concat([imports_feed_crops, imports_no_feed], ignore_index=True)
 
+    ratio_keys = ["Consumer_Country_Code", "Item_Code", "Animal_Product"]
     human_consumed_import_ratios = (imports_total
-        .groupby(["Item_Code", "Animal_Product"])[imports_total.columns]
-        .apply(lambda x: x.assign(Ratio=x["Value"] / x["Value"].sum()))
-        .reset_index(drop=True)
+        .assign(Ratio=imports_total["Value"] / imports_total.groupby(ratio_keys)["Value"].transform("sum"))
         .drop(columns=["Value"]))
     
     human_consumed_import_ratios.loc[human_consumed_import_ratios.Animal_Product=="", "Animal_Product"] = np.nan
 
 
 
-    df_hc, df_hc_err = fs.copy(), fserr.copy() # TODO remove copy
     cf = calculate_conversion_factors("dry_matter", factors.copy(), item_map.copy())
-    df_hc = df_hc.merge(cf, on="FAO_code", how="left")
-    df_hc_err = df_hc_err.merge(cf, on="FAO_code", how="left")
-    df_hc=df_hc[df_hc["ratio"]!=0]
-
-    df_hc.dropna(subset=["ratio"], inplace=True)
+    df_hc = fs.merge(cf, on="FAO_code", how="left")
+    df_hc_err = fserr.merge(cf, on="FAO_code", how="left")
+    df_hc = df_hc[df_hc["ratio"]!=0].dropna(subset=["ratio"])
     
-    df_hc["value_primary"] = df_hc.Value / df_hc.ratio
-    df_hc_err["value_primary_err"] = df_hc_err["Value"]**2
+    df_hc["value_primary"] = df_hc.Value.astype(float) / df_hc.ratio
+    df_hc_err["value_primary_err"] = df_hc_err["Value"].astype(float)**2
 
 
+    primary_keys = ["Consumer_Country_Code", "primary_item_code"]
     primary_consumption = (df_hc
-        .groupby(["primary_item_code"])[df_hc.columns]
-        .apply(lambda x: x.assign(value_primary=x["value_primary"].sum()))
-        .reset_index(drop=True)
-        [['primary_item_code', 'value_primary']]
-        .drop_duplicates(subset=["primary_item_code"])
+        .groupby(primary_keys, as_index=False)["value_primary"].sum()
         .merge(
             item_codes[["Item Code", "Item"]].rename(columns={"Item Code":"primary_item_code", "Item":"item_name"}),
             on="primary_item_code",
             how="left"))
         
-    df_hc_err = (df_hc_err
-        .groupby(["primary_item_code"])[df_hc_err.columns]
-        .apply(lambda x: x.assign(value_primary_err=np.sqrt(x["value_primary_err"].sum())))
-        .reset_index(drop=True)
-        [['primary_item_code', 'value_primary_err']]
-        .drop_duplicates(subset=["primary_item_code"]))
-    primary_consumption = primary_consumption.merge(df_hc_err, on="primary_item_code", how="left")
+    df_hc_err = np.sqrt(df_hc_err.groupby(primary_keys)["value_primary_err"].sum()).reset_index()
+    primary_consumption = primary_consumption.merge(df_hc_err, on=primary_keys, how="left")
 
     
-    # print("         Calculating human consumed provenance")
     cons_prov = (human_consumed_import_ratios
-        .merge(primary_consumption, left_on="Item_Code", right_on="primary_item_code", how="left")
-        .drop(columns=["primary_item_code", "item_name"]))
+        .merge(
+            primary_consumption.rename(columns={"primary_item_code": "Item_Code"}).drop(columns=["item_name"]),
+            on=["Consumer_Country_Code", "Item_Code"],
+            how="left"))
     cons_prov["provenance"] = cons_prov["Ratio"] * cons_prov["value_primary"]
     cons_prov["provenance_err"] = cons_prov.provenance * np.sqrt(1+(cons_prov.value_primary_err/cons_prov.value_primary)**2)
     cons_prov = (cons_prov
@@ -229,8 +231,6 @@ def main(year, country_of_interest, sua, historic=""):
 
     # provenance of feed
     ##################################################
-    # print("         Calculating feed provenance")
-
 
     primary_consumption_anim = primary_consumption[primary_consumption.primary_item_code.isin(weighing_factors.Item_Code)]   
 
@@ -239,39 +239,67 @@ def main(year, country_of_interest, sua, historic=""):
     primary_consumption_anim['value_primary_err'] = primary_consumption_anim['value_primary_err'] * primary_consumption_anim['Weighing factors']
     primary_consumption_anim = primary_consumption_anim[primary_consumption_anim['Weighing factors'] > 0]
     primary_consumption_anim = primary_consumption_anim.drop(columns=["Item_Code", "Item", "Weighing factors"])
-    
-    prov_mat_feed.loc[prov_mat_feed["Animal_Product_Code"].isna(), "Animal_Product_Code"] = 0
-    prov_mat_feed = prov_mat_feed[~(prov_mat_feed.Value.isna())&(prov_mat_feed.Value > 0)]
-    prov_mat_feed = (prov_mat_feed
-        .groupby(["Animal_Product_Code", "Consumer_Country_Code"])[prov_mat_feed.columns]
-        .apply(lambda x: x.assign(prov_ratio=x["Value"] / x["Value"].sum()))
-        .reset_index(drop=True))
-    prov_mat_feed.loc[prov_mat_feed["Animal_Product_Code"]==0, "Animal_Product_Code"] = np.nan
 
-    ##################################################
-
-    animal_codes = primary_consumption_anim.primary_item_code.unique()
-    sc2 = human_consumed_import_ratios[human_consumed_import_ratios.Item_Code.isin(animal_codes)]
-    sc2 = sc2.merge(primary_consumption_anim, left_on="Item_Code", right_on="primary_item_code", how="left")
+    # consumption of animal products by origin; the feed of each origin is
+    # found in the feed trade matrix under Consumer_Country_Code = the origin
+    sc2 = human_consumed_import_ratios.merge(
+        primary_consumption_anim,
+        left_on=["Consumer_Country_Code", "Item_Code"],
+        right_on=["Consumer_Country_Code", "primary_item_code"])
     sc2["cVal"] = sc2["Ratio"] * sc2["value_primary"]
     sc2["cVal_err"] = sc2["Ratio"] * sc2["value_primary_err"]
-    sc2["valid"] = sc2.Item_Code.astype(int).astype(str) +"-"+ sc2.Producer_Country_Code.astype(int).astype(str)
     sc2["Animal_Product"] = sc2.item_name
-    sc2 = sc2[["valid", "cVal", "cVal_err", "Animal_Product"]]
-    prov_mat_feed = prov_mat_feed[~prov_mat_feed.Animal_Product_Code.isna()]
-    prov_mat_feed["valid"] = prov_mat_feed.Animal_Product_Code.astype(int).astype(str) + "-" + prov_mat_feed.Consumer_Country_Code.astype(str)
-    dfx = prov_mat_feed[prov_mat_feed["valid"].isin(sc2["valid"])]
-    dfx = dfx.merge(sc2, on="valid", how="left")
+    sc2 = pd.DataFrame({
+        "coi_code": sc2.Consumer_Country_Code,
+        "Animal_Product_Code": sc2.Item_Code.astype(int).astype(float),
+        "Consumer_Country_Code": sc2.Producer_Country_Code.astype(int),
+        "cVal": sc2.cVal,
+        "cVal_err": sc2.cVal_err,
+        "Animal_Product": sc2.Animal_Product})
+
+    # share of each feed origin in the feed of an animal product and country,
+    # only for the animal products and countries consumed from
+    feed_keys = ["Animal_Product_Code", "Consumer_Country_Code"]
+    prov_mat_feed = feed_partitions(trade_feed, trade_matrix_feed, sorted(sc2.Consumer_Country_Code.unique()))
+    prov_mat_feed = prov_mat_feed[~(prov_mat_feed.Value.isna())&(prov_mat_feed.Value > 0)]
+    prov_mat_feed = prov_mat_feed.merge(sc2[feed_keys].drop_duplicates(), on=feed_keys)
+    prov_mat_feed["prov_ratio"] = prov_mat_feed["Value"] / prov_mat_feed.groupby(feed_keys)["Value"].transform("sum")
+
+    ##################################################
+
+    dfx = prov_mat_feed.merge(sc2, on=feed_keys)
     dfx["provenance"] = dfx.prov_ratio * dfx.cVal
     dfx.loc[dfx.cVal>0, "provenance_err"] = dfx.loc[dfx.cVal>0,"provenance"] * np.sqrt(1+(dfx.loc[dfx.cVal>0,"cVal_err"]/dfx.loc[dfx.cVal>0,"cVal"])**2)
-    dfx.drop(columns=["valid", "cVal", "cVal_err"], inplace=True)
+    dfx.drop(columns=["cVal", "cVal_err"], inplace=True)
     dfx = dfx.merge(area_codes[["FAOSTAT", "ISO3"]].rename(columns={"ISO3":"Country_ISO", "FAOSTAT":"Producer_Country_Code"}), on="Producer_Country_Code", how="left")
     dfx = dfx.merge(item_codes[["Item Code", "Item"]].rename(columns={"Item Code":"Item_Code",}), on="Item_Code", how="left")
     feed_prov = dfx[(dfx.Value > 1E-8)&(dfx.provenance > 0)]
 
 
     cons_prov = cons_prov[(cons_prov.Ratio > 1E-8)&(cons_prov.provenance > 0)]
-    cons_prov.to_csv(f"{country_savefile_path}/human_consumed.csv")
-    feed_prov = feed_prov[(feed_prov.Value > 1E-8)&(feed_prov.provenance > 0)]
-    feed_prov.to_csv(f"{country_savefile_path}/feed.csv")
-    return cons_prov, feed_prov
+    cons_rows = cons_prov.groupby("Consumer_Country_Code").indices
+    feed_rows = feed_prov.groupby("coi_code").indices
+    feed_prov = feed_prov.drop(columns=["coi_code"])
+
+    results = {}
+    for country, coi_code in coi_codes.items():
+        if coi_code not in supplied:
+            results[country] = (pd.DataFrame(), pd.DataFrame())
+            continue
+
+        country_savefile_path = f"./results/{year}/{country}"
+        if not os.path.isdir(country_savefile_path):
+            os.makedirs(country_savefile_path)   
+
+        country_cons = cons_prov.iloc[cons_rows.get(coi_code, [])].reset_index(drop=True)
+        country_feed = feed_prov.iloc[feed_rows.get(coi_code, [])].reset_index(drop=True)
+        country_cons.to_csv(f"{country_savefile_path}/human_consumed.csv")
+        country_feed.to_csv(f"{country_savefile_path}/feed.csv")
+        results[country] = (country_cons, country_feed)
+    return results
+
+
+def main(year, country_of_interest, sua, historic="", context=None, trade_matrix=None, trade_matrix_feed=None):
+    """Provenance of one country, see consumption_provenance_all()"""
+    return consumption_provenance_all(
+        year, [country_of_interest], sua, historic, context, trade_matrix, trade_matrix_feed)[country_of_interest]
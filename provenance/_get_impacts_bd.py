@@ -13,11 +13,15 @@ try:
 except ModuleNotFoundError:
     import data_utils
 
+from processing.pipeline_context import PipelineContext
 
-def get_impacts(wdf, year, coi, filename):
+
+def get_impacts(wdf, year, coi, filename, context=None):
     # setup
     country_savefile_path = f"./results/{year}/{coi}"
     datPath = "./input_data"
+    if context is None:
+        context = PipelineContext(datPath)
 
     
     # trim input data to significant values
@@ -25,16 +29,15 @@ def get_impacts(wdf, year, coi, filename):
     wdf = wdf[wdf.Value >= 0.015]
 
     # load additional data and merge into wdf
-    crop_database = pd.read_csv(f"{datPath}/crop_db.csv", index_col = 0)
-    wwf = data_utils.get_wwf_pbd(datPath)
-    Sm_wwf_items = pd.read_csv(f"{datPath}/schwarzmueller_wwf.csv",index_col = 0)
+    crop_database = context.table("crop_db")
+    wwf = context.get("wwf_pbd", lambda: data_utils.get_wwf_pbd(datPath)).copy()
+    Sm_wwf_items = context.table("schwarzmueller_wwf")
     wdf = (wdf
         .merge(Sm_wwf_items[["Item_Code_FAO", "WWF_cat"]], left_on="Item_Code", right_on="Item_Code_FAO", how="left")
         .drop(columns=["Item_Code_FAO"]))
 
     # load yield data
-    fao_prod = pd.read_csv(f"{datPath}/Production_Crops_Livestock_E_All_Data_(Normalized).csv", encoding = "latin-1", low_memory=False)
-    fao_prod = fao_prod[fao_prod.Year == year]
+    fao_prod = context.faostat("production", years=[year], elements=[5412], columns=["Area Code", "Item Code", "Element Code", "Year", "Value"])
     yield_dat = fao_prod[fao_prod["Element Code"] == 5412]
     yield_dat = yield_dat.rename(columns={"Area Code":"Area_Code", "Item Code":"Item_Code"})
     yield_dat = yield_dat[["Area_Code", "Item_Code", "Value"]]
@@ -80,7 +83,7 @@ def get_impacts(wdf, year, coi, filename):
             'Raw milk of cattle' : "bvmilk",
             }  
         rums_df = pd.DataFrame.from_dict(rums, orient='index', columns=['livestock'])
-        tb_pasture_vals = pd.read_csv(f"{datPath}/tb_pasture_factors_2.csv", index_col = 0)[["livestock", "fp_m2_kg", "Country_ISO"]]
+        tb_pasture_vals = context.table("pasture_factors")[["livestock", "fp_m2_kg", "Country_ISO"]]
         global_median_tb = {v: tb_pasture_vals[tb_pasture_vals["livestock"]==v]["fp_m2_kg"].median() for v in set(rums.values())}
         global_median_tb_df = pd.DataFrame.from_dict(global_median_tb, orient='index', columns=['global_median_fp_m2_kg'])
 
@@ -119,8 +122,7 @@ def get_impacts(wdf, year, coi, filename):
 
 
     # biodiversity opportunity cost
-    bd_path = f"{datPath}/country_opp_cost_v6.csv"
-    bd_opp_cost = pd.read_csv(bd_path, index_col = 0)
+    bd_opp_cost = context.table("opp_cost")
 
 
     # calculate fallback 2
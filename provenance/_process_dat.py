@@ -5,15 +5,16 @@ import os
 import warnings
 import time
 
-def main(year, coi_iso, bh, bf):
+from processing.pipeline_context import PipelineContext
+
+def main(year, coi_iso, bh, bf, context=None):
 
     datPath = "./input_data"
     scenPath = f"./results/{year}/{coi_iso}"
+    if context is None:
+        context = PipelineContext(datPath)
 
-    
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        country_code_data = pd.read_excel(f"{datPath}/nocsDataExport_20251021-164754.xlsx")
+    country_code_data = context.table("area_codes")
     coi = country_code_data.loc[country_code_data["ISO3"]==coi_iso]["FAOSTAT"].values[0]
 
     bd_path = f"{datPath}/country_opp_cost_v6.csv"
@@ -21,7 +22,7 @@ def main(year, coi_iso, bh, bf):
     
     # coi = 229
 
-    cropdb = pd.read_csv(f"{datPath}/crop_db.csv")
+    cropdb = context.table("crop_db")
     
     # bh = pd.read_csv(f"{scenPath}/human_consumed_impacts_wErr.csv", index_col = 0)
     # bf = pd.read_csv(f"{scenPath}/feed_impacts_wErr.csv", index_col = 0)
@@ -176,7 +177,7 @@ def main(year, coi_iso, bh, bf):
     last_row.iloc[0] = "Zero"
     food_commodity_impacts = pd.concat([food_commodity_impacts, last_row.to_frame().T], ignore_index=True)
 
-    old_to_new = pd.read_csv(f"{datPath}/composition_old_vs_new.csv")
+    old_to_new = context.table("composition_old_vs_new")
     old_to_new = old_to_new.merge(food_commodity_impacts, left_on="New", right_on="Item", how="left")
     old_to_new.drop(columns=["Item", "New", "tonnage"], inplace=True)
     old_to_new.rename(columns={"Old":""}, inplace=True)
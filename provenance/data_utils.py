@@ -9,6 +9,8 @@ import pandas as pd
 import sys
 import warnings
 
+from processing.excel_cache import read_excel_cached
+
 def file_list(**kwargs): 
     """
     Lists the complete path of all files. Will explore all directories in the
@@ -48,7 +50,7 @@ def get_area_codes(datPath):
     """
     with warnings.catch_warnings(): 
         warnings.simplefilter("ignore")
-        codes = pd.read_excel(f"{datPath}/nocsDataExport_20251021-164754.xlsx")
+        codes = read_excel_cached(f"{datPath}/nocsDataExport_20251021-164754.xlsx")
     return codes
 
 # def get_provenance_matrix_feed(year, datPath):
@@ -93,7 +95,7 @@ def get_wwf_pbd(datPath):
         
         with warnings.catch_warnings(): 
             warnings.simplefilter("ignore")
-            df = pd.read_excel(file_path, sheet_name = sheet_name)
+            df = read_excel_cached(file_path, sheet_name = sheet_name)
     else:
         sys.exit(f"""Couldn't find {file_name} in {datPath}""")
     return df
@@ -0,0 +1,200 @@
+"""Feed conversion of the trade matrix, against the original per-country loops"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from processing.animal_products_to_feed import embed_feed, iter_feed_partitions, ml_animal_prod
+
+COLUMNS = ["Year", "Producer_Country_Code", "Consumer_Country_Code", "Item_Code", "Value", "Animal_Product_Code"]
+
+
+def _rows(consumers, animal_product=np.nan):
+    return pd.DataFrame({
+        "Year": 2011, "Producer_Country_Code": 9.0, "Consumer_Country_Code": consumers,
+        "Item_Code": 15.0, "Value": 1.0, "Animal_Product_Code": animal_product})
+
+
+def test_feed_partitions_skip_consumers_without_rows():
+    crop_trade_data = _rows([4, 1, 4])
+    feed = iter([(1, _rows([1], 867)), (2, _rows([2, 2], 882))])
+
+    # consumer 3 trades animal products, but has no crop rows and no feed rows
+    partitions = list(iter_feed_partitions(crop_trade_data, pd.Series([1.0, 2.0, 3.0]), feed, COLUMNS))
+
+    assert [consumer for consumer, _ in partitions] == [1, 2, 4]
+    assert [len(partition) for _, partition in partitions] == [2, 2, 2]
+    for consumer, partition in partitions:
+        assert list(partition.columns) == COLUMNS
+        assert (partition["Consumer_Country_Code"] == consumer).all()
+    assert partitions[0][1]["Animal_Product_Code"].isna().tolist() == [True, False]
+
+
+def _original_ml_animal_prod(year, country, production_animals, feed_data, weighing_factors):
+    production_animal_data_1 = production_animals[
+        (production_animals["Area_Code"] == country) &
+        (production_animals["Year"] == year) &
+        (production_animals["Value"] > 0)]
+    data_feed = feed_data[
+        (feed_data["Area_Code"] == country) &
+        (feed_data["Year"] == year) &
+        (feed_data["Value"] > 0)]
+    data_2 = weighing_factors.merge(production_animal_data_1, on="Item_Code", how="inner")
+    data_2 = data_2[data_2["Weighing_factors"] > 0]
+    data_2["relative_weighing"] = data_2["Weighing_factors"] / data_2["Weighing_factors"].mean()
+    data_2["weighted_production"] = data_2["relative_weighing"] * data_2["Value"]
+    data_2["relative_production"] = data_2["weighted_production"] / data_2["weighted_production"].sum()
+    data_2["rel_prod_weighted"] = data_2["relative_production"] / data_2["Value"]
+
+    mpt = np.outer(data_2["rel_prod_weighted"], data_feed["Value"])
+
+    row_indices = data_2["Item_Code"].tolist()
+    col_indices = data_feed["Primary_Item_Code"].tolist()
+
+    results = []
+    for j in range(mpt.shape[0]):
+        for k in range(mpt.shape[1]):
+            if (mpt[j, k] > 0) & (not np.isnan(row_indices[j])):
+                results.append({
+                    "Producer_Country_Code": country,
+                    "Year": year,
+                    "Animal_Product_Code": row_indices[j],
+                    "Item_Code": col_indices[k],
+                    "Value": mpt[j, k]})
+    return results
+
+
+def _feed_tables(seed=0):
+    rng = np.random.default_rng(seed)
+    animal_products = [867.0, 882.0, 1058.0, 1035.0, 951.0]
+    feed_items = [15.0, 56.0, 236.0, 2555.0]
+    production_animals = pd.DataFrame(
+        [(area, item, year) for area in range(1, 9) for year in (2010, 2011) for item in animal_products],
+        columns=["Area_Code", "Item_Code", "Year"])
+    production_animals["Value"] = rng.lognormal(3, 1, len(production_animals)) * (rng.random(len(production_animals)) > 0.25)
+    feed_data = pd.DataFrame(
+        [(area, year, item) for area in range(1, 8) for year in (2010, 2011) for item in feed_items],
+        columns=["Area_Code", "Year", "Primary_Item_Code"])
+    feed_data["Value"] = rng.lognormal(4, 1, len(feed_data)) * (rng.random(len(feed_data)) > 0.2)
+    # missing rows, in no particular order
+    production_animals = production_animals.sample(frac=0.8, random_state=seed)
+    feed_data = feed_data.sample(frac=0.8, random_state=seed)
+    # 951 has no weight, 1035 a zero weight
+    weighing_factors = pd.DataFrame({"Item_Code": [1058.0, 882.0, 867.0, 1035.0], "Weighing_factors": [1.0, 0.3, 2.5, 0.0]})
+    return production_animals, feed_data, weighing_factors
+
+
+def test_ml_animal_prod_matches_original_loop():
+    production_animals, feed_data, weighing_factors = _feed_tables()
+    # country 8 has no feed use, 9 no animal production
+    countries = pd.DataFrame({
+        "Producer_Country_Code": [3, 1, 9, 8, 2, 5, 1, 7],
+        "Year": [2011, 2011, 2010, 2010, 2010, 2011, 2010, 2010]})
+
+    result = ml_animal_prod(countries, production_animals, feed_data, weighing_factors)
+
+    expected = []
+    for country, year in countries.sort_values(by=["Year", "Producer_Country_Code"]).itertuples(index=False):
+        expected += _original_ml_animal_prod(year, country, production_animals, feed_data, weighing_factors)
+    expected = pd.DataFrame(expected, columns=["Producer_Country_Code", "Year", "Animal_Product_Code", "Item_Code", "Value"])
+
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, rtol=1e-12)
+
+
+def _original_embed_feed(animal_trade_data, feed_eq_data, crop_shares):
+    share_per_country = feed_eq_data.merge(crop_shares, left_on=["AP_Producer_Country_Code", "Year", "Item_Code"], right_on=["Consumer_Country_Code", "Year", "CB_Item_Code"], how="left")
+    share_per_country["feed_share"] = share_per_country["Feed_per_AP"] * share_per_country["share"]
+    share_per_country = share_per_country[["AP_Producer_Country_Code", "Year", "Animal_Product_Code", "Feed_Producer_Country_Code", "Feed_Item_Code", "feed_share"]]
+
+    results = []
+    for prod in animal_trade_data["Item_Code"].unique():
+        animal_chunk = animal_trade_data[animal_trade_data["Item_Code"] == prod]
+        share_chunk = share_per_country[share_per_country["Animal_Product_Code"] == prod]
+        results.append(animal_chunk.merge(
+            share_chunk,
+            left_on=["Year", "Item_Code", "Producer_Country_Code"],
+            right_on=["Year", "Animal_Product_Code", "AP_Producer_Country_Code"],
+            how="inner").drop(columns=["AP_Producer_Country_Code", "Animal_Product_Code"]))
+    animal_product_data_full = pd.concat(results, ignore_index=True)
+    animal_product_data_full["tons_feed_use"] = animal_product_data_full["feed_share"] * animal_product_data_full["Value"]
+
+    agg = []
+    for cc in animal_product_data_full["Consumer_Country_Code"].unique():
+        subset = animal_product_data_full[animal_product_data_full["Consumer_Country_Code"] == cc]
+        agg.append(subset
+            .groupby(["Year", "Feed_Producer_Country_Code", "Consumer_Country_Code", "Feed_Item_Code", "Item_Code"])
+            .agg({"tons_feed_use": "sum"})
+            .reset_index()
+            .rename(columns={
+                "Feed_Producer_Country_Code": "Producer_Country_Code",
+                "tons_feed_use": "Value",
+                "Item_Code": "Animal_Product_Code",
+                "Feed_Item_Code": "Item_Code"})
+            .reindex(columns=["Year", "Producer_Country_Code", "Consumer_Country_Code", "Item_Code", "Value", "Animal_Product_Code"]))
+    feed_in_animal_products = pd.concat(agg, ignore_index=True)
+
+    agg = []
+    for cc in animal_product_data_full["Feed_Producer_Country_Code"].unique():
+        subset = animal_product_data_full[animal_product_data_full["Feed_Producer_Country_Code"] == cc]
+        agg.append(subset
+            .groupby(["Year", "Feed_Producer_Country_Code", "Producer_Country_Code", "Feed_Item_Code", "Item_Code"])
+            .agg({"tons_feed_use": "sum"})
+            .reset_index())
+    feed_use_origin_per_country = pd.concat(agg, ignore_index=True)
+    feed_use_origin_per_country.drop(columns=["Item_Code"], inplace=True)
+
+    return feed_in_animal_products, feed_use_origin_per_country
+
+
+def _embedding_tables(seed=0):
+    rng = np.random.default_rng(seed)
+    animal_products = [867, 882, 1058]
+    feed_items = [15.0, 56.0, 2555.0]
+    crop_items = [15.0, 56.0, 236.0]
+
+    animal_trade_data = pd.DataFrame(
+        [(year, producer, consumer, item)
+         for year in (2010, 2011) for producer in range(1, 7) for consumer in range(1, 9) for item in animal_products],
+        columns=["Year", "Producer_Country_Code", "Consumer_Country_Code", "Item_Code"]).sample(frac=0.4, random_state=seed)
+    animal_trade_data["Value"] = rng.lognormal(2, 1, len(animal_trade_data)) * (rng.random(len(animal_trade_data)) > 0.1)
+
+    # AP producer 6 has no feed attribution
+    feed_eq_data = pd.DataFrame(
+        [(producer, year, product, item)
+         for producer in range(1, 6) for year in (2010, 2011) for product in animal_products for item in feed_items],
+        columns=["AP_Producer_Country_Code", "Year", "Animal_Product_Code", "Item_Code"]).sample(frac=0.7, random_state=seed)
+    feed_eq_data["Feed_per_AP"] = rng.lognormal(0, 1, len(feed_eq_data))
+
+    # feed item 2555 has no crop shares, and some shares are zero
+    crop_shares = pd.DataFrame(
+        [(feed_producer, consumer, year, crop, item)
+         for feed_producer in range(1, 9) for consumer in range(1, 7) for year in (2010, 2011)
+         for crop, item in zip(crop_items, feed_items[:2] + [56.0])],
+        columns=["Feed_Producer_Country_Code", "Consumer_Country_Code", "Year", "Feed_Item_Code", "CB_Item_Code"]).sample(frac=0.5, random_state=seed)
+    crop_shares["share"] = rng.random(len(crop_shares)) * (rng.random(len(crop_shares)) > 0.15)
+    return animal_trade_data, feed_eq_data, crop_shares
+
+
+@pytest.mark.parametrize("seed", range(2))
+def test_embed_feed_matches_original_merges(seed):
+    tables = _embedding_tables(seed)
+
+    feed_use_origin_per_country, partitions = embed_feed(*tables)
+    partitions = list(partitions)
+    expected_feed, expected_origin = _original_embed_feed(*tables)
+
+    consumers = [consumer for consumer, _ in partitions]
+    assert consumers == sorted(set(consumers))
+    keys = ["Year", "Producer_Country_Code", "Consumer_Country_Code", "Item_Code", "Animal_Product_Code"]
+    pd.testing.assert_frame_equal(
+        pd.concat([partition for _, partition in partitions]).sort_values(by=keys).reset_index(drop=True),
+        expected_feed.sort_values(by=keys).reset_index(drop=True),
+        check_dtype=False, rtol=1e-12)
+
+    # the original kept one row per animal product, which the TradeMatrixFeed groupby sums anyway
+    keys = ["Year", "Feed_Producer_Country_Code", "Producer_Country_Code", "Feed_Item_Code"]
+    pd.testing.assert_frame_equal(
+        feed_use_origin_per_country,
+        expected_origin.groupby(keys, as_index=False)["tons_feed_use"].sum(),
+        check_dtype=False, rtol=1e-12)
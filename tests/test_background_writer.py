@@ -0,0 +1,84 @@
+"""Background writes against the synchronous to_csv() calls they replace"""
+
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from processing.background_writer import BackgroundWriter, run_now, write_csv
+
+
+def _frame(seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({"Item_Code": rng.integers(1, 900, 50), "Value": rng.lognormal(0, 1, 50)})
+
+
+def test_writes_match_synchronous_writes(tmp_path):
+    frames = [_frame(seed) for seed in range(4)]
+    for k, frame in enumerate(frames):
+        frame.to_csv(tmp_path / f"expected_{k}.csv", index=False)
+
+    with BackgroundWriter() as writer:
+        for k, frame in enumerate(frames):
+            writer.to_csv(frame, tmp_path / f"result_{k}.csv", index=False)
+
+    for k in range(len(frames)):
+        assert (tmp_path / f"result_{k}.csv").read_bytes() == (tmp_path / f"expected_{k}.csv").read_bytes()
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_jobs_run_in_submission_order():
+    order = []
+    release = threading.Event()
+    writer = BackgroundWriter()
+
+    writer.submit(release.wait)
+    for k in range(5):
+        writer.submit(order.append, k)
+    # nothing has run while the first job blocks
+    assert order == []
+    release.set()
+    writer.close()
+
+    assert order == list(range(5))
+
+
+def test_errors_are_raised_by_wait_and_close():
+    def fail():
+        raise OSError("disk full")
+
+    writer = BackgroundWriter()
+    writer.submit(fail)
+    with pytest.raises(OSError):
+        writer.wait()
+
+    writer.submit(fail)
+    with pytest.raises(OSError):
+        writer.close()
+
+
+def test_failed_write_keeps_the_previous_file(tmp_path):
+    filename = tmp_path / "TradeMatrix_import_dry_matter.csv"
+    write_csv(_frame(0), filename, index=False)
+    previous = filename.read_bytes()
+
+    class Unwritable:
+        def to_csv(self, path, **kwargs):
+            with open(path, "w") as f:
+                f.write("Item_Code,Value\n1,")
+            raise OSError("disk full")
+
+    with pytest.raises(OSError):
+        write_csv(Unwritable(), filename, index=False)
+
+    assert filename.read_bytes() == previous
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_run_now():
+    calls = []
+
+    run_now(calls.append, 1)
+
+    assert calls == [1]
@@ -0,0 +1,300 @@
+"""
+Batched consumption provenance against the original per-country main()
+
+_original_main() below is main() as it was before consumption_provenance_all()
+replaced it, minus commented-out code and timing. Both run on the same small
+synthetic reference tables, SUA and trade matrices, and must give the same
+rows per country, for the current and the historic food balance sheets.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from provenance._consumption_provenance import add_cols, calculate_conversion_factors, consumption_provenance_all
+
+YEAR = 2011
+# (ISO3, FAOSTAT code); FFF has no food supply data
+COUNTRIES = [("AAA", 1), ("BBB", 2), ("CCC", 3), ("DDD", 4), ("EEE", 5), ("FFF", 6)]
+COUNTRIES_OF_INTEREST = ["BBB", "AAA", "FFF", "DDD"]
+# item code, name, CPC code, dry matter, primary item
+ITEMS = [
+    (15, "Wheat", "0111", 88.0, 15),
+    (16, "Flour, wheat", "23110", 86.0, 15),
+    (56, "Maize", "0112", 87.0, 56),
+    (236, "Soya beans", "0141", 90.0, 236),
+    (867, "Meat of cattle", "21111.01", 30.0, 867),
+    (882, "Raw milk of cattle", "02211", 12.0, 882),
+    (1058, "Meat of chickens", "21121", 28.0, 1058),
+    (156, "Sugar cane", "01802", 30.0, 156),
+    (157, "Sugar beet", "01801", 25.0, 157),
+    (257, "Palm oil", "2165", 100.0, 257)]
+CROPS = [15, 56, 236]
+ANIMAL_PRODUCTS = [867, 882, 1058]
+# historic commodity balance codes and the FAO items they convert to
+CB_CODES = {2511: 15, 2514: 56, 2731: 867, 2848: 882}
+
+
+class _Context:
+    """Reference tables of PipelineContext, as copies of synthetic frames"""
+
+    def __init__(self):
+        self.tables = {
+            "item_codes": pd.DataFrame({
+                "Item Code": [item[0] for item in ITEMS],
+                "Item ": [item[1] for item in ITEMS],
+                "CPC Code": [item[2] for item in ITEMS]}),
+            "area_codes": pd.DataFrame({
+                "ISO3": [iso3 for iso3, _ in COUNTRIES],
+                "FAOSTAT": [code for _, code in COUNTRIES],
+                "LIST NAME": [f"Country {iso3}" for iso3, _ in COUNTRIES]}),
+            "content_factors": pd.DataFrame({
+                "Item Code": [item[0] for item in ITEMS],
+                "dry matter": [item[3] for item in ITEMS]}),
+            "item_map": pd.DataFrame({
+                "FAO code": [item[0] for item in ITEMS],
+                "FAO name primary": [dict((i[0], i[1]) for i in ITEMS)[item[4]] for item in ITEMS],
+                "primary item": [item[4] for item in ITEMS]}),
+            "weighing_factors": pd.DataFrame({
+                "Item_Code": ANIMAL_PRODUCTS,
+                "Item": ["Meat of cattle", "Raw milk of cattle", "Meat of chickens"],
+                "Weighing factors": [1.0, 0.4, 0.0]}),
+            "cb_conversion_map": pd.DataFrame({"FAO_code": list(CB_CODES.values()), "CB_code": list(CB_CODES)})}
+
+    def table(self, name):
+        return self.tables[name].copy()
+
+
+def _sua(rng, historic):
+    rows = []
+    for _, area in COUNTRIES[:-1]:
+        for year in (YEAR - 1, YEAR):
+            if historic:
+                rows.append((area, 2501, "", 511, "Total Population - Both sexes", year, rng.lognormal(8, 1)))
+                for item in list(CB_CODES) + [236]:
+                    rows.append((area, item, "", 645, "Food supply quantity (kg/capita/yr)", year, rng.lognormal(2, 1)))
+                continue
+            for item, _, cpc, _, _ in ITEMS[:7]:
+                value = rng.lognormal(6, 1) * (rng.random() > 0.15)
+                rows.append((area, item, cpc, 5141, "Food supply quantity (tonnes)", year, value))
+            for item, _, cpc, _, _ in ITEMS[7:]:
+                for element_code, element in [(5510, "Production"), (5610, "Import quantity"), (5910, "Export quantity"), (5016, "Loss")]:
+                    rows.append((area, item, cpc, element_code, element, year, rng.lognormal(5, 1)))
+    sua = pd.DataFrame(rows, columns=["Area Code", "Item Code", "Item Code (CPC)", "Element Code", "Element", "Year", "Value"])
+    sua["Note"] = ""
+    return sua
+
+
+def _trade_matrices(rng):
+    codes = [code for _, code in COUNTRIES]
+    trade_matrix = pd.DataFrame(
+        [(YEAR, producer, consumer, item)
+         for producer in codes for consumer in codes for item in CROPS + ANIMAL_PRODUCTS],
+        columns=["Year", "Producer_Country_Code", "Consumer_Country_Code", "Item_Code"]).sample(frac=0.6, random_state=1)
+    trade_matrix["Value"] = rng.lognormal(3, 1.5, len(trade_matrix))
+    trade_matrix = trade_matrix.sort_values(by=["Producer_Country_Code", "Consumer_Country_Code", "Item_Code"]).reset_index(drop=True)
+
+    # crop rows (including negative feed use) and the feed embedded in the animal products of each consumer
+    feed = pd.DataFrame(
+        [(YEAR, float(producer), consumer, float(item), animal_product)
+         for consumer in codes for producer in codes for item in CROPS for animal_product in [np.nan] + ANIMAL_PRODUCTS],
+        columns=["Year", "Producer_Country_Code", "Consumer_Country_Code", "Item_Code", "Animal_Product_Code"]).sample(frac=0.5, random_state=2)
+    feed["Value"] = rng.lognormal(2, 1.5, len(feed)) * rng.choice([1.0, 0.0, -1.0], len(feed), p=[0.8, 0.1, 0.1])
+    feed = feed[["Year", "Producer_Country_Code", "Consumer_Country_Code", "Item_Code", "Value", "Animal_Product_Code"]]
+    trade_matrix_feed = {
+        consumer: partition.reset_index(drop=True)
+        for consumer, partition in feed.sort_values(by=["Consumer_Country_Code", "Producer_Country_Code", "Item_Code"]).groupby("Consumer_Country_Code")}
+    return trade_matrix, trade_matrix_feed
+
+
+def _original_main(year, country_of_interest, sua, historic, context, trade_matrix, trade_matrix_feed):
+    item_codes = context.table("item_codes")
+    area_codes = context.table("area_codes")
+    factors = context.table("content_factors")
+    item_map = context.table("item_map")
+    weighing_factors = context.table("weighing_factors")
+    prov_mat_no_feed = trade_matrix
+    prov_mat_feed = trade_matrix_feed.copy()
+
+    coi_code = area_codes[area_codes["ISO3"] == country_of_interest]["FAOSTAT"].values[0]
+
+    item_codes.columns = [_.strip() for _ in item_codes.columns]
+    add_palestine = pd.DataFrame({"ISO3":["PSE"], "FAOSTAT":[299]})
+    area_codes = pd.concat([area_codes, add_palestine], ignore_index=True)
+    ic = item_codes.rename(columns={"CPC Code":"Item Code (CPC)", "Item Code":"FAO_code", "Item":"item_name"})
+    ic["Item Code (CPC)"] = ic["Item Code (CPC)"].astype("string")
+
+    sua = sua[(sua["Area Code"]==coi_code)&(sua.Year == year)]
+
+    if historic == "":
+        sugar_cane = sua[(sua["Item Code"]==156)]
+        sugar_beet = sua[(sua["Item Code"]==157)]
+        palm_oil = sua[(sua["Item Code"]==257)]
+        for sugar in [sugar_cane, sugar_beet, palm_oil]:
+            sugar_p = sugar[sugar["Element"]=="Production"].Value.sum()
+            sugar_i = sugar[sugar["Element"]=="Import quantity"].Value.sum()
+            sugar_e = sugar[sugar["Element"]=="Export quantity"].Value.sum()
+            sugar_l = sugar[sugar["Element"]=="Loss"].Value.sum()
+            sugar_val = np.max([sugar_p + sugar_i - sugar_e - sugar_l, 0])
+            new_entry = sugar.iloc[0].copy()
+            new_entry['Element Code'] = 5141
+            new_entry['Element'] = "Food supply quantity (tonnes)"
+            new_entry['Value'] = sugar_val
+            sua = pd.concat([sua, new_entry.to_frame().T], ignore_index=True)
+        fs = sua[sua["Element Code"]==5141].copy()
+        fs["Item Code (CPC)"] = fs["Item Code (CPC)"].astype("string")
+        fs = fs.merge(ic, on="Item Code (CPC)", how="left")
+        fs = fs.drop(columns=["Note"])
+
+    else:
+        population = sua[(sua["Element Code"]==511)].Value.values[0]
+        fs = sua[sua["Element Code"]==645].copy()
+        fs["Value"] = fs["Value"] * population
+        cb_conversion_map = context.table("cb_conversion_map")
+        fs = fs.merge(
+            cb_conversion_map[["FAO_code", "CB_code"]],
+            left_on="Item Code",
+            right_on="CB_code",
+            how="left")
+        fs["FAO_code"] = fs["FAO_code"].fillna(fs["Item Code"])
+        fs.drop(columns=["CB_code"], inplace=True)
+        fs = fs.merge(ic[["FAO_code", "item_name"]], on="FAO_code", how="left")
+
+    if len(fs) == 0:
+        return pd.DataFrame(), pd.DataFrame()
+
+    fserr = fs.copy()
+
+    imports_feed = prov_mat_feed[prov_mat_feed.Consumer_Country_Code == coi_code]
+    imports_feed = add_cols(imports_feed, area_codes=area_codes, item_codes=item_codes)
+    imports_feed = imports_feed[~imports_feed.Item.isna()]
+    imports_feed_crops = imports_feed[(imports_feed.Animal_Product.isna()) & (imports_feed.Value >= 0)]
+    imports_feed_crops.loc[:, 'Animal_Product'] = ""
+
+    imports_no_feed = prov_mat_no_feed[prov_mat_no_feed.Consumer_Country_Code == coi_code]
+    imports_no_feed = add_cols(imports_no_feed, area_codes=area_codes, item_codes=item_codes)
+    imports_no_feed = imports_no_feed[~imports_no_feed.Item.isna()]
+    imports_no_feed = imports_no_feed[imports_no_feed.Item_Code.isin(imports_feed.Animal_Product_Code.unique())]
+    imports_no_feed.loc[:, 'Animal_Product'] = "Primary"
+
+    imports_total = pd.concat([imports_feed_crops, imports_no_feed])
+
+    human_consumed_import_ratios = (imports_total
+        .groupby(["Item_Code", "Animal_Product"])[imports_total.columns]
+        .apply(lambda x: x.assign(Ratio=x["Value"] / x["Value"].sum()))
+        .reset_index(drop=True)
+        .drop(columns=["Value"]))
+
+    human_consumed_import_ratios.loc[human_consumed_import_ratios.Animal_Product=="", "Animal_Product"] = np.nan
+
+    df_hc, df_hc_err = fs.copy(), fserr.copy()
+    cf = calculate_conversion_factors("dry_matter", factors.copy(), item_map.copy())
+    df_hc = df_hc.merge(cf, on="FAO_code", how="left")
+    df_hc_err = df_hc_err.merge(cf, on="FAO_code", how="left")
+    df_hc=df_hc[df_hc["ratio"]!=0]
+
+    df_hc.dropna(subset=["ratio"], inplace=True)
+
+    df_hc["value_primary"] = df_hc.Value / df_hc.ratio
+    df_hc_err["value_primary_err"] = df_hc_err["Value"]**2
+
+    primary_consumption = (df_hc
+        .groupby(["primary_item_code"])[df_hc.columns]
+        .apply(lambda x: x.assign(value_primary=x["value_primary"].sum()))
+        .reset_index(drop=True)
+        [['primary_item_code', 'value_primary']]
+        .drop_duplicates(subset=["primary_item_code"])
+        .merge(
+            item_codes[["Item Code", "Item"]].rename(columns={"Item Code":"primary_item_code", "Item":"item_name"}),
+            on="primary_item_code",
+            how="left"))
+
+    df_hc_err = (df_hc_err
+        .groupby(["primary_item_code"])[df_hc_err.columns]
+        .apply(lambda x: x.assign(value_primary_err=np.sqrt(x["value_primary_err"].sum())))
+        .reset_index(drop=True)
+        [['primary_item_code', 'value_primary_err']]
+        .drop_duplicates(subset=["primary_item_code"]))
+    primary_consumption = primary_consumption.merge(df_hc_err, on="primary_item_code", how="left")
+
+    cons_prov = (human_consumed_import_ratios
+        .merge(primary_consumption, left_on="Item_Code", right_on="primary_item_code", how="left")
+        .drop(columns=["primary_item_code", "item_name"]))
+    cons_prov["provenance"] = cons_prov["Ratio"] * cons_prov["value_primary"]
+    cons_prov["provenance_err"] = cons_prov.provenance * np.sqrt(1+(cons_prov.value_primary_err/cons_prov.value_primary)**2)
+    cons_prov = (cons_prov
+        .drop(columns=["value_primary", "value_primary_err"])
+        .dropna(subset=["provenance"]))
+    cons_prov["Value"] = cons_prov["Ratio"]
+
+    primary_consumption_anim = primary_consumption[primary_consumption.primary_item_code.isin(weighing_factors.Item_Code)]
+
+    primary_consumption_anim = primary_consumption_anim.merge(weighing_factors, left_on="primary_item_code", right_on="Item_Code", how="left")
+    primary_consumption_anim['value_primary'] = primary_consumption_anim['value_primary'] * primary_consumption_anim['Weighing factors']
+    primary_consumption_anim['value_primary_err'] = primary_consumption_anim['value_primary_err'] * primary_consumption_anim['Weighing factors']
+    primary_consumption_anim = primary_consumption_anim[primary_consumption_anim['Weighing factors'] > 0]
+    primary_consumption_anim = primary_consumption_anim.drop(columns=["Item_Code", "Item", "Weighing factors"])
+
+    prov_mat_feed.loc[prov_mat_feed["Animal_Product_Code"].isna(), "Animal_Product_Code"] = 0
+    prov_mat_feed = prov_mat_feed[~(prov_mat_feed.Value.isna())&(prov_mat_feed.Value > 0)]
+    prov_mat_feed = (prov_mat_feed
+        .groupby(["Animal_Product_Code", "Consumer_Country_Code"])[prov_mat_feed.columns]
+        .apply(lambda x: x.assign(prov_ratio=x["Value"] / x["Value"].sum()))
+        .reset_index(drop=True))
+    prov_mat_feed.loc[prov_mat_feed["Animal_Product_Code"]==0, "Animal_Product_Code"] = np.nan
+
+    animal_codes = primary_consumption_anim.primary_item_code.unique()
+    sc2 = human_consumed_import_ratios[human_consumed_import_ratios.Item_Code.isin(animal_codes)]
+    sc2 = sc2.merge(primary_consumption_anim, left_on="Item_Code", right_on="primary_item_code", how="left")
+    sc2["cVal"] = sc2["Ratio"] * sc2["value_primary"]
+    sc2["cVal_err"] = sc2["Ratio"] * sc2["value_primary_err"]
+    sc2["valid"] = sc2.Item_Code.astype(int).astype(str) +"-"+ sc2.Producer_Country_Code.astype(int).astype(str)
+    sc2["Animal_Product"] = sc2.item_name
+    sc2 = sc2[["valid", "cVal", "cVal_err", "Animal_Product"]]
+    prov_mat_feed = prov_mat_feed[~prov_mat_feed.Animal_Product_Code.isna()]
+    prov_mat_feed["valid"] = prov_mat_feed.Animal_Product_Code.astype(int).astype(str) + "-" + prov_mat_feed.Consumer_Country_Code.astype(str)
+    dfx = prov_mat_feed[prov_mat_feed["valid"].isin(sc2["valid"])]
+    dfx = dfx.merge(sc2, on="valid", how="left")
+    dfx["provenance"] = dfx.prov_ratio * dfx.cVal
+    dfx.loc[dfx.cVal>0, "provenance_err"] = dfx.loc[dfx.cVal>0,"provenance"] * np.sqrt(1+(dfx.loc[dfx.cVal>0,"cVal_err"]/dfx.loc[dfx.cVal>0,"cVal"])**2)
+    dfx.drop(columns=["valid", "cVal", "cVal_err"], inplace=True)
+    dfx = dfx.merge(area_codes[["FAOSTAT", "ISO3"]].rename(columns={"ISO3":"Country_ISO", "FAOSTAT":"Producer_Country_Code"}), on="Producer_Country_Code", how="left")
+    dfx = dfx.merge(item_codes[["Item Code", "Item"]].rename(columns={"Item Code":"Item_Code",}), on="Item_Code", how="left")
+    feed_prov = dfx[(dfx.Value > 1E-8)&(dfx.provenance > 0)]
+
+    cons_prov = cons_prov[(cons_prov.Ratio > 1E-8)&(cons_prov.provenance > 0)]
+    feed_prov = feed_prov[(feed_prov.Value > 1E-8)&(feed_prov.provenance > 0)]
+    return cons_prov, feed_prov
+
+
+def _sorted(frame):
+    # row order within a country is not part of the output's meaning
+    return frame.sort_values(by=list(frame.columns)).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("historic", ["", "Historic"])
+def test_matches_original_per_country(historic, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(0)
+    sua = _sua(rng, historic)
+    trade_matrix, trade_matrix_feed = _trade_matrices(rng)
+    context = _Context()
+
+    results = consumption_provenance_all(
+        YEAR, COUNTRIES_OF_INTEREST, sua, historic, context=context,
+        trade_matrix=trade_matrix, trade_matrix_feed=trade_matrix_feed)
+
+    assert list(results) == COUNTRIES_OF_INTEREST
+    # the original failed on countries without any SUA rows, the batched pass skips them
+    assert all(frame.empty for frame in results["FFF"])
+    assert not (tmp_path / "results" / str(YEAR) / "FFF").exists()
+
+    for country in ["BBB", "AAA", "DDD"]:
+        expected = _original_main(
+            YEAR, country, sua, historic, context, trade_matrix,
+            pd.concat(trade_matrix_feed.values(), ignore_index=True))
+        for result, expected_frame in zip(results[country], expected, strict=True):
+            assert len(result) > 0 and set(result.columns) == set(expected_frame.columns)
+            pd.testing.assert_frame_equal(_sorted(result), _sorted(expected_frame[result.columns]), check_dtype=False, rtol=1e-10)
+        written = pd.read_csv(tmp_path / "results" / str(YEAR) / country / "human_consumed.csv", index_col=0)
+        assert len(written) == len(results[country][0])
@@ -0,0 +1,51 @@
+"""Vectorised eliminate_dates() against the original per-country loop"""
+
+import numpy as np
+import pandas as pd
+
+from processing.calculate_trade_matrix import eliminate_dates, reporting_windows
+
+
+def _original_eliminate_dates(reporting_dates, function_dataframe):
+    reporting_dates_start = reporting_dates[["Country_Code", "Start_Year"]].dropna()
+    reporting_dates_end = reporting_dates[["Country_Code", "End_Year"]].dropna()
+
+    for country, year in reporting_dates_start.values:
+        function_dataframe.loc[(function_dataframe["Reporter_Country_Code"] == country) & (function_dataframe["Year"] < year), "Value"] = 0
+    for country, year in reporting_dates_end.values:
+        function_dataframe.loc[(function_dataframe["Reporter_Country_Code"] == country) & (function_dataframe["Year"] > year), "Value"] = 0
+
+    return function_dataframe
+
+
+def test_matches_original_loop():
+    # 1: start only, 2: end only, 3: both, listed twice, 4: no dates, 5: not listed
+    reporting_dates = pd.DataFrame({
+        "Country_Code": [1, 2, 3, 3, 4],
+        "Start_Year": [1995, np.nan, 1990, 1993, np.nan],
+        "End_Year": [np.nan, 2005, 2010, 2008, np.nan]})
+    rng = np.random.default_rng(0)
+    trade = pd.DataFrame({
+        "Reporter_Country_Code": np.repeat([1, 2, 3, 4, 5], 40),
+        "Partner_Country_Code": rng.integers(1, 6, 200),
+        "Year": np.tile(np.arange(1986, 2026), 5),
+        "Value": rng.lognormal(0, 1, 200)},
+        index=rng.permutation(200))
+
+    result = eliminate_dates(reporting_windows(reporting_dates), trade.copy())
+    expected = _original_eliminate_dates(reporting_dates, trade.copy())
+
+    pd.testing.assert_frame_equal(result, expected)
+    assert (result["Value"] == 0).any() and (result["Value"] != 0).any()
+
+
+def test_reporting_windows_keep_the_narrowest_window():
+    reporting_dates = pd.DataFrame({
+        "Country Code": [3, 3, 7],
+        "Start Year": [1990, 1993, np.nan],
+        "End Year": [2010, 2008, np.nan]})
+
+    windows = reporting_windows(reporting_dates)
+
+    assert windows.loc[3].tolist() == [1993, 2008]
+    assert windows.loc[7].isna().all()
@@ -0,0 +1,94 @@
+"""On-disk MRIO cache: keys, round trips, eviction and cached solves against uncached ones"""
+
+import os
+import time
+
+import numpy as np
+
+from processing.calculate_trade_matrix import solve_item_systems
+from processing.mrio_cache import MrioCache, system_key
+
+
+def _item_system(item_code, seed, n=10):
+    rng = np.random.default_rng(seed)
+    Z = (rng.random((n, n)) < 0.4) * rng.lognormal(0, 1, (n, n))
+    np.fill_diagonal(Z, 0)
+    p = rng.lognormal(0, 1, n) * Z.sum(axis=1).mean()
+    p[rng.random(n) < 0.3] = 0
+    rows, cols = np.nonzero(Z)
+    countries = np.sort(rng.choice(np.arange(1, 300), n, replace=False))
+    return (2011, item_code, countries, rows, cols, Z[rows, cols], p)
+
+
+def _assert_same_solutions(results, expected):
+    assert len(results) == len(expected)
+    for result, expected_result in zip(results, expected):
+        for array, expected_array in zip(result[:3], expected_result[:3]):
+            np.testing.assert_array_equal(array, expected_array)
+        assert result[3] == expected_result[3]
+
+
+def test_system_key():
+    _, _, countries, rows, cols, values, p = _item_system(15, 0)
+    key = system_key(countries, rows, cols, values, p, "sparse")
+
+    assert key == system_key(countries.copy(), rows.copy(), cols.copy(), values.copy(), p.copy(), "sparse")
+    changed_values = values.copy()
+    changed_values[0] *= 1.001
+    assert key != system_key(countries, rows, cols, changed_values, p, "sparse")
+    assert key != system_key(countries, rows, cols, values, p, "dense")
+    assert key != system_key(countries, rows, cols, values, p, "sparse", consumers=np.array([0]))
+    assert (system_key(countries, rows, cols, values, p, "sparse", consumers=np.array([1]))
+            != system_key(countries, rows, cols, values, p, "sparse", producers=np.array([1])))
+
+
+def test_round_trip_and_corrupt_entries(tmp_path):
+    cache = MrioCache(tmp_path)
+    result = (np.array([4, 8]), np.array([8, 8]), np.array([1.25, 3.5]), "sparse_lu")
+
+    assert cache.get("ab" * 20) is None
+    cache.put("ab" * 20, result)
+    cached = cache.get("ab" * 20)
+
+    _assert_same_solutions([cached], [result])
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    (tmp_path / "cd").mkdir()
+    (tmp_path / "cd" / f"{'cd' * 20}.npz").write_bytes(b"not a zip file")
+    assert cache.get("cd" * 20) is None
+
+
+def test_cached_solves_match_uncached(tmp_path):
+    item_systems = [_item_system(item_code, seed) for seed, item_code in enumerate([15, 27, 56, 867])]
+    expected = solve_item_systems(item_systems)
+
+    cache = MrioCache(tmp_path)
+    _assert_same_solutions(solve_item_systems(item_systems, mrio_cache=cache), expected)
+    _assert_same_solutions(solve_item_systems(item_systems, mrio_cache=cache), expected)
+    assert (cache.hits, cache.misses) == (4, 4)
+
+    # after a change to one item, only that item is solved again
+    item_systems[2] = _item_system(56, 99)
+    results = solve_item_systems(item_systems, mrio_cache=cache)
+    _assert_same_solutions(results, solve_item_systems(item_systems))
+    assert (cache.hits, cache.misses) == (7, 5)
+
+
+def test_eviction(tmp_path):
+    result = (np.arange(100), np.arange(100), np.ones(100), "sparse_lu")
+    keys = [f"{k:02d}" * 20 for k in range(4)]
+    cache = MrioCache(tmp_path, max_age_days=30)
+    for key in keys:
+        cache.put(key, result)
+
+    now = time.time()
+    # keys[0] is too old, keys[1] the least recently used of the others
+    for key, age_days in zip(keys, [40, 3, 2, 1]):
+        os.utime(cache._file(key), (now - age_days * 86400, now - age_days * 86400))
+    entry_size = cache._file(keys[0]).stat().st_size
+    cache.max_size = 2 * entry_size
+
+    cache.evict()
+
+    assert [cache._file(key).exists() for key in keys] == [False, False, True, True]
+    assert cache.evicted == 2
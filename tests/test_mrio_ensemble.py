@@ -0,0 +1,81 @@
+"""Monte-Carlo ensemble of the MRIO step against the original implementation, which kept and copied every draw"""
+
+import numpy as np
+import pytest
+
+from processing.calculate_trade_matrix import iter_item_ensembles
+from processing.mrio_solver import _batch_r_bar, _perturbed, ensemble_memory, ensemble_r_bar
+
+
+def _system(n=12, seed=0):
+    rng = np.random.default_rng(seed)
+    Z = (rng.random((n, n)) < 0.4) * rng.lognormal(0, 1, (n, n))
+    np.fill_diagonal(Z, 0)
+    p = rng.lognormal(0, 1, n) * Z.sum(axis=1).mean()
+    p[[1, 5]] = 0
+    rows, cols = np.nonzero(Z)
+    return rows, cols, Z[rows, cols], p
+
+
+def _original_ensemble(rows, cols, values, p, n_draws, z_cv, p_cv, distribution, quantiles, rng, batch_size):
+    n = len(p)
+    producers = np.flatnonzero(p)
+    draws = np.zeros((n_draws, n, len(producers)))
+    for start in range(0, n_draws, batch_size):
+        size = min(batch_size, n_draws - start)
+        Z = np.zeros((size, n, n))
+        Z[:, rows, cols] = _perturbed(values, z_cv, distribution, rng, size)
+        draws[start:start + size] = _batch_r_bar(Z, _perturbed(p, p_cv, distribution, rng, size), producers)
+    return producers, draws.mean(axis=0), np.quantile(draws, quantiles, axis=0)
+
+
+@pytest.mark.parametrize("distribution", ["lognormal", "normal"])
+@pytest.mark.parametrize("n_draws, batch_size", [(50, 100), (250, 40), (1, 100)])
+def test_ensemble_matches_original(distribution, n_draws, batch_size):
+    system = _system()
+    options = dict(n_draws=n_draws, z_cv=0.2, p_cv=0.1, distribution=distribution, quantiles=(0.05, 0.5, 0.95))
+
+    producers, mean, quantile_values = ensemble_r_bar(
+        *system, rng=np.random.default_rng(3), batch_size=batch_size, **options)
+    expected = _original_ensemble(*system, rng=np.random.default_rng(3), batch_size=batch_size, **options)
+
+    np.testing.assert_array_equal(producers, expected[0])
+    np.testing.assert_allclose(mean, expected[1], rtol=1e-12)
+    np.testing.assert_array_equal(quantile_values, expected[2])
+
+
+def test_no_producers_and_no_draws():
+    rows, cols, values, p = _system()
+
+    producers, mean, quantile_values = ensemble_r_bar(rows, cols, values, np.zeros_like(p), n_draws=10)
+    assert len(producers) == 0 and mean.shape == (len(p), 0) and quantile_values.shape == (3, len(p), 0)
+
+    with pytest.raises(ValueError):
+        ensemble_r_bar(rows, cols, values, np.zeros_like(p), n_draws=0)
+
+
+@pytest.mark.parametrize("distribution", ["lognormal", "normal"])
+def test_perturbation_keeps_the_mean(distribution):
+    values = np.array([1.0, 10.0, 250.0])
+    rng = np.random.default_rng(11)
+
+    # a large cv, where clipping the normal draws at zero would raise their mean by 8%, truncating them by 29%
+    draws = _perturbed(values, 1.0, distribution, rng, 400_000)
+
+    assert (draws >= 0).all()
+    np.testing.assert_allclose(draws.mean(axis=0), values, rtol=2e-2)
+
+
+def test_workers_capped_by_memory_budget(capsys):
+    rows, cols, values, p = _system()
+    item_systems = [(2011, item_code, np.arange(len(p)), rows, cols, values, p) for item_code in (15, 27, 56)]
+    item_memory = ensemble_memory(len(p), np.count_nonzero(p), 20)
+
+    results = list(iter_item_ensembles(
+        item_systems, n_workers=4, memory_budget_gb=1.5 * item_memory / 1024**3, n_draws=20, seed=0))
+    serial = list(iter_item_ensembles(item_systems, n_workers=1, n_draws=20, seed=0))
+
+    assert "1 ensemble workers fit" in capsys.readouterr().out
+    for result, expected in zip(results, serial, strict=True):
+        for array, expected_array in zip(result, expected):
+            np.testing.assert_array_equal(array, expected_array)
@@ -0,0 +1,165 @@
+"""MRIO solver backends against the original dense pseudo-inverse of every item's system"""
+
+import numpy as np
+import pytest
+
+from processing.mrio_solver import _block_solve, dense_r_bar_batch, solve_mrio
+
+
+def _original_r_bar(Z, p):
+    # calculate_mrio_matrices() as it was: R_bar = diag(c) pinv(I - A) diag(p)
+    x = p + Z @ np.ones(len(p))
+    one_over_x = np.where(x != 0, 1.0 / np.where(x != 0, x, 1.0), 0.0)
+    A = Z @ np.diag(one_over_x)
+    R = np.linalg.pinv(np.eye(len(p)) - A) @ np.diag(p)
+    c = (x - Z.sum(axis=0)) * one_over_x
+    return np.diag(c) @ R
+
+
+def _random_system(n=15, density=0.3, seed=0, no_production=0.3):
+    rng = np.random.default_rng(seed)
+    Z = (rng.random((n, n)) < density) * rng.lognormal(0, 1, (n, n))
+    np.fill_diagonal(Z, 0)
+    p = rng.lognormal(0, 1, n) * Z.sum(axis=1).mean()
+    p[rng.random(n) < no_production] = 0
+    rows, cols = np.nonzero(Z)
+    return rows, cols, Z[rows, cols], p
+
+
+def _singular_system():
+    # countries 3 and 4 only re-export to each other and produce nothing, so I - A is singular
+    Z = np.zeros((5, 5))
+    Z[0, 1], Z[1, 0], Z[2, 0], Z[2, 1] = 4.0, 2.0, 1.5, 3.0
+    Z[3, 4], Z[4, 3] = 2.0, 5.0
+    p = np.array([10.0, 8.0, 0.0, 0.0, 0.0])
+    rows, cols = np.nonzero(Z)
+    return rows, cols, Z[rows, cols], p
+
+
+def _component_system(seed=0):
+    # clusters of countries that trade among themselves, linked one way, plus isolated countries
+    rng = np.random.default_rng(seed)
+    sizes = [1, 4, 1, 6, 3, 1, 1, 5]
+    n = sum(sizes)
+    starts = np.cumsum([0] + sizes)
+    Z = np.zeros((n, n))
+    for start, stop in zip(starts[:-1], starts[1:]):
+        Z[start:stop, start:stop] = (rng.random((stop - start, stop - start)) < 0.7) * rng.lognormal(0, 1, (stop - start,) * 2)
+    for start, stop, later_start, later_stop in zip(starts[:-2], starts[1:-1], starts[1:-1], starts[2:]):
+        Z[rng.integers(start, stop), rng.integers(later_start, later_stop)] = rng.lognormal(0, 1)
+    np.fill_diagonal(Z, 0)
+    p = rng.lognormal(0, 1, n) * 3
+    p[rng.random(n) < 0.3] = 0
+    order = rng.permutation(n)
+    Z, p = Z[np.ix_(order, order)], p[order]
+    rows, cols = np.nonzero(Z)
+    return rows, cols, Z[rows, cols], p
+
+
+def _dense(rows, cols, values, p):
+    Z = np.zeros((len(p), len(p)))
+    Z[rows, cols] = values
+    return Z
+
+
+def _assert_r_bar_close(R_bar, expected):
+    np.testing.assert_allclose(R_bar, expected, rtol=1e-8, atol=1e-9 * np.abs(expected).max())
+
+
+SYSTEMS = [_random_system(seed=seed) for seed in range(4)] + [
+    _random_system(n=30, density=0.05, seed=7),
+    _random_system(n=8, density=0.6, seed=3, no_production=0.0),
+    _component_system(seed=0),
+    _component_system(seed=1)]
+
+
+@pytest.mark.parametrize("system", SYSTEMS)
+def test_sparse_matches_original(system):
+    R_bar, path = solve_mrio(*system, solver="sparse")
+
+    assert path == "sparse_lu"
+    _assert_r_bar_close(R_bar, _original_r_bar(_dense(*system), system[3]))
+
+
+@pytest.mark.parametrize("system", SYSTEMS)
+def test_scc_matches_original(system):
+    R_bar, path = solve_mrio(*system, solver="scc")
+
+    assert path == "scc_blocks"
+    _assert_r_bar_close(R_bar, _original_r_bar(_dense(*system), system[3]))
+
+
+def test_block_solve():
+    rows, cols, values, p = _component_system(seed=2)
+    Z = _dense(rows, cols, values, p)
+    M = np.eye(len(p)) - Z / (1 + p + Z.sum(axis=1))[None, :]
+    rhs = np.random.default_rng(0).random((len(p), 3))
+
+    np.testing.assert_allclose(_block_solve(M, rhs), np.linalg.solve(M, rhs), rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(_block_solve(M.T, rhs), np.linalg.solve(M.T, rhs), rtol=1e-10, atol=1e-12)
+    # a country whose diagonal entry vanishes makes its block singular
+    M[0, :] = 0
+    assert _block_solve(M, rhs) is None
+
+
+@pytest.mark.parametrize("solver", ["sparse", "scc"])
+def test_singular_system_falls_back_to_pinv(solver):
+    system = _singular_system()
+
+    R_bar, path = solve_mrio(*system, solver=solver)
+
+    assert path == "pinv"
+    _assert_r_bar_close(R_bar, _original_r_bar(_dense(*system), system[3]))
+
+
+def test_no_production():
+    rows, cols, values, p = _random_system(seed=1)
+
+    R_bar, _ = solve_mrio(rows, cols, values, np.zeros_like(p), solver="sparse")
+
+    assert not R_bar.any()
+
+
+def test_unknown_solver():
+    with pytest.raises(ValueError):
+        solve_mrio(*_random_system(), solver="lu")
+
+
+@pytest.mark.parametrize("solver", ["sparse", "scc"])
+@pytest.mark.parametrize("system", SYSTEMS + [_singular_system()])
+def test_rows_and_columns_only(system, solver):
+    rows, cols, values, p = system
+    consumers, producers = np.array([0, 3]), np.array([2, 4])
+    expected = _original_r_bar(_dense(*system), p)
+
+    for subsets in [dict(consumers=consumers), dict(producers=producers), dict(consumers=consumers, producers=producers)]:
+        R_bar, _ = solve_mrio(rows, cols, values, p, solver=solver, **subsets)
+
+        needed = np.zeros(expected.shape, dtype=bool)
+        needed[subsets.get("consumers", []), :] = True
+        needed[:, subsets.get("producers", [])] = True
+        _assert_r_bar_close(R_bar, np.where(needed, expected, 0))
+
+
+@pytest.mark.parametrize("system", SYSTEMS + [_singular_system()])
+def test_dense_matches_original(system):
+    R_bar, path = solve_mrio(*system, solver="dense")
+
+    assert path == "pinv"
+    _assert_r_bar_close(R_bar, _original_r_bar(_dense(*system), system[3]))
+
+
+@pytest.mark.parametrize("max_entries, n_threads", [(1, None), (500, 2), (2**24, None)])
+def test_dense_batch_matches_original(max_entries, n_threads):
+    # max_entries=1 solves one item per batch, 500 a few small items per batch
+    systems = SYSTEMS + [_singular_system(), _random_system(n=3, seed=5)]
+
+    results = dense_r_bar_batch(systems, max_entries=max_entries, n_threads=n_threads)
+
+    assert len(results) == len(systems)
+    for (i_indices, j_indices, values), system in zip(results, systems):
+        expected = np.round(_original_r_bar(_dense(*system), system[3]), 2)
+        expected_i, expected_j = np.nonzero(expected)
+        np.testing.assert_array_equal(i_indices, expected_i)
+        np.testing.assert_array_equal(j_indices, expected_j)
+        np.testing.assert_allclose(values, expected[expected_i, expected_j], rtol=1e-8)
@@ -0,0 +1,92 @@
+"""Partitioned TradeMatrixFeed output against the single CSV the pipeline wrote before"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from processing.partitioned_csv import (
+    PartitionedCsvWriter, partition_dir, read_manifest, read_partitioned_csv, table_exists)
+
+COLUMNS = ["Year", "Producer_Country_Code", "Consumer_Country_Code", "Item_Code", "Value", "Animal_Product_Code"]
+
+
+def _table(seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "Year": 2013,
+        "Producer_Country_Code": rng.integers(1, 20, 300).astype(float),
+        "Consumer_Country_Code": np.sort(rng.choice([4, 8, 12, 231], 300)),
+        "Item_Code": rng.choice([15.0, 56.0, 236.0], 300),
+        "Value": rng.lognormal(0, 2, 300),
+        "Animal_Product_Code": rng.choice([np.nan, 867.0, 882.0], 300)})
+
+
+def _write(filename, table):
+    with PartitionedCsvWriter(filename, "Consumer_Country_Code", COLUMNS) as writer:
+        for consumer, partition in table.groupby("Consumer_Country_Code"):
+            writer.write(int(consumer), partition)
+
+
+def test_round_trip_matches_single_csv(tmp_path):
+    filename = tmp_path / "TradeMatrixFeed_import_dry_matter.csv"
+    table = _table()
+    _write(filename, table)
+    # what the pipeline wrote before, and how it was read
+    table.to_csv(tmp_path / "single.csv", index=False)
+    expected = pd.read_csv(tmp_path / "single.csv")
+
+    assert table_exists(filename) and not filename.exists()
+    manifest = read_manifest(filename)
+    assert [partition["key"] for partition in manifest["partitions"]] == [4, 8, 12, 231]
+    assert sum(partition["rows"] for partition in manifest["partitions"]) == len(table)
+    pd.testing.assert_frame_equal(read_partitioned_csv(filename), expected)
+    pd.testing.assert_frame_equal(
+        read_partitioned_csv(filename, partitions=[12, 4]),
+        expected[expected["Consumer_Country_Code"].isin([4, 12])].reset_index(drop=True))
+
+
+def test_single_csv_of_earlier_versions(tmp_path):
+    filename = tmp_path / "TradeMatrixFeed_import_dry_matter.csv"
+    table = _table()
+    table.to_csv(filename, index=False)
+    expected = pd.read_csv(filename)
+
+    assert read_manifest(filename) is None and table_exists(filename)
+    pd.testing.assert_frame_equal(read_partitioned_csv(filename), expected)
+    pd.testing.assert_frame_equal(
+        read_partitioned_csv(filename, partitions=[8]).reset_index(drop=True),
+        expected[expected["Consumer_Country_Code"] == 8].reset_index(drop=True))
+
+
+def test_no_selected_partitions(tmp_path):
+    filename = tmp_path / "TradeMatrixFeed_import_dry_matter.csv"
+    _write(filename, _table())
+
+    result = read_partitioned_csv(filename, partitions=[999])
+
+    assert result.empty and list(result.columns) == COLUMNS
+
+
+def test_failed_write_keeps_the_previous_output(tmp_path):
+    filename = tmp_path / "TradeMatrixFeed_import_dry_matter.csv"
+    previous = _table(0)
+    _write(filename, previous)
+    expected = read_partitioned_csv(filename)
+
+    with pytest.raises(RuntimeError):
+        with PartitionedCsvWriter(filename, "Consumer_Country_Code", COLUMNS) as writer:
+            writer.write(4, _table(1).iloc[:10])
+            # readers still see the complete previous output while a write is in progress
+            pd.testing.assert_frame_equal(read_partitioned_csv(filename), expected)
+            raise RuntimeError("stage failed")
+
+    pd.testing.assert_frame_equal(read_partitioned_csv(filename), expected)
+    assert [path.name for path in tmp_path.iterdir()] == [partition_dir(filename).name]
+
+
+def test_missing_table(tmp_path):
+    filename = tmp_path / "TradeMatrixFeed_import_dry_matter.csv"
+
+    assert not table_exists(filename)
+    with pytest.raises(FileNotFoundError):
+        read_partitioned_csv(filename)
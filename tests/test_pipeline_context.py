@@ -0,0 +1,64 @@
+"""PipelineContext.faostat: one load per request and per-year caching under a small memory budget"""
+
+import pandas as pd
+import pytest
+
+import processing.pipeline_context as pipeline_context
+from processing.pipeline_context import PipelineContext
+
+
+def _dataset(years):
+    return pd.DataFrame([
+        {"Area_Code": area, "Item_Code": 15, "Element_Code": 5510, "Year": year, "Value": float(area * year)}
+        for year in years
+        for area in range(1, 21)])
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    calls = []
+
+    def load_faostat(dataset, years=None, columns=None, elements=None, path=None):
+        calls.append(list(years))
+        data = _dataset(years)
+        return data if columns is None else data[list(columns)]
+
+    monkeypatch.setattr(pipeline_context, "load_faostat", load_faostat)
+    return calls
+
+
+def _one_year_budget():
+    year_size = _dataset([2011]).memory_usage(deep=True).sum()
+    return 1.5 * year_size / 1024**3
+
+
+def test_missing_years_load_in_one_call(loads):
+    context = PipelineContext(memory_budget_gb=1)
+
+    data = context.faostat("production", years=[2010, 2011, 2012])
+
+    assert loads == [[2010, 2011, 2012]]
+    pd.testing.assert_frame_equal(data, _dataset([2010, 2011, 2012]))
+
+    context.faostat("production", years=[2012, 2013])
+    assert loads == [[2010, 2011, 2012], [2013]]
+
+
+def test_cached_year_survives_eviction_within_a_request(loads):
+    context = PipelineContext(memory_budget_gb=_one_year_budget())
+    context.faostat("production", years=[2011])
+
+    # caching 2012 evicts 2011, which this request already took from the cache
+    data = context.faostat("production", years=[2012, 2011])
+
+    assert loads == [[2011], [2012]]
+    pd.testing.assert_frame_equal(data, _dataset([2012, 2011]))
+
+
+def test_columns_without_year(loads):
+    context = PipelineContext(memory_budget_gb=1)
+
+    data = context.faostat("production", years=[2010, 2011], columns=["Area_Code", "Value"])
+
+    assert list(data.columns) == ["Area_Code", "Value"]
+    pd.testing.assert_frame_equal(data, _dataset([2010, 2011])[["Area_Code", "Value"]])
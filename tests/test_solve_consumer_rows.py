@@ -0,0 +1,61 @@
+"""Solving only the R_bar rows the provenance of a few countries needs, against full solves"""
+
+import numpy as np
+
+from processing.calculate_trade_matrix import solve_consumer_rows, solve_item_systems
+
+COUNTRIES = np.arange(1, 13) * 10
+
+
+def _item_system(item_code, seed, density=0.35):
+    rng = np.random.default_rng(seed)
+    n = len(COUNTRIES)
+    Z = (rng.random((n, n)) < density) * rng.lognormal(2, 1, (n, n))
+    np.fill_diagonal(Z, 0)
+    p = rng.lognormal(2, 1, n) * Z.sum(axis=1).mean()
+    p[rng.random(n) < 0.3] = 0
+    rows, cols = np.nonzero(Z)
+    return (2011, item_code, COUNTRIES, rows, cols, Z[rows, cols], p)
+
+
+def _entries(result):
+    consumers, producers, values, _ = result
+    return {(int(i), int(j)): value for i, j, value in zip(consumers, producers, values)}
+
+
+def _rows(entries, codes):
+    return {key: value for key, value in entries.items() if key[0] in codes}
+
+
+def test_consumer_rows_match_full_solves():
+    # two crops, two sparsely traded animal products and the sugar aggregate
+    item_systems = [
+        _item_system(15, 0), _item_system(27, 1), _item_system(867, 2, density=0.1), _item_system(882, 3, density=0.1),
+        _item_system(2545, 4)]
+    consumers = [30, 110]
+
+    full = [_entries(result) for result in solve_item_systems(item_systems)]
+    partial = [_entries(result) for result in solve_consumer_rows(item_systems, consumers)]
+
+    # everything that is solved is the full solution
+    for entries, expected in zip(partial, full):
+        assert all(np.isclose(value, expected.get(key, 0), rtol=1e-9, atol=0.01) for key, value in entries.items())
+
+    # animal products: the consumers' rows and columns, and the rows of the countries they import from
+    origins = {j for entries in full[2:4] for (i, j), value in entries.items() if i in consumers and value != 0}
+    for entries, expected in zip(partial[2:4], full[2:4]):
+        needed = {key: value for key, value in expected.items()
+                  if key[0] in set(consumers) | origins or key[1] in consumers}
+        assert entries.keys() >= needed.keys()
+
+    # crops: the rows of the consumers and of the countries their animal product origins import from
+    feed_origins = {j for entries in full[2:4] for (i, j), value in entries.items()
+                    if i in set(consumers) | origins and value != 0}
+    for entries, expected in zip(partial[:2], full[:2]):
+        needed = _rows(expected, set(consumers) | feed_origins)
+        assert entries.keys() >= needed.keys()
+
+    # the sugar aggregate in full
+    assert partial[4].keys() == full[4].keys()
+    # and the other items only in part
+    assert origins and all(len(entries) < len(expected) for entries, expected in zip(partial[:4], full[:4]))
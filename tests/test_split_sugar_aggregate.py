@@ -0,0 +1,187 @@
+"""
+Sugar split of the trade matrix against the original groupby.apply implementation
+
+The reference functions below are the per-group versions that
+sugar_processing_shares(), add_sugar_production() and split_sugar_aggregate()
+replaced; the grouped array operations must reproduce their values, the rows
+they drop and their row order.
+"""
+
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from processing.calculate_trade_matrix import add_sugar_production, split_sugar_aggregate, sugar_processing_shares
+
+YEARS = [2010, 2011]
+
+# 1: cane and beet, both processed; 2: cane and beet, only cane processed;
+# 3: beet only, no processing data; 4: exports sugar without producing a sugar crop
+PRODUCTION = {
+    (1, 156): [500.0, 520.0], (1, 157): [300.0, 280.0],
+    (2, 156): [400.0, 410.0], (2, 157): [100.0, 90.0],
+    (3, 157): [250.0, 260.0]}
+PROCESSING = {
+    (1, 2536): [45.0, 47.0], (1, 2537): [25.0, 24.0],
+    (2, 2536): [38.0, 40.0]}
+
+
+@pytest.fixture
+def conversion_factors():
+    return pd.DataFrame({
+        "FAO_code": [156, 157],
+        "Conversion_factor": [0.11, 0.15],
+        "primary_item": [2545, 2545],
+        "FAO_name_primary": ["Sugar (Raw Equivalent)"] * 2})
+
+
+@pytest.fixture
+def production_all():
+    rows = [
+        {"Area_Code": area, "Area": f"Area {area}", "Item_Code": item, "Item": f"Item {item}",
+         "Element_Code": 5510, "Element": "Production", "Year_Code": year, "Year": year,
+         "Unit": "t", "Value": values[i], "Flag": "A"}
+        for (area, item), values in PRODUCTION.items()
+        for i, year in enumerate(YEARS)]
+    # a non-sugar item, which must not enter the shares
+    rows.append({**rows[0], "Item_Code": 15, "Item": "Wheat", "Value": 900.0})
+    return pd.DataFrame(rows)
+
+
+@pytest.fixture
+def sugar_processing():
+    return pd.DataFrame([
+        {"Area_Code": area, "Item_Code": item, "Element_Code": 5131, "Year": year, "Value": values[i]}
+        for (area, item), values in PROCESSING.items()
+        for i, year in enumerate(YEARS)])
+
+
+@pytest.fixture
+def sugar_trade_data():
+    rng = np.random.default_rng(7)
+    rows = [
+        {"Consumer_Country_Code": consumer, "Producer_Country_Code": producer,
+         "Value": rng.uniform(1.0, 20.0), "Item_Code": 2545, "Year": year}
+        for year in YEARS
+        for consumer in [3, 1, 4, 2]
+        for producer in [2, 4, 1, 3]]
+    # the MRIO results come in item/year blocks, not sorted by producer
+    return pd.DataFrame(rows).sample(frac=1.0, random_state=3).reset_index(drop=True)
+
+
+def _old_sugar_processing_shares(sugar_processing, conversion_factors):
+    sugar_processing = sugar_processing[
+        (sugar_processing["Item_Code"].isin([2536, 2537]))&
+        (sugar_processing["Element_Code"] == 5131)&
+        (sugar_processing["Area_Code"] < 300)&
+        (sugar_processing["Value"] > 0)].copy()
+    sugar_processing["Value"] = sugar_processing["Value"]*1000
+    sugar_processing["Item_Code"] = sugar_processing["Item_Code"].replace({2536: 156, 2537: 157})
+    sugar_processing = sugar_processing.merge(conversion_factors, left_on="Item_Code", right_on="FAO_code", how="left")
+    sugar_processing["Value_new"] = sugar_processing["Value"] * sugar_processing["Conversion_factor"]
+    return (sugar_processing
+        .groupby(["Area_Code", "Year"])
+        .apply(lambda x: x.assign(processing_share=x["Value_new"] / x["Value_new"].sum()))
+        .reset_index(drop=True)[["Area_Code", "Year", "Item_Code", "processing_share"]])
+
+
+def _old_sugar_shares(production_all, conversion_factors):
+    sugar_production = production_all[production_all["Item_Code"].isin([156, 157])].merge(
+        conversion_factors, left_on="Item_Code", right_on="FAO_code", how="left")
+    return (sugar_production
+        .groupby(["Area_Code", "Year"],)
+        .apply(lambda x: x.assign(share=x["Value"] / x["Value"].sum()))
+        .reset_index(drop=True)
+        [["Area_Code", "Year", "Item_Code", "share"]]
+        .query("share > 0"))
+
+
+def _old_split_sugar_aggregate(sugar_trade_data, sugar_shares, sugar_processing, production_all, conversion_factors):
+    sugar_crop_share = sugar_shares.merge(sugar_processing, on=["Area_Code", "Year", "Item_Code"], how="left")
+    sugar_crop_share = (sugar_crop_share
+        .groupby(["Area_Code", "Year"])
+        .apply(lambda x: x.assign(control=x["processing_share"].sum(skipna=True)))
+        .reset_index(drop=True))
+    mask1 = sugar_crop_share["processing_share"].isna() & (sugar_crop_share["control"] == 1)
+    sugar_crop_share.loc[mask1, "processing_share"] = 0
+    mask2 = sugar_crop_share["processing_share"].isna()
+    sugar_crop_share.loc[mask2, "processing_share"] = sugar_crop_share.loc[mask2, "share"]
+    sugar_crop_share = sugar_crop_share.rename(columns={"Item_Code": "Sugar_Crop_Code"}).assign(Item_Code=2545)
+    sugar_crop_share = sugar_crop_share.merge(
+        conversion_factors, left_on="Sugar_Crop_Code", right_on="FAO_code", how="left")
+
+    sugar_data = sugar_trade_data.merge(
+        sugar_crop_share,
+        left_on=["Year", "Item_Code", "Producer_Country_Code"],
+        right_on=["Year", "Item_Code", "Area_Code"],
+        how="left")
+    sugar_data["Value_new"] = sugar_data["Value"] * sugar_data["processing_share"] / sugar_data["Conversion_factor"]
+    sugar_data = sugar_data[["Consumer_Country_Code", "Producer_Country_Code", "Year", "Sugar_Crop_Code", "Value_new"]]
+    sugar_data = sugar_data.rename(columns={"Value_new": "Value", "Sugar_Crop_Code": "Item_Code"})
+
+    sugar_production_2 = production_all[
+        production_all["Item_Code"].isin([156, 157])].rename(columns={"Value": "national_production"})
+    sugar_data = (sugar_data
+        .groupby(["Producer_Country_Code", "Year", "Item_Code"])
+        .apply(lambda x: x.assign(sugar_crop_total=x["Value"].sum(skipna=True)))
+        .reset_index(drop=True)
+        .reindex(columns=[*sugar_data.columns, "sugar_crop_total"]))
+    sugar_data = sugar_data.merge(
+        sugar_production_2,
+        left_on=["Year", "Item_Code", "Producer_Country_Code"],
+        right_on=["Year", "Item_Code", "Area_Code"],
+        how="left")
+    sugar_data["Value_new"] = sugar_data["Value"] + sugar_data["national_production"] - sugar_data["sugar_crop_total"]
+    mask_diagonal = sugar_data["Producer_Country_Code"] == sugar_data["Consumer_Country_Code"]
+    sugar_data.loc[mask_diagonal, "Value"] = sugar_data.loc[mask_diagonal, "Value_new"]
+    return sugar_data[["Consumer_Country_Code", "Producer_Country_Code", "Value", "Item_Code", "Year"]]
+
+
+def _old(function, *args):
+    with warnings.catch_warnings():
+        # groupby.apply over the grouping columns is deprecated
+        warnings.simplefilter("ignore", DeprecationWarning)
+        warnings.simplefilter("ignore", FutureWarning)
+        return function(*args)
+
+
+def test_processing_shares(sugar_processing, conversion_factors):
+    shares = sugar_processing_shares(sugar_processing, conversion_factors)
+
+    pd.testing.assert_frame_equal(
+        shares, _old(_old_sugar_processing_shares, sugar_processing, conversion_factors))
+    assert np.allclose(shares.groupby(["Area_Code", "Year"])["processing_share"].sum(), 1)
+
+
+def test_production_shares(production_all, conversion_factors):
+    _, shares = add_sugar_production(production_all, conversion_factors)
+
+    pd.testing.assert_frame_equal(
+        shares, _old(_old_sugar_shares, production_all, conversion_factors).reset_index(drop=True))
+    assert set(shares["Area_Code"]) == {1, 2, 3}
+    assert set(shares["Item_Code"]) == {156, 157}
+
+
+def test_split_sugar_aggregate(sugar_trade_data, sugar_processing, production_all, conversion_factors):
+    processing = sugar_processing_shares(sugar_processing, conversion_factors)
+    _, shares = add_sugar_production(production_all, conversion_factors)
+
+    sugar_data = split_sugar_aggregate(sugar_trade_data, shares, processing, production_all, conversion_factors)
+    expected = _old(_old_split_sugar_aggregate, sugar_trade_data, shares, processing, production_all, conversion_factors)
+
+    # the producer without a crop share is dropped, as groupby drops its NaN keys
+    assert 4 not in set(sugar_data["Producer_Country_Code"])
+    assert len(sugar_data) == len(expected)
+    # the row order is that of the old per-group concatenation
+    pd.testing.assert_frame_equal(sugar_data, expected, check_dtype=False)
+
+    # unprocessed beet of producer 2 gets no sugar, producer 3 falls back to its production shares
+    assert (sugar_data.query("Producer_Country_Code == 2 and Item_Code == 157 and Consumer_Country_Code != 2")["Value"] == 0).all()
+    assert set(sugar_data.query("Producer_Country_Code == 3")["Item_Code"]) == {157}
+
+    # each producer's crop totals match its production
+    totals = sugar_data.groupby(["Producer_Country_Code", "Year", "Item_Code"])["Value"].sum()
+    production = production_all.set_index(["Area_Code", "Year", "Item_Code"])["Value"]
+    assert np.allclose(totals, production.reindex(totals.index))
@@ -0,0 +1,123 @@
+"""Low-rank scenario updates against a full re-solve of the edited system with the original dense pseudo-inverse"""
+
+import numpy as np
+import pytest
+
+from processing.trade_scenarios import ScenarioBaseline, run_scenarios
+
+
+def _original_r_bar(Z, p):
+    # calculate_mrio_matrices() as it was: R_bar = diag(c) pinv(I - A) diag(p)
+    x = p + Z @ np.ones(len(p))
+    one_over_x = np.where(x != 0, 1.0 / np.where(x != 0, x, 1.0), 0.0)
+    A = Z @ np.diag(one_over_x)
+    R = np.linalg.pinv(np.eye(len(p)) - A) @ np.diag(p)
+    c = (x - Z.sum(axis=0)) * one_over_x
+    return np.diag(c) @ R
+
+
+def _baseline(Z, p, countries=None):
+    rows, cols = np.nonzero(Z)
+    if countries is None:
+        countries = np.arange(10, 10 + len(p))
+    return ScenarioBaseline(2011, 15, countries, rows, cols, Z[rows, cols], p)
+
+
+def _random_baseline(n=15, density=0.3, seed=0):
+    rng = np.random.default_rng(seed)
+    Z = (rng.random((n, n)) < density) * rng.lognormal(0, 1, (n, n))
+    np.fill_diagonal(Z, 0)
+    p = rng.lognormal(0, 1, n) * Z.sum(axis=1).mean()
+    p[rng.random(n) < 0.3] = 0
+    return _baseline(Z, p)
+
+
+def _chain_z():
+    # countries 13 and 14 only re-export to each other
+    Z = np.zeros((5, 5))
+    Z[0, 1], Z[1, 0], Z[2, 0], Z[2, 1] = 4.0, 2.0, 1.5, 3.0
+    Z[3, 4], Z[4, 3] = 2.0, 5.0
+    return Z
+
+
+def _assert_scenario(baseline, z_edits=None, p_edits=None):
+    R_bar, delta = baseline.apply(z_edits, p_edits)
+    expected = _original_r_bar(*baseline.edited(z_edits, p_edits))
+
+    atol = 1e-9 * max(np.abs(expected).max(), 1.0)
+    np.testing.assert_allclose(R_bar, expected, rtol=1e-8, atol=atol)
+    np.testing.assert_allclose(delta, expected - _original_r_bar(baseline.Z, baseline.p), rtol=1e-7, atol=atol)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_flow_edits_match_full_solve(seed):
+    baseline = _random_baseline(seed=seed)
+    exporter = baseline.countries[np.argmax(baseline.Z.sum(axis=0))]
+    importer, producer = baseline.countries[np.argwhere(baseline.Z)[0]]
+
+    assert baseline.path == "sparse_lu"
+    _assert_scenario(baseline, baseline.flow_edits(producer=exporter))
+    _assert_scenario(baseline, baseline.flow_edits(consumer=importer))
+    _assert_scenario(baseline, baseline.flow_edits(consumer=importer, producer=producer, factor=2.0))
+    # a new flow where there was none
+    _assert_scenario(baseline, {(baseline.countries[1], baseline.countries[2]): 3.5})
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_production_edits_match_full_solve(seed):
+    baseline = _random_baseline(seed=seed)
+    producer = baseline.countries[np.argmax(baseline.p)]
+    non_producer = baseline.countries[np.flatnonzero(baseline.p == 0)[0]]
+
+    _assert_scenario(baseline, p_edits={producer: 0.0})
+    _assert_scenario(baseline, p_edits={producer: 0.5 * baseline.p.max(), non_producer: 2.0})
+    _assert_scenario(baseline, baseline.flow_edits(producer=producer), {producer: 0.0, non_producer: 1.0})
+
+
+def test_no_edits_give_the_baseline():
+    baseline = _random_baseline()
+
+    R_bar, delta = baseline.apply()
+
+    np.testing.assert_array_equal(R_bar, baseline.r_bar)
+    assert not delta.any()
+
+
+def test_singular_baseline_is_solved_directly():
+    baseline = _baseline(_chain_z(), np.array([10.0, 8.0, 0.0, 0.0, 0.0]))
+
+    assert baseline.path == "pinv"
+    _assert_scenario(baseline, p_edits={13: 1.0})
+    _assert_scenario(baseline, baseline.flow_edits(producer=10, factor=0.5))
+
+
+def test_singular_scenario_is_solved_directly(monkeypatch):
+    # production of 13 keeps the baseline regular, halting it leaves the re-export loop of 13 and 14
+    baseline = _baseline(_chain_z(), np.array([10.0, 8.0, 0.0, 1.0, 0.0]))
+    solve = ScenarioBaseline._solve
+    solved = []
+    monkeypatch.setattr(ScenarioBaseline, "_solve", staticmethod(lambda Z, p: solved.append(p) or solve(Z, p)))
+
+    assert baseline.path == "sparse_lu"
+    _assert_scenario(baseline, p_edits={13: 0.0})
+    assert len(solved) == 1
+    _assert_scenario(baseline, p_edits={13: 2.0})
+    assert len(solved) == 1
+
+
+def test_run_scenarios():
+    baseline = _random_baseline(seed=4)
+    producer = baseline.countries[np.argmax(baseline.p)]
+    scenarios = [{"Z": baseline.flow_edits(producer=producer)}, {"p": {producer: 0.0}}, {}]
+
+    for (R_bar, delta), scenario in zip(run_scenarios(baseline, scenarios), scenarios, strict=True):
+        expected = baseline.apply(scenario.get("Z"), scenario.get("p"))
+        np.testing.assert_array_equal(R_bar, expected[0])
+        np.testing.assert_array_equal(delta, expected[1])
+
+
+def test_unknown_country():
+    baseline = _random_baseline()
+
+    with pytest.raises(ValueError):
+        baseline.apply(p_edits={999: 1.0})